@@ -0,0 +1,68 @@
+import sqlite3, time
+
+from urllib.parse import urlsplit
+
+# A local record of every post this worker has archived.
+# Posts are keyed by blog name and url path rather than the full url,
+# so the same post found under a custom domain and under blogspot.com is only stored once.
+# Rows are staged per batch and only written once the batch has been uploaded.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    blog_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    post_url TEXT NOT NULL,
+    comment_count INTEGER,
+    fetched_at INTEGER NOT NULL,
+    location TEXT NOT NULL,
+    PRIMARY KEY (blog_name, path)
+)
+"""
+
+
+def get_post_key(blog_name, post_url):
+    parts = urlsplit(post_url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    return (blog_name, path)
+
+
+class ArchiveIndex:
+    def __init__(self, path="../archive_index.sqlite3"):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        # batch_id -> rows waiting for the batch to be uploaded
+        self.staged = {}
+
+    def get(self, blog_name, post_url):
+        row = self.connection.execute(
+            "SELECT post_url, comment_count, fetched_at, location FROM posts WHERE blog_name = ? AND path = ?",
+            get_post_key(blog_name, post_url)
+        ).fetchone()
+        if row:
+            return {"post_url": row[0], "comment_count": row[1], "fetched_at": row[2], "location": row[3]}
+
+    def has(self, blog_name, post_url):
+        return self.get(blog_name, post_url) is not None
+
+    def is_unchanged(self, blog_name, post_url, comment_count):
+        archived = self.get(blog_name, post_url)
+        return bool(archived) and archived["comment_count"] == comment_count
+
+    def stage(self, batch_id, blog_name, post_url, comment_count, location):
+        self.staged.setdefault(batch_id, []).append(get_post_key(blog_name, post_url) + (post_url, comment_count, round(time.time()), location))
+
+    def commit_batch(self, batch_id):
+        rows = self.staged.pop(batch_id, [])
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def discard_batch(self, batch_id):
+        self.staged.pop(batch_id, None)
+
+    def close(self):
+        self.connection.close()
@@ -1,32 +1,118 @@
-import time, json, gzip
+import time, json, gzip, os, shutil, sys, tempfile
+
+sys.path.insert(0, './fetch/')
+
+import metrics
 
 class BatchError(Exception):
 	pass
 
 
 class BatchFile:
-	def __init__(self, directory, batch_id):
+	# columnar_sink: an optional columnar.ColumnarSink that gets every post as well
+	# index: start a gzip member for every blog and save where each blog and post starts
+	#   to {file_name}.idx.json, so batch_reader.read_post only has to inflate one blog
+	def __init__(self, directory, batch_id, columnar_sink=None, index=False):
 		self.batch_id = batch_id
 		self.directory = directory
 		self.file_name = f"{self.batch_id}.json.gz"
-		self.batch_file = gzip.open(f"{self.directory}{self.file_name}", "w")
-		self.batch_file.write(b"[")
+		self.raw_file = open(f"{self.directory}{self.file_name}", "wb")
+		self.batch_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+
+		self.index = {"blogs": []} if index else None
+		self.index_path = f"{self.directory}{self.file_name}.idx.json" if index else None
+		self.member_offset = 0
+		self.member_bytes = 0
+
+		self.write(b"[")
 
 		self.closed = False
 
 		self.blog_started = False
 		self.blog_started_status = None
+		self.blog_name = None
+		self.blog_domain = None
+
+		self.columnar_sink = columnar_sink
+
+	def write(self, data):
+		self.batch_file.write(data)
+		self.member_bytes += len(data)
+		metrics.GZIP_BYTES.inc("uncompressed", amount=len(data))
+
+	def start_member(self):
+		self.batch_file.close()
+		self.member_offset = self.raw_file.tell()
+		self.member_bytes = 0
+		self.batch_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
 
 	def end_batch(self):
-		self.batch_file.write(b"\n]")
+		self.write(b"\n]")
+		self.batch_file.close()
+		self.raw_file.close()
+		if self.index is not None:
+			with open(self.index_path, "w") as index_file:
+				json.dump(self.index, index_file)
+		if self.columnar_sink:
+			self.columnar_sink.close()
+		metrics.GZIP_BYTES.inc("compressed", amount=os.path.getsize(f"{self.directory}{self.file_name}"))
+
+	def spool_blog(self):
+		"""Returns a BlogSpool to write a blog into before it's this blog's turn in the batch"""
+		return BlogSpool(self)
+
+	def append_spool(self, spool):
+		"""Appends a finished BlogSpool as the next blog of the batch, the compressed member is copied as it is"""
+		if self.blog_started:
+			raise BatchError("Cannot append spooled blog: there is already a blog started")
+		spool.close()
+		offset = self.append_member(spool.raw_file)
+		spool.raw_file.close()
+		if self.index is not None:
+			for blog in spool.index["blogs"]:
+				blog["location"] = (offset + blog["location"][0], blog["location"][1])
+				blog["posts"] = {url: (offset + member_offset, position) for url, (member_offset, position) in blog["posts"].items()}
+				self.index["blogs"].append(blog)
+
+	# path: a finished ShardSpool, post_locations: its index of {post_url: (0, position)} if the batch is indexed
+	def append_shard(self, path, post_locations, first_post):
+		"""Appends the posts a process of a sharded blog wrote (shards.py) to the blog that's started"""
+		if not self.blog_started or self.blog_started_status != "a":
+			raise BatchError("Cannot append shard: there is no available blog started")
+		if not first_post:
+			self.write(b",\n")
+		with open(path, "rb") as shard_file:
+			offset = self.append_member(shard_file)
+		if self.index is not None:
+			posts = self.index["blogs"][-1]["posts"]
+			for url, (member_offset, position) in post_locations.items():
+				posts[url] = (offset + member_offset, position)
+		if self.columnar_sink:
+			# the shard processes don't share the sink, their posts are read back from the shard
+			from batch_reader import iter_lines
+			for member_offset, position, line in iter_lines(path):
+				post = json.loads(line.strip().rstrip(b","))
+				if post.get("comments"):
+					self.columnar_sink.add_post(self.blog_name, self.blog_domain, post["post_url"], post["comments"])
+
+	def append_member(self, source):
+		"""Closes the current gzip member, copies the members in source after it and starts a new one, returns where they start"""
 		self.batch_file.close()
+		offset = self.raw_file.tell()
+		append_file(source, self.raw_file)
+		self.member_offset = self.raw_file.tell()
+		self.member_bytes = 0
+		self.batch_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+		return offset
 
 	# status: a for available, p for private, d for deleted, e for excluded
-	# __i for single domain investigate
+	# __i for single domain investigate, t for cut short by a time, request or byte budget
 	def start_blog(self, version, blog_name, domain, status, first_blog):
 		if not self.blog_started:
 			self.blog_started = True
 			self.blog_started_status = status
+			self.blog_name = blog_name
+			self.blog_domain = domain
 			blog_header_obj = {
 				"version": version,
 				"fetch_date": round(time.time()),
@@ -36,32 +122,59 @@ class BatchFile:
 			}
 			blog_header = ""
 			comma = "," if not first_blog else ""
+
+			if self.index is not None:
+				self.start_member()
+				# the header line starts after the comma and newline
+				location = (self.member_offset, len(comma) + 1)
+				self.index["blogs"].append({"blog_name": blog_name, "location": location, "posts": {}})
+
 			if status == "a":
 				blog_header_obj["posts"] = []
 				blog_header = f"{comma}\n    " + json.dumps(blog_header_obj)[:-2] + "\n"
 			else:
 				blog_header = f"{comma}\n    " + json.dumps(blog_header_obj)
 
-			self.batch_file.write((blog_header).encode("utf-8"))
+			self.write((blog_header).encode("utf-8"))
 		else:
 			raise BatchError("Cannot start blog: there is already a blog started")
 
-	def end_blog(self):
+	# truncated: why an available blog was cut short part way through its posts (the budget that ran out,
+	# e.g. "blog seconds"), written as a "truncated" key after the posts
+	def end_blog(self, truncated=None):
 		if self.blog_started:
 			if self.blog_started_status == "a":
-				end_text = b"\n    ]}"
-				self.batch_file.write(end_text)
+				if truncated:
+					end_text = f"\n    ], \"truncated\": {json.dumps(truncated)}}}".encode("utf-8")
+				else:
+					end_text = b"\n    ]}"
+				self.write(end_text)
 			self.blog_started = False
 			self.blog_started_status = None
+			self.blog_name = None
+			self.blog_domain = None
 		else:
 			raise BatchError("Cannot end blog: there is no blog started")
 
-	def add_blog_post(self, url, json_post, first_post):
+	# unchanged_since: the batch file an unchanged post was last archived in, written in place of its comments
+	# archived_comment_ids: comments of the post that weren't fetched again and are only known from a compact prior index
+	def add_blog_post(self, url, json_post, first_post, unchanged_since=None, archived_comment_ids=None):
 		if self.blog_started and self.blog_started_status == "a":
-			post_text = ("        " + json.dumps({"post_url": url, "comments": json_post})).encode("utf-8")
+			if unchanged_since:
+				post_obj = {"post_url": url, "unchanged_since": unchanged_since}
+			else:
+				post_obj = {"post_url": url, "comments": json_post}
+				if archived_comment_ids:
+					post_obj["archived_comment_ids"] = archived_comment_ids
+			post_text = ("        " + json.dumps(post_obj)).encode("utf-8")
 
 			pre_text = b",\n" if not first_post else b""
-			self.batch_file.write(pre_text + post_text)
+			if self.index is not None:
+				self.index["blogs"][-1]["posts"][url] = (self.member_offset, self.member_bytes + len(pre_text))
+			self.write(pre_text + post_text)
+
+			if self.columnar_sink and json_post:
+				self.columnar_sink.add_post(self.blog_name, self.blog_domain, url, json_post)
 		elif not self.blog_started:
 			raise BatchError("Cannot add blog post: there is no blog started")
 		elif self.blog_started_status != "a":
@@ -70,6 +183,114 @@ class BatchFile:
 			raise BatchError("Cannot add blog post")
 
 
+class BlogSpool(BatchFile):
+	"""
+	A blog written to its own gzip member in a temporary file next to the batch, for blogs that finish
+	before their turn (worker.py --parallel-blogs). Waiting blogs are kept on disk instead of in memory,
+	and BatchFile.append_spool copies the compressed member into the batch without inflating it.
+	"""
+
+	def __init__(self, batch):
+		self.batch_id = batch.batch_id
+		self.directory = batch.directory
+		self.file_name = batch.file_name
+		# unlinked right away, the space is freed when it's closed
+		self.raw_file = tempfile.TemporaryFile(dir=batch.directory)
+		self.batch_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+
+		self.index = {"blogs": []} if batch.index is not None else None
+		self.member_offset = 0
+		self.member_bytes = 0
+
+		self.closed = False
+
+		self.blog_started = False
+		self.blog_started_status = None
+		self.blog_name = None
+		self.blog_domain = None
+
+		self.columnar_sink = batch.columnar_sink
+
+	def start_member(self):
+		# the spool is a single member, it already starts where the blog does
+		pass
+
+	def close(self):
+		if not self.closed:
+			self.batch_file.close()
+			self.raw_file.flush()
+			self.closed = True
+
+	def end_batch(self):
+		raise BatchError("Cannot end batch: spooled blogs are appended to their batch with BatchFile.append_spool")
+
+
+class ShardSpool(BlogSpool):
+	"""
+	The posts one process of a sharded blog downloads (shards.py), written as a single gzip member to path.
+	It's inside the blog from the start, so it only holds posts, and BatchFile.append_shard copies it into
+	the blog the batch has started. A process downloads several shards one after another into the same spool.
+	"""
+
+	def __init__(self, path, batch_id, file_name, blog_name, blog_domain, index=False):
+		self.batch_id = batch_id
+		self.file_name = file_name
+		self.raw_file = open(path, "wb")
+		self.batch_file = gzip.GzipFile(fileobj=self.raw_file, mode="wb")
+
+		self.index = {"blogs": [{"blog_name": blog_name, "location": (0, 0), "posts": {}}]} if index else None
+		self.member_offset = 0
+		self.member_bytes = 0
+
+		self.closed = False
+
+		self.blog_started = True
+		self.blog_started_status = "a"
+		self.blog_name = blog_name
+		self.blog_domain = blog_domain
+
+		self.columnar_sink = None
+		self.posts_written = 0
+
+	def add_blog_post(self, url, json_post, first_post, unchanged_since=None, archived_comment_ids=None):
+		# first_post is relative to a downloader, every shard after the first needs its comma too
+		super().add_blog_post(url, json_post, self.posts_written == 0, unchanged_since, archived_comment_ids)
+		self.posts_written += 1
+
+	def start_blog(self, version, blog_name, domain, status, first_blog):
+		raise BatchError("Cannot start blog: a shard is part of the blog started in its batch")
+
+	def end_blog(self, truncated=None):
+		raise BatchError("Cannot end blog: a shard is part of the blog started in its batch")
+
+	def close(self):
+		if not self.closed:
+			self.batch_file.close()
+			self.raw_file.close()
+			self.closed = True
+
+
+def append_file(source, destination):
+	"""Copies all of source to the end of destination in the kernel where the os can (copy_file_range), otherwise in chunks"""
+	destination.flush()
+	size = os.fstat(source.fileno()).st_size
+	start = destination.tell()
+	copied = 0
+	try:
+		while copied < size:
+			count = os.copy_file_range(source.fileno(), destination.fileno(), size - copied, copied, start + copied)
+			if count == 0:
+				break
+			copied += count
+	except (AttributeError, OSError):
+		# no copy_file_range (not Linux or python < 3.8) or not between these file systems
+		pass
+	destination.seek(start + copied)
+	if copied < size:
+		source.seek(copied)
+		shutil.copyfileobj(source, destination)
+
+
 if __name__ == '__main__':
 
 	test_posts = [
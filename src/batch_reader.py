@@ -0,0 +1,171 @@
+import json, zlib
+
+# Reads the .json.gz batches BatchFile writes without inflating and parsing the whole batch.
+# The format is one json object per line:
+#
+# [
+#     {blog header..., "posts": [
+#         {"post_url": ..., "comments": [...]},
+#         {"post_url": ..., "comments": [...]}
+#     ]},
+#     {header of a blog without posts (deleted, private...)}
+# ]
+#
+# Memory use is bounded by the largest single post. Batches written with index=True start a new
+# gzip member for every blog, so a post can be read back by inflating only its own blog.
+
+CHUNK_SIZE = 256 * 1024
+POST_INDENT = b"        "
+
+
+def iter_lines(path, start=0):
+    """
+    Yields (member_offset, offset_in_member, line) for every line of a (possibly multi member) gzip file.
+    member_offset is where the gzip member the line starts in begins in the compressed file,
+    offset_in_member is where the line starts in that member's inflated data.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw_position = start
+        inflated = 0
+        # (inflated position the member starts at, compressed offset of the member)
+        members = [(0, start)]
+        pending = b""
+        pending_start = 0
+
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            while chunk:
+                data = decompressor.decompress(chunk)
+                inflated += len(data)
+                pending += data
+
+                # the lines are sliced out from line_start on, pending is only cut once per chunk
+                line_start = 0
+                line_end = pending.find(b"\n")
+                while line_end != -1:
+                    while len(members) > 1 and members[1][0] <= pending_start:
+                        members.pop(0)
+                    yield (members[0][1], pending_start - members[0][0], pending[line_start:line_end])
+                    pending_start += line_end + 1 - line_start
+                    line_start = line_end + 1
+                    line_end = pending.find(b"\n", line_start)
+                pending = pending[line_start:]
+
+                if decompressor.eof:
+                    raw_position += len(chunk) - len(decompressor.unused_data)
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    members.append((inflated, raw_position))
+                else:
+                    raw_position += len(chunk)
+                    chunk = b""
+
+        if pending:
+            while len(members) > 1 and members[1][0] <= pending_start:
+                members.pop(0)
+            yield (members[0][1], pending_start - members[0][0], pending)
+
+
+def parse_blog_end(text):
+    # "]}" or "], "truncated": "blog seconds"}" when the blog was cut short by a budget
+    extra = text[1:].lstrip(",").strip()
+    if extra and extra != "}":
+        return json.loads("{" + extra)
+    return {}
+
+
+def iter_records(path, start=0):
+    """Yields ("blog", header, location), ("post", post, location) and ("end_blog", updates, location) for every line"""
+    for member_offset, offset, line in iter_lines(path, start):
+        text = line.strip().rstrip(b",")
+        if not text or text in (b"[", b"]"):
+            continue
+        location = (member_offset, offset)
+        if text.startswith(b"]"):
+            yield ("end_blog", parse_blog_end(text.decode("utf-8")), location)
+        elif line.startswith(POST_INDENT):
+            yield ("post", json.loads(text), location)
+        elif text.endswith(b"["):
+            # an available blog, its posts follow on the next lines
+            yield ("blog", json.loads(text + b"]}"), location)
+        else:
+            yield ("blog", json.loads(text), location)
+
+
+def iter_posts(path):
+    """Yields (blog header, post) for every post in a batch"""
+    header = None
+    for kind, record, location in iter_records(path):
+        if kind == "blog":
+            header = record
+        elif kind == "post":
+            yield (header, record)
+
+
+def iter_blogs(path):
+    """Yields every blog header, with "truncated" if the blog was cut short after its posts started"""
+    header = None
+    for kind, record, location in iter_records(path):
+        if kind == "blog":
+            if header is not None:
+                yield header
+            header = record
+            header.pop("posts", None)
+        elif kind == "end_blog":
+            header.update(record)
+            yield header
+            header = None
+    if header is not None:
+        yield header
+
+
+def build_index(path):
+    """Maps every blog and post to where it starts: {"blogs": [{"blog_name", "location", "posts": {post_url: location}}]}"""
+    blogs = []
+    for kind, record, location in iter_records(path):
+        if kind == "blog":
+            blogs.append({"blog_name": record["blog_name"], "location": location, "posts": {}})
+        elif kind == "post":
+            blogs[-1]["posts"][record["post_url"]] = location
+    return {"blogs": blogs}
+
+
+def save_index(index, path):
+    with open(path, "w") as file:
+        json.dump(index, file)
+
+
+def load_index(path):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def find_post(index, blog_name, post_url):
+    for blog in index["blogs"]:
+        if blog["blog_name"] == blog_name and post_url in blog["posts"]:
+            return blog["posts"][post_url]
+
+
+def read_post(path, location):
+    """Reads a single post, inflating from the start of its gzip member"""
+    member_offset, offset = location
+    for line_member_offset, line_offset, line in iter_lines(path, member_offset):
+        if line_offset == offset:
+            return json.loads(line.strip().rstrip(b","))
+        elif line_member_offset != member_offset or line_offset > offset:
+            break
+    raise KeyError(f"No post at {location} in {path}")
+
+
+if __name__ == '__main__':
+    import sys
+
+    batch_path = sys.argv[1]
+    index = build_index(batch_path)
+    for blog in index["blogs"]:
+        print(f"{blog['blog_name']} | posts: {len(blog['posts'])} | location: {blog['location']}")
+    save_index(index, f"{batch_path}.idx.json")
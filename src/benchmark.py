@@ -0,0 +1,322 @@
+import sys, os, gc, json, argparse, atexit, shutil, subprocess, tempfile, tracemalloc
+
+from time import perf_counter
+
+sys.path.insert(0, './fetch/')
+
+# Times the CPU-bound parts of the scraper against the recorded responses in ../test_data/.
+# Each benchmark returns a function that processes its records once plus the number of records,
+# and is reported as the best time per record over several rounds, along with the peak memory
+# allocated per record (tracemalloc) in one more round.
+# python benchmark.py [names...]
+# python benchmark.py --save-baseline  saves the results to BASELINE_PATH, merged into the benchmarks already in it
+# python benchmark.py --check          exits with 1 if a benchmark allocates more than its baseline by more than
+#                                      --memory-threshold or its record count changed
+# python benchmark.py --check --check-time  also fails if it got slower by more than --time-threshold, only
+#                                      meaningful against a baseline saved on the same machine
+
+TEST_DATA = "../test_data/"
+BASELINE_PATH = "benchmark_baseline.json"
+
+BENCHMARKS = {}
+# benchmarks --check leaves out, their timings are too noisy to gate on
+UNCHECKED = set()
+# increases in peak memory per record below this many bytes are noise, not regressions
+MEMORY_SLACK = 32
+
+
+def benchmark(name, check=True):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        if not check:
+            UNCHECKED.add(name)
+        return setup
+    return register
+
+
+def read_test_data(file_name):
+    with open(f"{TEST_DATA}{file_name}", "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def load_comments():
+    from comments import get_comments_from_blogger_object
+    # sample_comments.json is the part of the widget's blogger object the comments are in
+    return get_comments_from_blogger_object([None, json.loads(read_test_data("sample_comments.json"))])
+
+
+def load_replies():
+    from replies import get_replies_from_raw_response
+    return list(get_replies_from_raw_response(read_test_data("replies_response.txt")))
+
+
+def load_texts():
+    return [item["text"] for item in load_comments() + load_replies() if item.get("text")]
+
+
+@benchmark("decode_text")
+def bench_decode_text(scale):
+    from text_content import decode_text
+    texts = load_texts() * scale
+
+    def run():
+        for text in texts:
+            decode_text(text)
+    return run, len(texts)
+
+
+@benchmark("set_text_both")
+def bench_set_text(scale):
+    import text_content
+    texts = load_texts() * scale
+
+    def run():
+        text_content.TEXT_FORMAT = "both"
+        try:
+            for text in texts:
+                text_content.set_text({}, text)
+        finally:
+            text_content.TEXT_FORMAT = "raw"
+    return run, len(texts)
+
+
+def scale_reply_thread(scale, file_name="replies_response.txt"):
+    # repeats the replies of a recorded getactivity response to make a thread scale times as long
+    from util import remove_xssi_guard
+    response = json.loads(remove_xssi_guard(read_test_data(file_name)))
+    response[0][1][7] = response[0][1][7] * scale
+    return ")]}'\n" + json.dumps(response), len(response[0][1][7])
+
+
+@benchmark("replies_thread")
+def bench_replies_thread(scale):
+    from replies import get_replies_from_raw_response
+    raw_response_text, reply_count = scale_reply_thread(scale)
+
+    def run():
+        for reply in get_replies_from_raw_response(raw_response_text):
+            pass
+    return run, reply_count
+
+
+@benchmark("comments_from_blogger_object")
+def bench_comments_from_blogger_object(scale):
+    from comments import get_comments_from_blogger_object
+    page = json.loads(read_test_data("sample_comments.json"))
+    page[7] = page[7] * scale
+
+    def run():
+        # the comments are replaced in the list they're read from, so every round gets its own list
+        return get_comments_from_blogger_object([None, page[:7] + [list(page[7])] + page[8:]])
+    return run, len(page[7])
+
+
+@benchmark("info_from_comment")
+def bench_info_from_comment(scale):
+    from comments import get_info_from_comment
+    raw_comments = json.loads(read_test_data("sample_comments.json"))[7] * scale
+
+    def run():
+        return [get_info_from_comment(comment) for comment in raw_comments]
+    return run, len(raw_comments)
+
+
+@benchmark("replies_from_raw_response")
+def bench_replies_from_raw_response(scale):
+    from replies import get_replies_from_raw_response
+    raw_response_text, reply_count = scale_reply_thread(scale, "sample_replies.json")
+
+    def run():
+        return list(get_replies_from_raw_response(raw_response_text))
+    return run, reply_count
+
+
+@benchmark("plus_ones_from_raw_response")
+def bench_plus_ones_from_raw_response(scale):
+    # getpeople responses aren't recorded, this one lists the authors of the recorded comments and replies
+    from plus_ones import get_plus_ones_from_raw_response
+    people = [[item["user_name"], item["user_id"], item["user_profile"], item["user_avatar"]] for item in load_comments() + load_replies()] * scale
+    raw_response_text = ")]}'\n" + json.dumps([["os.pl", people]])
+
+    def run():
+        return list(get_plus_ones_from_raw_response(raw_response_text))
+    return run, len(people)
+
+
+@benchmark("add_blog_post")
+def bench_add_blog_post(scale):
+    # every post has all the recorded comments and replies, written to a new batch file in a temporary directory
+    from batch_file import BatchFile
+    comments = load_comments()
+    comments[0]["replies"] = load_replies()
+    directory = tempfile.mkdtemp(prefix="benchmark-") + "/"
+    atexit.register(shutil.rmtree, directory, True)
+    posts = [(f"https://blogger.googleblog.com/2019/01/post-{i}.html", comments) for i in range(2 * scale)]
+
+    def run():
+        batch_file = BatchFile(directory, "benchmark")
+        batch_file.start_blog(3, "googleblog", "blogger.googleblog.com", "a", True)
+        for i, (url, post_comments) in enumerate(posts):
+            batch_file.add_blog_post(url, post_comments, i == 0)
+        batch_file.end_blog()
+        batch_file.end_batch()
+        os.remove(directory + batch_file.file_name)
+    return run, len(posts)
+
+
+@benchmark("request_bodies")
+def bench_request_bodies(scale):
+    from request_bodies import more_comments_body, replies_body
+    comments = load_comments()
+    post_url = "https://blogger.googleblog.com/2019/01/an-update-on-google-and-blogger.html"
+    comment_ids = [comment["id"] for comment in comments] * scale
+
+    def run():
+        for comment_id in comment_ids:
+            more_comments_body(post_url).render(continuation_key=comment_id)
+            replies_body(post_url).render(comment_id=comment_id, page_hint=20)
+    return run, len(comment_ids)
+
+
+@benchmark("request_bodies_urlencode")
+def bench_request_bodies_urlencode(scale):
+    # what building the bodies costs when the whole template is formatted and urlencoded every time
+    from urllib.parse import urlencode
+    from request_bodies import MORE_COMMENTS_TEMPLATE, REPLIES_TEMPLATE
+    comments = load_comments()
+    post_url = "https://blogger.googleblog.com/2019/01/an-update-on-google-and-blogger.html"
+    comment_ids = [comment["id"] for comment in comments] * scale
+
+    def run():
+        for comment_id in comment_ids:
+            urlencode({"f.req": MORE_COMMENTS_TEMPLATE.format(continuation_key=comment_id, post_url=post_url)}, doseq=True).encode("utf-8")
+            urlencode({"f.req": REPLIES_TEMPLATE.format(comment_id=comment_id, page_hint=20, post_url=post_url)}, doseq=True).encode("utf-8")
+    return run, len(comment_ids)
+
+
+@benchmark("startup", check=False)
+def bench_startup(scale):
+    # a fresh interpreter importing the worker, as on every dyno start or supervisor restart
+    def run():
+        subprocess.run([sys.executable, "-c", "import worker"], check=True)
+    return run, 1
+
+
+@benchmark("blog_domain")
+def bench_blog_domain(scale):
+    from util import get_blog_domain
+    post_urls = [f"http://blog{i}.blogspot.com/2013/05/post-{i}.html" for i in range(100 * scale)]
+
+    def run():
+        for post_url in post_urls:
+            get_blog_domain(post_url)
+    return run, len(post_urls)
+
+
+def text_sizes():
+    from text_content import decode_text
+    raw = decoded = 0
+    for text in load_texts():
+        plain, spans = decode_text(text)
+        raw += len(json.dumps(text))
+        decoded += len(json.dumps(plain)) + len(json.dumps(spans or None))
+    return raw, decoded
+
+
+def run_benchmark(name, scale, rounds):
+    run, records = BENCHMARKS[name](scale)
+    best = None
+    # like timeit, collections are kept out of the timings
+    gc.disable()
+    try:
+        for i in range(rounds):
+            started = perf_counter()
+            run()
+            elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    # tracemalloc slows everything down, so memory is measured in a separate round
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"name": name, "records": records, "best": best, "per_record": best / records if records else 0, "peak_bytes_per_record": peak / records if records else 0}
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_baseline(results, scale, path=BASELINE_PATH):
+    # the benchmarks that weren't run keep their results, unless they were saved with another scale
+    benchmarks = {}
+    if os.path.exists(path):
+        baseline = load_baseline(path)
+        if baseline["scale"] == scale:
+            benchmarks = baseline["benchmarks"]
+    benchmarks.update((result["name"], result) for result in results)
+    with open(path, "w") as file:
+        json.dump({"scale": scale, "benchmarks": benchmarks}, file, indent=4)
+
+
+def check_regressions(results, baseline, time_threshold, memory_threshold):
+    """Returns a message for every benchmark allocating more (or with time_threshold, running slower) than its baseline
+    by more than the thresholds"""
+    regressions = []
+    for result in results:
+        expected = baseline["benchmarks"].get(result["name"])
+        if not expected or result["name"] in UNCHECKED:
+            continue
+        if expected["records"] != result["records"]:
+            regressions.append(f"{result['name']}: {result['records']} records instead of {expected['records']}, the fixtures or --scale changed, save a new baseline")
+            continue
+        # times are only comparable to a baseline saved on the same machine, so they're checked on request
+        if time_threshold is not None and result["per_record"] > expected["per_record"] * (1 + time_threshold):
+            regressions.append(f"{result['name']}: {result['per_record'] * 1e6:.2f} us per record, baseline {expected['per_record'] * 1e6:.2f} us (+{result['per_record'] / expected['per_record'] - 1:.0%})")
+        if result["peak_bytes_per_record"] > max(expected["peak_bytes_per_record"] * (1 + memory_threshold), expected["peak_bytes_per_record"] + MEMORY_SLACK):
+            regressions.append(f"{result['name']}: {result['peak_bytes_per_record']:.0f} bytes per record, baseline {expected['peak_bytes_per_record']:.0f} bytes (+{result['peak_bytes_per_record'] / expected['peak_bytes_per_record'] - 1:.0%})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all of them by default (the ones in the baseline with --check)")
+    parser.add_argument("--scale", type=int, default=50, help="times the fixture records are repeated")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--check", action="store_true", help="fail if a benchmark's memory or record count regressed against the baseline")
+    parser.add_argument("--check-time", action="store_true", help="with --check, also fail on slower times, for a baseline saved on this machine")
+    parser.add_argument("--time-threshold", type=float, default=0.25, help="allowed increase in time per record with --check-time")
+    parser.add_argument("--memory-threshold", type=float, default=0.10, help="allowed increase in peak memory per record with --check")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.check else None
+    if baseline and args.scale != baseline["scale"]:
+        sys.exit(f"The baseline was saved with --scale {baseline['scale']}")
+    names = args.names or ([name for name in baseline["benchmarks"] if name not in UNCHECKED] if baseline else list(BENCHMARKS))
+
+    results = []
+    for name in names:
+        result = run_benchmark(name, args.scale, args.rounds)
+        results.append(result)
+        print(f"{name} | records: {result['records']} | best: {result['best'] * 1000:.2f} ms | per record: {result['per_record'] * 1e6:.2f} us | peak memory per record: {result['peak_bytes_per_record']:.0f} bytes")
+
+    if not args.names or "decode_text" in args.names:
+        raw, decoded = text_sizes()
+        print(f"text json size | raw: {raw} bytes | decoded: {decoded} bytes ({decoded / raw:.0%})")
+
+    if args.save_baseline:
+        save_baseline(results, args.scale, args.baseline)
+        print(f"Saved baseline to {args.baseline}")
+    if baseline:
+        regressions = check_regressions(results, baseline, args.time_threshold if args.check_time else None, args.memory_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
@@ -0,0 +1,142 @@
+import json, os, sys
+
+sys.path.insert(0, './fetch/')
+
+from comments import COMMENT_FIELDS
+from replies import REPLY_FIELDS
+from plus_ones import PLUS_ONE_FIELDS
+
+# Writes the comments, replies and +1s of a batch as three Parquet files next to the .json.gz,
+# flat tables that analytics can query without re-parsing the nested json.
+# Columns with few distinct values (user ids, domains, post urls...) are dictionary encoded.
+# Needs pyarrow, which is only imported when a ColumnarSink is created.
+
+# Columns in front of each table's own fields, tying the rows back to their blog, post and parent
+COMMENT_COLUMNS = ("blog_name", "blog_domain", "post_url") + COMMENT_FIELDS
+REPLY_COLUMNS = ("blog_name", "blog_domain", "post_url", "comment_id") + REPLY_FIELDS
+PLUS_ONE_COLUMNS = ("blog_name", "blog_domain", "post_url", "comment_id", "reply_id") + PLUS_ONE_FIELDS
+
+DICTIONARY_COLUMNS = {"blog_name", "blog_domain", "post_url", "comment_id", "domain", "user_name", "user_id", "user_avatar", "user_profile", "language_code", "language_display", "share_string"}
+INTEGER_COLUMNS = {"type", "reply_count", "date_posted", "plus_one_count"}
+# nested values are stored as their json
+JSON_COLUMNS = {"text", "text_spans"}
+
+# rows buffered per table before they're written out as a row group
+ROW_GROUP_SIZE = 50000
+
+
+class DictionaryColumn:
+    def __init__(self):
+        self.codes = []
+        self.dictionary = []
+        self.lookup = {}
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(None)
+            return
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        self.codes.append(code)
+
+    def to_arrow(self, pa):
+        return pa.DictionaryArray.from_arrays(pa.array(self.codes, pa.int32()), pa.array(self.dictionary, pa.string()))
+
+
+class PlainColumn:
+    def __init__(self, arrow_type):
+        self.values = []
+        self.arrow_type = arrow_type
+
+    def append(self, value):
+        self.values.append(value)
+
+    def to_arrow(self, pa):
+        return pa.array(self.values, self.arrow_type)
+
+
+class ColumnarTable:
+    def __init__(self, pa, pq, path, columns):
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.columns = columns
+        self.writer = None
+        self.rows = 0
+        self.reset()
+
+    def reset(self):
+        pa = self.pa
+        self.data = {}
+        for name in self.columns:
+            if name in DICTIONARY_COLUMNS:
+                self.data[name] = DictionaryColumn()
+            elif name in INTEGER_COLUMNS:
+                self.data[name] = PlainColumn(pa.int64())
+            else:
+                self.data[name] = PlainColumn(pa.string())
+        self.buffered = 0
+
+    def append(self, row):
+        for name in self.columns:
+            value = row.get(name)
+            if name in JSON_COLUMNS and value is not None:
+                value = json.dumps(value, separators=(",", ":"))
+            self.data[name].append(value)
+        self.buffered += 1
+        if self.buffered >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        table = self.pa.table({name: self.data[name].to_arrow(self.pa) for name in self.columns})
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema, compression="zstd")
+        self.writer.write_table(table)
+        self.rows += self.buffered
+        self.reset()
+
+    def close(self):
+        self.flush()
+        if self.writer:
+            self.writer.close()
+
+
+def import_pyarrow():
+    """Returns the pyarrow and pyarrow.parquet modules, worker.py calls it at startup to fail before taking batches"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Columnar output needs pyarrow (pip install pyarrow)")
+    return pa, pq
+
+
+class ColumnarSink:
+    def __init__(self, directory, batch_id):
+        pa, pq = import_pyarrow()
+
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.comments = ColumnarTable(pa, pq, f"{directory}{batch_id}.comments.parquet", COMMENT_COLUMNS)
+        self.replies = ColumnarTable(pa, pq, f"{directory}{batch_id}.replies.parquet", REPLY_COLUMNS)
+        self.plus_ones = ColumnarTable(pa, pq, f"{directory}{batch_id}.plus_ones.parquet", PLUS_ONE_COLUMNS)
+
+    def add_post(self, blog_name, blog_domain, post_url, comments):
+        parent = {"blog_name": blog_name, "blog_domain": blog_domain, "post_url": post_url}
+        for comment in comments:
+            self.comments.append(dict(comment, **parent))
+            for plus_one in comment.get("plus_ones", ()):
+                self.plus_ones.append(dict(plus_one, comment_id=comment["id"], **parent))
+            for reply in comment.get("replies", ()):
+                self.replies.append(dict(reply, comment_id=comment["id"], **parent))
+                for plus_one in reply.get("plus_ones", ()):
+                    self.plus_ones.append(dict(plus_one, comment_id=comment["id"], reply_id=reply["id"], **parent))
+
+    def close(self):
+        self.comments.close()
+        self.replies.close()
+        self.plus_ones.close()
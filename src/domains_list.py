@@ -0,0 +1,340 @@
+import asyncio, hashlib, os, zlib
+
+from log import get_logger
+
+DOMAINS_PATH = "../domains.txt"
+# the compressed download is kept while in progress so it can be resumed with a range request
+DOMAINS_PART_PATH = "../domains.txt.gz.part"
+# sha256 and size of the extracted domains.txt, written once the download has been verified
+DOMAINS_HASH_PATH = "../domains.txt.sha256"
+# size of the published domains.txt, checked for lists without a hash file (downloaded by workers from
+# before the hash was recorded, or extracted by hand)
+DOMAINS_SIZE = 122697503
+
+CHUNK_SIZE = 1024 * 1024
+MAX_DOWNLOAD_TRIES = 10
+# blocks kept in memory by RemoteDomains when there is no local block cache
+MEMORY_BLOCKS = 64
+
+log = get_logger("domains")
+# how often LocalDomains checks whether the download has reached the lines a batch needs
+DOWNLOAD_POLL_SECONDS = 1
+
+
+class IncompleteDomains(Exception):
+    pass
+
+
+class DomainsExtractor:
+    """Inflates the gzipped domains list into domains.txt as it arrives."""
+
+    def __init__(self, output_path=DOMAINS_PATH):
+        self.output = open(output_path, "wb")
+        # 16 + MAX_WBITS tells zlib to expect (and verify) the gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.compressed_hash = hashlib.sha256()
+        self.extracted_hash = hashlib.sha256()
+        self.line_count = 0
+        self.bytes_written = 0
+
+    def feed(self, chunk):
+        """Raises zlib.error if the chunk isn't valid gzip data"""
+        data = self.decompressor.decompress(chunk)
+        self.compressed_hash.update(chunk)
+        self._write(data)
+
+    def finish(self):
+        self._write(self.decompressor.flush())
+        self.output.close()
+        # eof is only set once the gzip trailer (crc32 and size) has been read and checked
+        return self.decompressor.eof
+
+    def _write(self, data):
+        if not data:
+            return
+        self.output.write(data)
+        # LocalDomains reads batches from the file while it's being extracted
+        self.output.flush()
+        self.extracted_hash.update(data)
+        self.line_count += data.count(b"\n")
+        self.bytes_written += len(data)
+
+    def save_hash(self, hash_path=DOMAINS_HASH_PATH):
+        with open(hash_path, "w") as hash_file:
+            hash_file.write(f"{self.extracted_hash.hexdigest()} {self.bytes_written}")
+
+
+def hash_file(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def is_valid_domains_file(path=DOMAINS_PATH, hash_path=DOMAINS_HASH_PATH):
+    if not os.path.exists(path):
+        return False
+    if not os.path.exists(hash_path):
+        if os.path.getsize(path) != DOMAINS_SIZE:
+            return False
+        # the hash file is written once so later starts only have to check the size
+        with open(hash_path, "w") as file:
+            file.write(f"{hash_file(path)} {DOMAINS_SIZE}")
+        return True
+    with open(hash_path, "r") as file:
+        expected = file.read().split()
+    if len(expected) > 1:
+        # the download was already checked (gzip crc and the published sha256) when the hash file
+        # was written, only make sure the file wasn't cut short or replaced since
+        return os.path.getsize(path) == int(expected[1])
+    # hash files written before the size was recorded
+    return hash_file(path) == expected[0]
+
+
+async def fetch_expected_hash(url, session):
+    # The upload server may publish a sha256 of the gzip next to it, if it doesn't we rely on the gzip crc
+    try:
+        async with session.get(f"{url}.sha256") as response:
+            if response.status == 200:
+                text = await response.text()
+                return text.split()[0].lower() if text.strip() else None
+    except Exception:
+        pass
+    return None
+
+
+def discard_download(extractor, part_path, output_path):
+    extractor.output.close()
+    for path in (part_path, output_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def download_domains(url, session, part_path=DOMAINS_PART_PATH, output_path=DOMAINS_PATH):
+    expected_hash = await fetch_expected_hash(url, session)
+
+    extractor = DomainsExtractor(output_path)
+
+    # Inflate whatever was already downloaded by a previous run before resuming
+    if os.path.exists(part_path):
+        log.info("Resuming domains download from %s bytes", os.path.getsize(part_path))
+        try:
+            with open(part_path, "rb") as part:
+                for chunk in iter(lambda: part.read(CHUNK_SIZE), b""):
+                    extractor.feed(chunk)
+        except zlib.error as e:
+            log.warning("The partial domains download is corrupt (%s), restarting it", e)
+            discard_download(extractor, part_path, output_path)
+            extractor = DomainsExtractor(output_path)
+
+    try:
+        tries = 0
+        with open(part_path, "ab") as part:
+            while not extractor.decompressor.eof:
+                tries += 1
+                if tries > MAX_DOWNLOAD_TRIES:
+                    raise IncompleteDomains(f"Unable to download the domains list after {MAX_DOWNLOAD_TRIES} tries")
+
+                downloaded = part.tell()
+                headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 200 and downloaded:
+                            # The server ignored the range, start over
+                            log.warning("Server does not support resuming, restarting domains download")
+                            part.seek(0)
+                            part.truncate()
+                            extractor.output.close()
+                            extractor = DomainsExtractor(output_path)
+                        elif response.status not in (200, 206):
+                            log.warning("Failed to get domains.txt.gz (%s), retrying", response.status)
+                            await asyncio.sleep(2)
+                            continue
+
+                        log.info("Downloading domains list | content length: %s | resumed at: %s", response.headers.get('Content-Length'), part.tell())
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            # inflated first so corrupt data never gets into the part a restart resumes from
+                            extractor.feed(chunk)
+                            part.write(chunk)
+                        part.flush()
+                except zlib.error as e:
+                    log.warning("Received corrupt domains list data (%s), restarting the download", e)
+                    part.seek(0)
+                    part.truncate()
+                    extractor.output.close()
+                    extractor = DomainsExtractor(output_path)
+                except Exception as e:
+                    # timeouts, dropped connections and aiohttp.ClientError all resume from what was written
+                    log.warning("Domains download interrupted (%r) at %s bytes, resuming in 2 seconds", e, part.tell())
+                    part.flush()
+                    await asyncio.sleep(2)
+
+        if not extractor.finish():
+            raise IncompleteDomains("The domains list is incomplete")
+
+        if expected_hash and extractor.compressed_hash.hexdigest() != expected_hash:
+            raise IncompleteDomains("The domains list does not match the published sha256")
+    except IncompleteDomains:
+        # nothing of it can be trusted, the next start downloads it again from the beginning
+        discard_download(extractor, part_path, output_path)
+        raise
+
+    extractor.save_hash()
+    os.remove(part_path)
+
+    log.info("Extracted domains list | lines: %s | bytes: %s", extractor.line_count, extractor.bytes_written)
+    return True
+
+
+class LocalDomains:
+    """
+    The domains.txt on disk. download is the download_domains task while it's still being extracted,
+    batches read their lines as soon as the download has got to them.
+    """
+
+    def __init__(self, path=DOMAINS_PATH, download=None):
+        self.path = path
+        self.download = download
+        self.file = None
+
+    async def read_lines(self, offset, count):
+        while True:
+            lines = self.read(offset, count)
+            if self.download is None or (lines is not None and all(line.endswith(b"\n") for line in lines)):
+                break
+            if self.download.done():
+                # raises if the download failed, the lines that are there are all the list has otherwise
+                self.download.result()
+                self.download = None
+                continue
+            await asyncio.sleep(DOWNLOAD_POLL_SECONDS)
+        return [line.decode("utf-8").rstrip("\n") for line in lines]
+
+    def read(self, offset, count):
+        """Returns count lines from offset as bytes, None if the download hasn't created the file yet"""
+        if self.download is not None:
+            # a download that restarts replaces the file, so it's opened again for every read until it's done
+            if not os.path.exists(self.path):
+                return None
+            with open(self.path, "rb") as file:
+                file.seek(offset)
+                return [file.readline() for i in range(count)]
+        if self.file is None:
+            self.file = open(self.path, "rb")
+        # Read the whole slice at once so batch downloaders sharing the file can't interleave seeks
+        self.file.seek(offset)
+        return [self.file.readline() for i in range(count)]
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class RemoteDomains:
+    """
+    Reads only the needed byte ranges of an uncompressed domains.txt served over http.
+    Fetched blocks are kept in a sparse local file (cache_path) so repeated batches
+    over the same area of the list don't hit the server again.
+    """
+
+    def __init__(self, url, session, cache_path=None, block_size=64 * 1024):
+        self.url = url
+        self.session = session
+        self.block_size = block_size
+        self.size = None
+
+        self.cache_path = cache_path
+        self.cached_blocks = set()
+        self.memory_blocks = {}
+        if cache_path:
+            # the sparse file only takes up disk space for the blocks that were written
+            self.cache = open(cache_path, "r+b" if os.path.exists(cache_path) else "w+b")
+            if os.path.exists(f"{cache_path}.blocks"):
+                with open(f"{cache_path}.blocks", "r") as blocks_file:
+                    self.cached_blocks = {int(block) for block in blocks_file.read().split()}
+            self.blocks_file = open(f"{cache_path}.blocks", "a")
+        else:
+            self.cache = None
+
+    async def fetch_block(self, block):
+        start = block * self.block_size
+        end = start + self.block_size - 1
+        if self.size is not None and start >= self.size:
+            return b""
+
+        for dl_try in range(MAX_DOWNLOAD_TRIES):
+            try:
+                async with self.session.get(self.url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                    if response.status == 416:
+                        return b""
+                    elif response.status == 206:
+                        content_range = response.headers.get("Content-Range", "")
+                        if "/" in content_range and content_range.rsplit("/", 1)[1] != "*":
+                            self.size = int(content_range.rsplit("/", 1)[1])
+                        return await response.read()
+                    elif response.status == 200:
+                        # No range support, there's no point in being lazy
+                        raise IncompleteDomains(f"{self.url} doesn't support range requests")
+                    log.warning("Failed to get domains block %s (%s), retrying", block, response.status)
+            except IncompleteDomains:
+                raise
+            except Exception as e:
+                log.warning("Failed to get domains block %s (%r), retrying", block, e)
+            await asyncio.sleep(2)
+
+        raise IncompleteDomains(f"Unable to get block {block} of the domains list")
+
+    async def read_block(self, block):
+        if block in self.cached_blocks:
+            self.cache.seek(block * self.block_size)
+            return self.cache.read(self.block_size)
+        elif block in self.memory_blocks:
+            return self.memory_blocks[block]
+
+        data = await self.fetch_block(block)
+        # only full blocks are cached, the last block of the file is small and cheap to refetch
+        if len(data) == self.block_size:
+            if self.cache:
+                self.cache.seek(block * self.block_size)
+                self.cache.write(data)
+                self.cache.flush()
+                self.cached_blocks.add(block)
+                self.blocks_file.write(f"{block}\n")
+                self.blocks_file.flush()
+            else:
+                if len(self.memory_blocks) >= MEMORY_BLOCKS:
+                    # drop the oldest block
+                    del self.memory_blocks[next(iter(self.memory_blocks))]
+                self.memory_blocks[block] = data
+        return data
+
+    async def read_lines(self, offset, count):
+        lines = []
+        pending = b""
+        block = offset // self.block_size
+        skip = offset - block * self.block_size
+
+        while len(lines) < count:
+            data = await self.read_block(block)
+            if skip:
+                data = data[skip:]
+                skip = 0
+            if not data:
+                break
+            pending += data
+            *complete, pending = pending.split(b"\n")
+            lines.extend(line.decode("utf-8") for line in complete)
+            block += 1
+
+        if len(lines) < count and pending:
+            lines.append(pending.decode("utf-8"))
+        # match readline() at the end of the file
+        lines = lines[:count]
+        lines.extend("" for i in range(count - len(lines)))
+        return lines
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+            self.blocks_file.close()
@@ -1,4 +1,4 @@
-import json, asyncio, aiohttp, logging, traceback
+import json, asyncio, aiohttp, logging, argparse, contextlib, heapq, itertools
 from time import perf_counter
 
 import sys
@@ -8,6 +8,13 @@ sys.path.insert(0, './fetch/')
 from fetch.posts import get_blog_posts
 from fetch.comments import get_comments_from_post
 from fetch.util import get_url_path
+import metrics, tracing, budget
+from log import get_logger, setup_logging, stop_logging
+from pool import POOL
+from config import CONFIG
+from prior import PriorArchive
+import text_content
+import plus_ones
 
 from batch_file import BatchFile
 
@@ -16,12 +23,35 @@ from batch_file import BatchFile
 # sharing state between downloaders is just too hard without global variables
 # they will have to do for now
 
+log = get_logger("downloader")
 
-class PostsDownloader:
 
-	log_cooldown = 0
+class PostQueue:
+	"""
+	Hands out the posts with the most comments first (longest job first), so one huge post
+	picked up last doesn't hold up the whole blog while the other downloaders sit idle.
+	Posts without a known count keep their discovery order after the known ones.
+	"""
+
+	def __init__(self, posts, comment_counts=None):
+		self.comment_counts = comment_counts or {}
+		self.order = itertools.count()
+		self.heap = []
+		for post in posts:
+			self.append(post)
+
+	def append(self, url):
+		heapq.heappush(self.heap, (-(self.comment_counts.get(url) or 0), next(self.order), url))
+
+	def pop(self):
+		return heapq.heappop(self.heap)[2]
+
+	def __len__(self):
+		return len(self.heap)
 
-	def __init__(self, blog_posts, batch_file, exclude_limit, starting_post=0, downloader_count=10, graceful_killer=None):
+class PostsDownloader:
+
+	def __init__(self, blog_posts, batch_file, exclude_limit, starting_post=0, downloader_count=None, graceful_killer=None, pool=POOL, prior_archive=None, archive_index=None, skip_unchanged=False, comment_counts=None, on_tail=None):
 		self.blog_posts = blog_posts
 		self.batch_file = batch_file
 
@@ -30,7 +60,8 @@ class PostsDownloader:
 
 		self.exclude_limit = exclude_limit
 		self.starting_post = starting_post
-		self.downloader_count = downloader_count
+		# config.CONFIG.downloader_count when not given, read for every blog so a reload applies to the next one
+		self.downloader_count = downloader_count or CONFIG.downloader_count
 
 		self.time_start = perf_counter()
 
@@ -43,15 +74,29 @@ class PostsDownloader:
 		self.downloader_tasks = []
 
 		self.restarting_session = False
-
-		self.session_headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36"}
-		self.session_timeout = aiohttp.ClientTimeout(total=20)
-		self.session_connector = aiohttp.TCPConnector(limit=30)
-		self.session = aiohttp.ClientSession(connector=self.session_connector, headers=self.session_headers, timeout=self.session_timeout, connector_owner=False)
-
-		self.queue = []
-		for post in self.blog_posts[self.starting_post:]:
-			self.queue.append(post)
+		# pool.rotations when the downloaders were told to pause
+		self.paused_at_rotation = None
+
+		# set to the budget that ran out ("blog seconds", "batch requests"...) if the blog was cut short
+		self.budget_exceeded = None
+
+		# the pool outlives the downloader, its connections are reused by the next blog
+		self.pool = pool
+		self.session = pool.get_session()
+
+		# comments archived by an earlier run, only new comments are fetched for these posts
+		self.prior_archive = prior_archive
+		# local record of archived posts (archive_index.py), skip_unchanged stops after the first page
+		# of posts whose comment total is the same as when they were last archived
+		self.archive_index = archive_index
+		self.skip_unchanged = skip_unchanged
+		# {post_url: comment count from the blog's feed}, posts with 0 are written without any requests
+		self.comment_counts = comment_counts or {}
+		# called once every post has been handed out and only the last ones are still downloading,
+		# worker.py starts discovering the next blog of the batch then
+		self.on_tail = on_tail
+
+		self.queue = PostQueue(self.blog_posts[self.starting_post:], self.comment_counts)
 
 		for i in range(self.downloader_count):
 			prefix = "0" if i < 10 else ""
@@ -61,11 +106,14 @@ class PostsDownloader:
 
 	async def start(self):
 		t0 = perf_counter()
-		await asyncio.gather(*self.downloader_tasks)
+		try:
+			with tracing.span("blog", file=self.batch_file.file_name, posts=len(self.blog_posts)):
+				await asyncio.gather(*self.downloader_tasks)
+		finally:
+			# lets the pool close the session if it was retired by a config change during the blog
+			await self.pool.release(self.session)
 		duration = perf_counter() - t0
-		print("Saved %s posts in %s seconds" % (self.posts_finished, format(duration, '.2f')))
-		await self.session.close()
-		await self.session_connector.close()
+		log.info("Saved %s posts in %s seconds", self.posts_finished, format(duration, '.2f'))
 
 	async def downloader(self, name, batch_file, queue):
 
@@ -74,23 +122,34 @@ class PostsDownloader:
 		paused = False
 
 		while len(queue) > 0:
+			budget_exceeded = budget.exceeded()
+			if budget_exceeded:
+				if not self.budget_exceeded:
+					self.budget_exceeded = budget_exceeded
+					metrics.BUDGETS_EXCEEDED.inc(budget_exceeded)
+					log.warning("%s | %s budget used up, stopping with %s posts left", name, budget_exceeded, len(queue))
+				break
 			if not self.downloaders_should_pause and (self.starting_post + self.posts_finished < len(self.blog_posts)):
 				url = queue.pop()
+				if len(queue) == 0:
+					self.start_tail()
 				try:
 					if paused:
 						paused = False
 						self.downloaders_paused -= 1
-						print(f"{name} | Resuming from rate limit pause")
-						self.print_downloader_status(name)
+						log.info("%s | Resuming from rate limit pause", name)
+						self.log_downloader_status(name)
 					await self.download_post(name, url)
 					worker_posts_downloaded += 1
 				except (json.decoder.JSONDecodeError,ValueError) as e:
 					try:
-						print(f"{name} | Pause reason: {traceback.format_exc()}")
-						print(f"{name} | Paused due to rate limit")
-						self.print_downloader_status(name)
+						log.debug("%s | Pause reason", name, exc_info=True)
+						log.warning("%s | Paused due to rate limit (%r)", name, e)
+						self.log_downloader_status(name)
 						if not self.downloaders_should_pause:
 							self.downloaders_should_pause = True
+							self.paused_at_rotation = self.pool.rotations
+							metrics.RATE_LIMIT_PAUSES.inc()
 						# Add the url back to the queue for another task do pick up
 						self.requeue_url(name, url)
 					except Exception as e:
@@ -104,30 +163,56 @@ class PostsDownloader:
 					paused = True
 					self.downloaders_paused += 1
 				else:
-					print(f"{name} | Waiting for all downloaders to pause")
-					self.print_downloader_status(name)
+					log.info("%s | Waiting for all downloaders to pause", name)
+					self.log_downloader_status(name)
 
 				if not self.restarting_session and self.downloaders_should_pause and self.downloaders_paused >= (self.downloader_count - self.downloaders_finished):
 					self.restarting_session = True
 					# sleep for a bit so we don't resume right after hitting the captcha page
 					await asyncio.sleep(1)
-					print("All downloaders paused, restarting session")
-					self.print_downloader_status(name)
-					await self.session.close()
-					self.session = aiohttp.ClientSession(connector=self.session_connector, headers=self.session_headers, timeout=self.session_timeout, connector_owner=False)
+					log.warning("All downloaders paused, rotating session identity")
+					self.log_downloader_status(name)
+					self.pool.rotate_identity(self.paused_at_rotation)
+					session = self.pool.get_session()
+					await self.pool.release(self.session)
+					self.session = session
 					self.downloaders_should_pause = False
 					self.restarting_session = False
 
+		self.start_tail()
 		self.downloaders_finished += 1
-		print(f"{name} DONE | Posts Downloaded: {worker_posts_downloaded}")
-		self.print_downloader_status(name)
+		log.info("%s DONE | Posts Downloaded: %s", name, worker_posts_downloaded)
+		self.log_downloader_status(name)
 
 	async def download_post(self, name, url):
+		if self.comment_counts.get(url) == 0:
+			self.batch_file.add_blog_post(url, [], self.posts_finished == 0)
+			if self.archive_index:
+				self.archive_index.stage(self.batch_file.batch_id, self.batch_file.blog_name, url, 0, self.batch_file.file_name)
+			metrics.POSTS.inc()
+			metrics.EMPTY_POSTS_SKIPPED.inc()
+			self.posts_finished += 1
+			return
+
 		try:
-			comments = await get_comments_from_post(url, self.session, get_all_pages=True, get_replies=True, get_comment_plus_ones=True, get_reply_plus_ones=True)
+			with tracing.span("post", url=url):
+				prior = self.prior_archive.get(url) if self.prior_archive else None
+				archived = None
+				if self.archive_index and self.skip_unchanged:
+					archived = self.archive_index.get(self.batch_file.blog_name, url)
+				post_info = {}
+				comments = await get_comments_from_post(url, self.session, get_all_pages=True, get_replies=True, get_comment_plus_ones=True, get_reply_plus_ones=True, prior=prior, known_total=archived["comment_count"] if archived else None, post_info=post_info)
 
 			first_post = self.posts_finished == 0
-			self.batch_file.add_blog_post(url, comments, first_post)
+			if comments is None:
+				self.batch_file.add_blog_post(url, None, first_post, unchanged_since=archived["location"])
+			else:
+				with tracing.span("serialization", url=url, comments=len(comments)):
+					self.batch_file.add_blog_post(url, comments, first_post, archived_comment_ids=post_info.get("archived_comment_ids"))
+				metrics.COMMENTS.inc(amount=len(comments))
+				if self.archive_index:
+					self.archive_index.stage(self.batch_file.batch_id, self.batch_file.blog_name, url, post_info["total_comments"], self.batch_file.file_name)
+			metrics.POSTS.inc()
 
 			# include a random string to prevent file name collisions
 			# random_chars = "".join(random.choices(chars, k=7))
@@ -135,13 +220,8 @@ class PostsDownloader:
 			# with open(file_path, "w") as file:
 			# 	file.write(json.dumps({"url": url, "comments": comments}))
 
-			total_time = perf_counter() - self.time_start
-			if PostsDownloader.log_cooldown >= 20 or self.downloaders_should_pause or self.restarting_session:
-				self.print_downloader_progress(name, total_time)
-				self.print_downloader_status(name)
-				PostsDownloader.log_cooldown = 0
-			else:
-				PostsDownloader.log_cooldown += 1
+			# rate limited by the log pipeline
+			self.log_downloader_progress(name, perf_counter() - self.time_start)
 			self.posts_finished += 1
 		except (
 				asyncio.TimeoutError,
@@ -151,24 +231,35 @@ class PostsDownloader:
 				TypeError
 			) as e:
 
-			print(f"{name} | Retry reason: {traceback.format_exc()}")
-
-			print(f"{name} | {self.batch_file.file_name} | An error occurred during the request, requeuing post in 5 seconds")
+			log.debug("%s | Retry reason", name, exc_info=True)
+			log.warning("%s | %s | An error occurred during the request (%r), requeuing post in 5 seconds", name, self.batch_file.file_name, e)
+			metrics.RETRIES.inc(type(e).__name__)
 			await asyncio.sleep(5)
 			self.requeue_url(name, url)
 
+	def add_posts(self, posts):
+		"""Hands out more posts to the downloaders still running, shards.py adds a shard this way from on_tail"""
+		self.blog_posts = self.blog_posts + posts
+		for url in posts:
+			self.queue.append(url)
+
+	def start_tail(self):
+		if self.on_tail:
+			on_tail, self.on_tail = self.on_tail, None
+			on_tail()
+
 	def requeue_url(self, name, url):
-		print(f"{name} | Requeuing post: \'{get_url_path(url)}\'")
+		log.info("%s | Requeuing post: '%s'", name, get_url_path(url))
 		self.queue.append(url)
 
-	def print_downloader_progress(self, name, total_time):
-		print(f"{name} | [PROGRESS] {self.batch_file.file_name} | Post {self.starting_post + self.posts_finished + 1}/{len(self.blog_posts)} | Total time running: {format(total_time, '.2f')}s")
+	def log_downloader_progress(self, name, total_time):
+		log.info("%s | [PROGRESS] %s | Post %s/%s | Total time running: %ss", name, self.batch_file.file_name, self.starting_post + self.posts_finished + 1, len(self.blog_posts), format(total_time, '.2f'))
 
-	def print_downloader_status(self, name):
-		print(f"{name} | downloaders_paused: {self.downloaders_paused} downloaders_finished: {self.downloaders_finished}\n")
+	def log_downloader_status(self, name):
+		log.info("%s | downloaders_paused: %s downloaders_finished: %s\n", name, self.downloaders_paused, self.downloaders_finished)
 
 
-async def main():
+async def main(profile=False, prior_path=None):
 
 	# logging.basicConfig(format="%(message)s", level=logging.INFO)
 	#
@@ -187,10 +278,13 @@ async def main():
 		print(blog_posts)
 		# blog_posts_2 = json.loads(file.read())
 
-		batch_file.start_blog(1, "googleblog", "googleblog.blogspot.com", "a", True)
-		dl = PostsDownloader(blog_posts, batch_file, 450)
-		await dl.start()
-		batch_file.end_blog()
+		with tracing.BatchProfiler("downloader-120312") if profile else contextlib.nullcontext():
+			batch_file.start_blog(1, "googleblog", "googleblog.blogspot.com", "a", True)
+			prior_archive = PriorArchive.load(prior_path) if prior_path else None
+			dl = PostsDownloader(blog_posts, batch_file, 450, prior_archive=prior_archive)
+			await dl.start()
+			batch_file.end_blog()
+		await POOL.close()
 
 		# batch_file.start_blog(1, "clean", "clean.blogspot.com", "a", False)
 		# await download_blog(blog_posts_2, batch_file, __exclude_limit=450, __starting_post=3300)
@@ -209,4 +303,17 @@ async def main():
 
 
 if __name__ == '__main__':
-	asyncio.run(main())
\ No newline at end of file
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--profile", action="store_true", help="save a cProfile dump and a Chrome trace of the run to ../profiles/")
+	parser.add_argument("--prior", help="a previous batch .json.gz or comment index to re-archive incrementally against")
+	parser.add_argument("--max-plus-ones", type=int, help="request at most this many +1 profiles per comment or reply, larger lists are marked plus_ones_capped")
+	parser.add_argument("--text", choices=text_content.TEXT_FORMATS, default="raw", help="store comment text as Google's raw arrays, decoded plain text with link spans, or both")
+	args = parser.parse_args()
+	text_content.TEXT_FORMAT = args.text
+	plus_ones.MAX_PLUS_ONES = args.max_plus_ones
+	CONFIG.load()
+	setup_logging()
+	try:
+		asyncio.run(main(args.profile, args.prior))
+	finally:
+		stop_logging()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import contextvars
+
+from contextlib import contextmanager
+from time import perf_counter
+
+# Limits on how long a blog or a batch may run, how many requests it may make and how many
+# response bytes it may download. Like tracing, the budgets in force are kept in a context
+# variable, so every request made by the tasks of a blog is charged to that blog and its batch.
+# Budgets are only checked between posts, a post that was started is always finished.
+
+current_budgets = contextvars.ContextVar("current_budgets", default=())
+
+LIMIT_NAMES = ("seconds", "requests", "bytes")
+UNITS = {"k": 1000, "m": 1000 ** 2, "g": 1000 ** 3}
+
+
+class Budget:
+    def __init__(self, scope, seconds=None, requests=None, bytes=None):
+        self.scope = scope
+        self.limits = {"seconds": seconds, "requests": requests, "bytes": bytes}
+        self.started = perf_counter()
+        self.requests = 0
+        self.bytes = 0
+
+    def charge(self, body_length):
+        self.requests += 1
+        self.bytes += body_length
+
+    def used(self):
+        return {"seconds": perf_counter() - self.started, "requests": self.requests, "bytes": self.bytes}
+
+    def exceeded(self):
+        """Returns the name of the first limit that was reached, or None"""
+        used = self.used()
+        for name in LIMIT_NAMES:
+            limit = self.limits[name]
+            if limit is not None and used[name] >= limit:
+                return name
+
+
+class SharedBudget(Budget):
+    """
+    A Budget whose requests and bytes are counted in a shared multiprocessing Array of [requests, bytes],
+    so all the processes of a sharded blog (shards.py) use up the same budget
+    """
+
+    def __init__(self, scope, counts, seconds=None, requests=None, bytes=None):
+        super().__init__(scope, seconds, requests, bytes)
+        self.counts = counts
+
+    def charge(self, body_length):
+        with self.counts.get_lock():
+            self.counts[0] += 1
+            self.counts[1] += body_length
+
+    def used(self):
+        return {"seconds": perf_counter() - self.started, "requests": self.counts[0], "bytes": self.counts[1]}
+
+
+def parse_budget(spec):
+    """'seconds=3600,requests=50000,bytes=2g' -> {"seconds": 3600, "requests": 50000, "bytes": 2000000000}"""
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition("=")
+        name = name.strip()
+        value = value.strip().lower()
+        if name not in LIMIT_NAMES:
+            raise ValueError(f"Unknown budget limit: '{name}' (expected one of {', '.join(LIMIT_NAMES)})")
+        multiplier = UNITS.get(value[-1:], 1)
+        if value[-1:] in UNITS:
+            value = value[:-1]
+        limits[name] = float(value) * multiplier if name == "seconds" else int(float(value) * multiplier)
+    return limits
+
+
+@contextmanager
+def track(budget):
+    """Charges every request made in this context (and the tasks created in it) to budget as well"""
+    token = current_budgets.set(current_budgets.get() + (budget,))
+    try:
+        yield budget
+    finally:
+        current_budgets.reset(token)
+
+
+def charge(body_length):
+    for budget in current_budgets.get():
+        budget.charge(body_length)
+
+
+def exceeded():
+    """Returns "scope limit" for the first budget in force that was used up, or None"""
+    for budget in current_budgets.get():
+        limit = budget.exceeded()
+        if limit:
+            return f"{budget.scope} {limit}"
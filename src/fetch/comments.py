@@ -1,13 +1,22 @@
 import re, json, logging
 import asyncio, aiohttp
 
+from collections import deque
 from time import sleep, perf_counter
 
-from util import remove_xssi_guard, get_url_path
+from util import remove_xssi_guard, get_url_path, route
+import metrics, tracing
+from log import get_logger
 from replies import get_replies_from_comment_id
-from plus_ones import get_plus_ones_from_id
+from plus_ones import get_plus_ones_from_id, is_capped
+from prior import reuse_replies, reuse_plus_ones, prior_replies_by_id
+from text_content import set_text
+from request_bodies import more_comments_body, FORM_HEADERS
 
-import time
+log = get_logger("comments")
+
+# pages whose replies and +1s can be fetched at the same time
+MAX_PAGES_PROCESSING = 4
 
 blogger_object_pattern = re.compile(r'data:(\["os\.blogger",[\s\S]*?)}\);</script>')
 
@@ -37,6 +46,9 @@ def get_comments_from_blogger_object(blogger_object):
 
     return comment_list
 
+# The keys get_info_from_comment can set, in order
+COMMENT_FIELDS = ("id", "type", "reply_count", "date_posted", "domain", "user_name", "user_id", "user_avatar", "user_profile", "plus_one_id", "plus_one_count", "text", "text_plain", "text_spans", "language_code", "language_display", "share_string")
+
 def get_info_from_comment(comment, return_info_list=False):
     comment_type = comment[5][0]
 
@@ -73,7 +85,7 @@ def get_info_from_comment(comment, return_info_list=False):
         results["plus_one_id"] = likes_object[0] or None
         results["plus_one_count"] = likes_object[16] or 0
 
-    results["text"] = info_list[137] if info_list[137] else None
+    set_text(results, info_list[137])
 
     language_object = info_list[141]
     if language_object and len(language_object) == 3:
@@ -89,8 +101,11 @@ def get_info_from_comment(comment, return_info_list=False):
 
 async def fetch_initial_page(post_url, session):
     params = {"first_party_property": "BLOGGER", "query": post_url}
-    async with session.get("https://apis.google.com/u/0/_/widget/render/comments", params=params) as response:
+    started = perf_counter()
+    async with session.get(route("https://apis.google.com/u/0/_/widget/render/comments"), params=params) as response:
+        body = await response.read()
         text = await response.text()
+        metrics.observe_request("widget", started, response.status, len(body))
         return (text, response.status,response.request_info.url)
 
 async def fetch_initial_page_retry(post_url, session):
@@ -101,24 +116,31 @@ async def fetch_initial_page_retry(post_url, session):
         tries += 1
         fetch_response = await fetch_initial_page(post_url, session)
         if (tries>1):
-            print(f"fetch_response[1] {fetch_response[1]} try {tries} url {post_url}")
+            metrics.RETRIES.inc("widget_404")
+            log.info("fetch_response[1] %s try %s url %s", fetch_response[1], tries, post_url)
         if (tries>4):
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
         if fetch_response[1]!=404 or tries>max_tries:
             return fetch_response
 
 async def fetch_more_comments(continuation_key, post_url, session):
-    data = {"f.req": f'[[null,[[null,null,null,null,2]],[1,[20,\"{continuation_key}\"],null,[[[2,[null,\"\"]]]],true],[100]],[[\"{post_url}\",null,null,null,0,null,\"{post_url}\",null,null,1,[20,null,null,1,null,null,null,1,null,\"fntn\",0,9,0,[\"{post_url}\"],null,null,0],null,null,null,null,1,null,null,null,null,0,null,null,3,1,\"ADSJ_i2qch7-NelDrYpMAgUEL3IyfvpRaOpIlNdE_bvIQ75NJOZBrBOcjySzgO6TLTwV505qclfGXYIJhMfE5caBt_gnFo0oJQMYepGtofNznk9sXjdUpWpbuvR9fVGZg5UE5s63b2jaYidM-u0YJobnkro9YS07tqwxEfgTeBOKzWrTTOVchhsesdkGf_5Bt2nIVwQX-CBt0dMjHSlQOVRDK8lDWMDDmByx31C9iLDhEhuG6dr0IdYCDriTB8orFKbx4AJztSfIqaJgpDhjauRnxyGTfIeDCF615Dhc5oQRNWv5DC3lk0Tdz76D42zH768dAYF1_pyJLZX8CdvH9V2MlBc6bvnCJdZWmHaWi1U17imK\",20,null,null,[null,null,0,0,0],1,0,null,0],\"{post_url}\",\"{post_url}\",[20,null,null,1,null,null,null,1,null,\"fntn\",0,9,0,[\"{post_url}\"],null,null,0],0,\"\"]]'}
+    data = more_comments_body(post_url).render(continuation_key=continuation_key)
 
-    async with session.post("https://apis.google.com/wm/1/_/sw/bs", data=data) as response:
+    started = perf_counter()
+    async with session.post(route("https://apis.google.com/wm/1/_/sw/bs"), data=data, headers=FORM_HEADERS) as response:
+        body = await response.read()
         text = await response.text()
+        metrics.observe_request("sw/bs", started, response.status, len(body))
 
+        started = perf_counter()
         response_string = remove_xssi_guard(text)
         blogger_object = json.loads(response_string)[0]
 
-        return {"comments": get_comments_from_blogger_object(blogger_object), "continuation_key": extract_continuation_key(blogger_object)}
+        results = {"comments": get_comments_from_blogger_object(blogger_object), "continuation_key": extract_continuation_key(blogger_object)}
+        metrics.observe_parse("sw/bs", started)
+        return results
 
-async def process_comments(comments, session, post_url=None, get_replies=False, get_comment_plus_ones=False, get_reply_plus_ones=False):
+async def process_comments(comments, session, post_url=None, get_replies=False, get_comment_plus_ones=False, get_reply_plus_ones=False, prior=None):
     # There's probably a way to avoid creating two loops here
     # but I'm not experienced enough with asyncio to figure it out
 
@@ -128,19 +150,24 @@ async def process_comments(comments, session, post_url=None, get_replies=False,
 
     # Initial loop to start all of the tasks in parallel
     for comment in comments:
-        if get_replies and comment["reply_count"] > 0:
+        # Replies and +1s whose count hasn't changed since the prior archive are copied from it
+        prior_comment = prior.get(comment["id"]) if prior else None
+
+        if get_replies and comment["reply_count"] > 0 and not reuse_replies(comment, prior_comment):
             # This probably isn't the python way of doing async, but it works fine for now
-            reply_task = asyncio.create_task(get_replies_from_comment_id(comment["id"], post_url, session))
+            reply_task = asyncio.create_task(get_replies_from_comment_id(comment["id"], post_url, session, comment["reply_count"]))
             reply_task.comment = comment
+            reply_task.prior_replies = prior_replies_by_id(prior_comment)
             reply_tasks[comment["id"]] = reply_task
 
-        if get_comment_plus_ones and "plus_one_id" in comment and "plus_one_count" in comment and comment["plus_one_count"] > 0:
+        if get_comment_plus_ones and "plus_one_id" in comment and "plus_one_count" in comment and comment["plus_one_count"] > 0 and not reuse_plus_ones(comment, prior_comment):
             plus_one_task = asyncio.create_task(get_plus_ones_from_id(comment["plus_one_id"], comment["plus_one_count"], session))
             plus_one_task.comment = comment
             plus_one_tasks[comment["id"]] = plus_one_task
 
     if get_replies:
-        await asyncio.gather(*list(reply_tasks.values()))
+        with tracing.span("reply fan-out", comments=len(reply_tasks)):
+            await asyncio.gather(*list(reply_tasks.values()))
         # Loop to assign the replies to their respective comments
         if get_reply_plus_ones:
             for key, value in reply_tasks.items():
@@ -148,7 +175,7 @@ async def process_comments(comments, session, post_url=None, get_replies=False,
                 value.comment["replies"] = replies
                 if get_reply_plus_ones:
                     for reply in replies:
-                        if reply["plus_one_id"] and reply["plus_one_count"] > 0:
+                        if reply["plus_one_id"] and reply["plus_one_count"] > 0 and not reuse_plus_ones(reply, value.prior_replies.get(reply["id"])):
                             reply_plus_one_task = asyncio.create_task(get_plus_ones_from_id(reply["plus_one_id"], reply["plus_one_count"], session))
                             reply_plus_one_task.reply = reply
                             reply_plus_one_tasks[reply["id"]] = reply_plus_one_task
@@ -157,17 +184,25 @@ async def process_comments(comments, session, post_url=None, get_replies=False,
                 value.comment["replies"] = list(value.result())
 
     if get_comment_plus_ones:
-        await asyncio.gather(*list(plus_one_tasks.values()))
+        with tracing.span("plus-one fan-out", comments=len(plus_one_tasks)):
+            await asyncio.gather(*list(plus_one_tasks.values()))
 
         for key, value in plus_one_tasks.items():
             value.comment["plus_ones"] = list(value.result())
+            if is_capped(value.comment):
+                value.comment["plus_ones_capped"] = True
 
     if get_reply_plus_ones:
-        await asyncio.gather(*list(reply_plus_one_tasks.values()))
+        with tracing.span("plus-one fan-out", replies=len(reply_plus_one_tasks)):
+            await asyncio.gather(*list(reply_plus_one_tasks.values()))
         for key, value in reply_plus_one_tasks.items():
             value.reply["plus_ones"] = list(value.result())
+            if is_capped(value.reply):
+                value.reply["plus_ones_capped"] = True
 
-# Retrieves comments and replies
+# Retrieves comments and replies, yielding them a page at a time (a list of comments per page)
+# as soon as each page's replies and +1s are in. At most MAX_PAGES_PROCESSING pages are fetched
+# ahead of the consumer, so a slow consumer holds back pagination instead of piling up pages.
 # get_all_pages
 #   - Use the continuation key to get all pages of comments (20 comments per page)
 #   - The amount of additional network requests is (amount of comments / 20) (excluding replies)
@@ -178,44 +213,130 @@ async def process_comments(comments, session, post_url=None, get_replies=False,
 #   - Retrieve a list of all the authors that +1'd each comment
 #   - An additional network request is made for each comment and reply that has >1 plus_ones
 # session - To reuse an existing aiohttp.ClientSession object (performance improvement)
-async def get_comments_from_post(post_url, session, get_all_pages=True, get_replies=False, get_comment_plus_ones=False, get_reply_plus_ones=False):
+# prior
+#   - {comment_id: comment} already archived for this post (see prior.py)
+#   - Pagination stops once every comment is either fetched or in prior, the rest are yielded from prior
+#   - Replies and +1s are only fetched for comments whose counts changed
+# known_total
+#   - The comment total recorded when the post was last archived, nothing is yielded if it hasn't changed
+# post_info
+#   - An optional dict that gets the post's "total_comments", and "unchanged" when it matched known_total.
+#     "archived_comment_ids" lists the comments left out because only the compact prior index has them
+async def iter_post_comments(post_url, session, get_all_pages=True, get_replies=False, get_comment_plus_ones=False, get_reply_plus_ones=False, prior=None, known_total=None, post_info=None):
 
-    results = []
     page = 1
+    seen_ids = set()
+    archived_ids = set(prior) if prior else set()
     logging.info(f"- Getting comments for: {post_url}")
 
-    fetch_response = await fetch_initial_page_retry(post_url, session)
+    with tracing.span("widget fetch", url=post_url):
+        fetch_response = await fetch_initial_page_retry(post_url, session)
     logging.info(f"  Received HTML | status: {fetch_response[1]}")
 
     if (fetch_response[1]==404):
         raise  ValueError('Restart session please')
 
-    blogger_object = extract_blogger_object_from_html(fetch_response[0])
-    comments = get_comments_from_blogger_object(blogger_object)
-
-    logging.info("  Total comments: %s" % get_total_comment_count(blogger_object))
+    with tracing.span("extraction", url=post_url):
+        started = perf_counter()
+        blogger_object = extract_blogger_object_from_html(fetch_response[0])
+        comments = get_comments_from_blogger_object(blogger_object)
+        metrics.observe_parse("widget", started)
+
+    total_comments = get_total_comment_count(blogger_object)
+    logging.info("  Total comments: %s" % total_comments)
+    if post_info is not None:
+        post_info["total_comments"] = total_comments
+    if known_total is not None and total_comments == known_total:
+        logging.info("  Unchanged since it was last archived")
+        if post_info is not None:
+            post_info["unchanged"] = True
+        return
     logging.info("  Extracting comments")
     logging.info("    page 1 (%s)" % len(comments))
 
-    # Add the comments from the initial html (first 20)
-    await process_comments(comments, session, post_url, get_replies, get_comment_plus_ones, get_reply_plus_ones)
-    results.extend(comments)
+    # Replies and +1s for a page are fetched while the next page is requested, so a post with
+    # thousands of comments doesn't wait on each page's fan-out before asking for the next one
+    processing = deque()
+
+    def start_processing(comments):
+        task = asyncio.create_task(process_comments(comments, session, post_url, get_replies, get_comment_plus_ones, get_reply_plus_ones, prior))
+        processing.append((task, comments))
+
+    def caught_up():
+        # newer comments come first, so once a whole page is archived the rest of the post is too. It's only
+        # safe to stop if the archived comments not seen yet are exactly what's left of the total, with more
+        # of them some were deleted since and there's no telling which without fetching the rest
+        if not prior:
+            return False
+        page_ids = {comment["id"] for comment in comments}
+        seen_ids.update(page_ids)
+        if not page_ids or not page_ids <= archived_ids:
+            return False
+        return len(seen_ids) + len(archived_ids - seen_ids) == total_comments
+
+    try:
+        # Add the comments from the initial html (first 20)
+        start_processing(comments)
+
+        stopped_early = caught_up()
+        if stopped_early:
+            logging.info("  Caught up with the prior archive after page 1")
+        elif get_all_pages:
+            continuation_key = extract_continuation_key(blogger_object)
+            while True:
+                while len(processing) >= MAX_PAGES_PROCESSING:
+                    task, finished_comments = processing.popleft()
+                    await task
+                    yield finished_comments
+
+                page += 1
+                with tracing.span("pagination", url=post_url, page=page):
+                    next_comments = await fetch_more_comments(continuation_key, post_url, session)
+
+                continuation_key = next_comments["continuation_key"]
+                comments = next_comments["comments"]
+
+                if not len(comments) or not continuation_key: break
+
+                logging.info("    page %s (%s)" % (page, len(comments)))
+                start_processing(comments)
+
+                if caught_up():
+                    stopped_early = True
+                    logging.info("  Caught up with the prior archive after page %s" % page)
+                    break
+
+        while processing:
+            task, finished_comments = processing.popleft()
+            await task
+            yield finished_comments
+    finally:
+        for task, finished_comments in processing:
+            task.cancel()
+
+    if stopped_early:
+        # Stopped early, the remaining comments are the already archived ones. Those from a compact index
+        # are only ids and counts, they're listed on the post instead of being passed off as comments
+        archived_comments = [comment for comment_id, comment in prior.items() if comment_id not in seen_ids and not comment.get("archived")]
+        index_only_ids = [comment_id for comment_id, comment in prior.items() if comment_id not in seen_ids and comment.get("archived")]
+        if index_only_ids and post_info is not None:
+            post_info["archived_comment_ids"] = index_only_ids
+        if archived_comments:
+            yield archived_comments
+    logging.info("  Finished")
 
-    if get_all_pages:
-        continuation_key = extract_continuation_key(blogger_object)
-        while True:
-            page += 1
-            next_comments = await fetch_more_comments(continuation_key, post_url, session)
 
-            continuation_key = next_comments["continuation_key"]
-            comments = next_comments["comments"]
+# Collects everything iter_post_comments yields into one list of comments,
+# None if the post is unchanged since known_total
+async def get_comments_from_post(post_url, session, get_all_pages=True, get_replies=False, get_comment_plus_ones=False, get_reply_plus_ones=False, prior=None, known_total=None, post_info=None):
+    post_info = post_info if post_info is not None else {}
 
-            if not len(comments) or not continuation_key: break
+    results = []
+    async for comments in iter_post_comments(post_url, session, get_all_pages, get_replies, get_comment_plus_ones, get_reply_plus_ones, prior, known_total, post_info):
+        results.extend(comments)
 
-            logging.info("    page %s (%s)" % (page, len(comments)))
-            await process_comments(comments, session, post_url, get_replies, get_comment_plus_ones, get_reply_plus_ones)
-            results.extend(comments)
-    logging.info("  Finished")
+    if post_info.get("unchanged"):
+        return None
     return results
 
 
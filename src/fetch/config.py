@@ -0,0 +1,104 @@
+import json, os
+
+from log import get_logger
+
+# The worker's concurrency and timing knobs. Defaults can be overridden with BLOGSPOT_<NAME> environment
+# variables (e.g. BLOGSPOT_DOWNLOADER_COUNT=6) and then by a json file of {name: value}, given with
+# WORKER_CONFIG=path or worker.py --config. The knobs are read where they're used, so a reload (SIGHUP to
+# re-read the file, or POST /config on the metrics server) applies to the next blog, request or retry
+# without restarting and losing the batches in flight. Knobs that aren't live only apply at startup.
+
+FIELDS = {
+    # name: (type, default, live, description)
+    "downloader_count": (int, 10, True, "posts of a blog downloaded at once, from the next blog"),
+    "connection_limit": (int, 30, True, "connections the pool keeps open at once (TCPConnector limit), from the next blog"),
+    "request_timeout": (float, 20, True, "total seconds a Google request may take, from the next blog"),
+    "feed_page_size": (int, 150, True, "posts asked for per Blogger feed page (150 is the most Blogger returns)"),
+    "batch_sleep": (float, 10, True, "seconds between batches and between tries of a failed batch"),
+    "master_sleep_increment": (float, 30, True, "seconds added to the wait after every failed master request"),
+    "master_sleep_maximum": (float, 180, True, "longest wait between master requests"),
+    "master_sleep_total": (float, 60 * 60 * 18, True, "seconds of waiting for the master before giving up"),
+    "batch_downloader_count": (int, 1, False, "batches downloaded at the same time"),
+}
+
+# upper limits of knobs that can't usefully go above them
+MAXIMUMS = {
+    # Blogger never returns more posts per page, and posts.py takes a page shorter than asked for as the last one
+    "feed_page_size": 150,
+}
+
+log = get_logger("config")
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Config:
+
+    def __init__(self, path=None):
+        self.path = path
+        for name, (kind, default, live, description) in FIELDS.items():
+            setattr(self, name, default)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def parse(self, values, live_only=False):
+        """Checks and converts {name: value}, raises ConfigError for unknown knobs or bad values"""
+        if not isinstance(values, dict):
+            raise ConfigError("Settings must be a json object of {setting: value}")
+        parsed = {}
+        for name, value in values.items():
+            if name not in FIELDS:
+                raise ConfigError(f"Unknown setting: '{name}'")
+            kind, default, live, description = FIELDS[name]
+            if live_only and not live:
+                raise ConfigError(f"'{name}' only applies at startup")
+            try:
+                value = kind(value)
+            except (TypeError, ValueError):
+                raise ConfigError(f"'{name}' must be {'a whole number' if kind is int else 'a number'}, got {value!r}")
+            if value <= 0:
+                raise ConfigError(f"'{name}' must be greater than 0")
+            if name in MAXIMUMS and value > MAXIMUMS[name]:
+                raise ConfigError(f"'{name}' can be at most {MAXIMUMS[name]}")
+            parsed[name] = value
+        return parsed
+
+    def update(self, values, live_only=False):
+        """Applies {name: value} and returns {name: (old, new)} for the knobs that changed"""
+        changes = {}
+        for name, value in self.parse(values, live_only).items():
+            if getattr(self, name) != value:
+                changes[name] = (getattr(self, name), value)
+                setattr(self, name, value)
+        for name, (old, new) in changes.items():
+            log.info("Config changed | %s: %s -> %s", name, old, new)
+        return changes
+
+    def read_file(self):
+        if not self.path:
+            return {}
+        with open(self.path, "r") as file:
+            return json.load(file)
+
+    def load(self, environ=os.environ):
+        values = {name: environ[f"BLOGSPOT_{name.upper()}"] for name in FIELDS if f"BLOGSPOT_{name.upper()}" in environ}
+        values.update(self.parse(self.read_file()))
+        return self.update(values)
+
+    def reload(self):
+        """Reads the config file again and applies its live knobs, a bad file leaves the config as it was"""
+        try:
+            values = self.parse(self.read_file())
+            startup_only = [name for name in values if not FIELDS[name][2]]
+            if startup_only:
+                log.warning("Config reload | ignoring settings that only apply at startup: %s", ", ".join(startup_only))
+            return self.update({name: value for name, value in values.items() if name not in startup_only}, live_only=True)
+        except (OSError, ValueError, ConfigError) as e:
+            log.error("Config reload failed, keeping the current config: %s", e)
+            return {}
+
+
+CONFIG = Config(os.environ.get("WORKER_CONFIG"))
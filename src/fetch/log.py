@@ -0,0 +1,108 @@
+import logging, logging.handlers, os, queue, random, sys, time
+
+# Log records are put on a queue by the event loop and formatted and written to stdout
+# by a background thread, so a slow log pipe (Heroku's log router) can't stall the loop.
+# Each message template (the unformatted msg) is rate limited on its own, so a storm of
+# one kind of message doesn't drown out or slow down everything else.
+
+LOG_FORMAT = "%(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `rate` records per message template every `per` seconds,
+    past that a `sample` fraction of them. Errors are never dropped.
+    """
+
+    def __init__(self, rate=20, per=10.0, sample=0.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.sample = sample
+        # (logger name, msg) -> [window start, records let through, records suppressed]
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or now - window[0] >= self.per:
+            suppressed = window[2] if window else 0
+            window = self.windows[key] = [now, 0, 0]
+            if suppressed:
+                record.suppressed = suppressed
+
+        if window[1] < self.rate or (self.sample and random.random() < self.sample):
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats the message (and traceback) on the calling thread,
+    # leave that to the listener thread instead
+    def prepare(self, record):
+        return record
+
+
+class SuppressedFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed)"
+        return text
+
+
+listener = None
+handler = None
+
+
+def setup_logging(level=None, rate=None, per=None, sample=None):
+    """LOG_LEVEL, LOG_RATE, LOG_RATE_PERIOD and LOG_SAMPLE environment variables are used for anything not passed"""
+    global listener, handler
+    if listener:
+        return listener
+
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    rate = rate if rate is not None else int(os.environ.get("LOG_RATE", 20))
+    per = per if per is not None else float(os.environ.get("LOG_RATE_PERIOD", 10))
+    sample = sample if sample is not None else float(os.environ.get("LOG_SAMPLE", 0))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(SuppressedFormatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue() if hasattr(queue, "SimpleQueue") else queue.Queue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate, per, sample))
+
+    root = logging.getLogger("blogspot")
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    root.propagate = False
+    handler = queue_handler
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+def stop_logging():
+    """Flushes anything still queued"""
+    global listener, handler
+    if listener:
+        listener.stop()
+        listener = None
+        # a later setup_logging adds a new handler, records shouldn't pile up in this one's queue
+        logging.getLogger("blogspot").removeHandler(handler)
+        handler = None
+handler = None
+
+
+def get_logger(name):
+    return logging.getLogger(f"blogspot.{name}")
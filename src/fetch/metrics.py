@@ -0,0 +1,296 @@
+import asyncio, hmac, json, os, time
+
+from bisect import bisect_left
+from time import perf_counter
+
+import budget
+from config import CONFIG, ConfigError
+from log import get_logger
+
+# Counters and histograms are plain dicts keyed by label values, updating one is a dict
+# lookup and an add so they're cheap enough to leave on in the hot paths.
+# Everything runs on the event loop thread, so no locking is needed.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60)
+PARSE_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+log = get_logger("metrics")
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+    def to_dict(self):
+        return {"|".join(map(str, label_values)) or "total": value for label_values, value in self.values.items()}
+
+    def merge(self, values):
+        for label_values, value in values.items():
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def quantile(self, q, *label_values):
+        """Estimates the q quantile from the buckets like Prometheus' histogram_quantile, across all labels if none are given"""
+        if label_values:
+            counts = self.values.get(label_values)
+            if not counts:
+                return None
+        else:
+            counts = [sum(column) for column in zip(*self.values.values())]
+            if not counts:
+                return None
+        total = sum(counts[:-1])
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0
+        for bound, count in zip(self.buckets, counts):
+            if cumulative + count >= rank:
+                return lower + (bound - lower) * ((rank - cumulative) / count if count else 0)
+            cumulative += count
+            lower = bound
+        # in the +Inf bucket, the largest finite bound is the best estimate
+        return self.buckets[-1]
+
+    def to_dict(self):
+        results = {}
+        for label_values, counts in self.values.items():
+            count = sum(counts[:-1])
+            results["|".join(map(str, label_values)) or "total"] = {
+                "count": count,
+                "sum": round(counts[-1], 6),
+                "mean": round(counts[-1] / count, 6) if count else 0
+            }
+        return results
+
+    def merge(self, values):
+        for label_values, counts in values.items():
+            if label_values in self.values:
+                self.values[label_values] = [a + b for a, b in zip(self.values[label_values], counts)]
+            else:
+                self.values[label_values] = list(counts)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.started = time.time()
+
+    def counter(self, name, description, labels=()):
+        metric = Counter(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        """Returns {metric name: values} and starts every metric again from zero, to hand them to another process"""
+        values = {}
+        for metric in self.metrics:
+            values[metric.name] = metric.values
+            metric.values = {}
+        return values
+
+    def merge(self, values):
+        """Adds the values collect() returned in another process"""
+        for metric in self.metrics:
+            metric.merge(values.get(metric.name, {}))
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        uptime = time.time() - self.started
+        results = {"time": round(time.time()), "uptime": round(uptime, 2)}
+        for metric in self.metrics:
+            results[metric.name] = metric.to_dict()
+        results["posts_per_second"] = round(POSTS.get() / uptime, 3) if uptime else 0
+        return results
+
+
+METRICS = Registry()
+
+REQUESTS = METRICS.counter("blogspot_requests_total", "Requests made, by endpoint and status", ("endpoint", "status"))
+REQUEST_LATENCY = METRICS.histogram("blogspot_request_seconds", "Request latency, by endpoint", ("endpoint",))
+RESPONSE_BYTES = METRICS.counter("blogspot_response_bytes_total", "Response body bytes, by endpoint", ("endpoint",))
+PARSE_TIME = METRICS.histogram("blogspot_parse_seconds", "Time spent parsing responses, by endpoint", ("endpoint",), PARSE_BUCKETS)
+RETRIES = METRICS.counter("blogspot_retries_total", "Retried requests and requeued posts, by reason", ("reason",))
+RATE_LIMIT_PAUSES = METRICS.counter("blogspot_rate_limit_pauses_total", "Times the downloaders paused for a rate limit")
+POSTS = METRICS.counter("blogspot_posts_total", "Posts saved")
+COMMENTS = METRICS.counter("blogspot_comments_total", "Comments saved")
+EMPTY_POSTS_SKIPPED = METRICS.counter("blogspot_empty_posts_skipped_total", "Posts written without a request because the feed has no comments for them")
+PLUS_ONES_CAPPED = METRICS.counter("blogspot_plus_ones_capped_total", "+1 lists requested with fewer profiles than the comment has because of --max-plus-ones")
+BUDGETS_EXCEEDED = METRICS.counter("blogspot_budgets_exceeded_total", "Blogs cut short because a blog or batch budget ran out, by budget", ("budget",))
+GZIP_BYTES = METRICS.counter("blogspot_gzip_bytes_total", "Bytes written to batch files", ("kind",))
+
+
+def observe_request(endpoint, started, status, body_length):
+    REQUESTS.inc(endpoint, status)
+    REQUEST_LATENCY.observe(perf_counter() - started, endpoint)
+    RESPONSE_BYTES.inc(endpoint, amount=body_length)
+    budget.charge(body_length)
+
+
+def observe_parse(endpoint, started):
+    PARSE_TIME.observe(perf_counter() - started, endpoint)
+
+
+def memory_rss():
+    """Resident memory in bytes, from /proc on Linux or the peak from getrusage elsewhere"""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_report(previous=None):
+    """Throughput since the previous report, request latency percentiles by endpoint and memory"""
+    now = time.time()
+    report = {
+        "time": round(now),
+        "uptime": round(now - METRICS.started, 2),
+        "posts": POSTS.get(),
+        "comments": COMMENTS.get(),
+        "requests": sum(REQUESTS.values.values()),
+        "rss_bytes": memory_rss(),
+        "latency": {}
+    }
+    if previous:
+        elapsed = now - previous["time"] or 1
+        for name in ("posts", "comments", "requests"):
+            report[f"{name}_per_second"] = round((report[name] - previous[name]) / elapsed, 2)
+    for (endpoint,) in REQUEST_LATENCY.values:
+        report["latency"][endpoint] = {f"p{round(q * 100)}": round(REQUEST_LATENCY.quantile(q, endpoint), 4) for q in (0.5, 0.9, 0.99)}
+    return report
+
+
+async def write_load_report_periodically(path, interval=10):
+    """Appends a load_report every interval seconds to path as json lines"""
+    previous = load_report()
+    while True:
+        await asyncio.sleep(interval)
+        report = load_report(previous)
+        with open(path, "a") as file:
+            file.write(json.dumps(report) + "\n")
+        latency = " ".join(f"{endpoint}: {values['p50']}/{values['p99']}s" for endpoint, values in report["latency"].items())
+        log.info("[load] posts/s: %s | comments/s: %s | requests/s: %s | p50/p99 %s | rss: %s MB", report["posts_per_second"], report["comments_per_second"], report["requests_per_second"], latency, report["rss_bytes"] // 1024 ** 2)
+        previous = report
+
+
+async def dump_json_periodically(path, interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(METRICS.to_dict(), file)
+        os.replace(temp_path, path)
+
+
+# config_token: POST /config is only served with it, as "Authorization: Bearer <token>", since the server
+# listens on every interface
+async def start_metrics_server(port, config_token=None):
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=METRICS.render_prometheus(), content_type="text/plain")
+
+    async def handle_json(request):
+        return web.json_response(METRICS.to_dict())
+
+    # GET shows the worker's config, POST {setting: value} changes its live settings (see config.py)
+    async def handle_config(request):
+        if request.method == "POST":
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {config_token}"):
+                return web.json_response({"error": "Unauthorized"}, status=401)
+            try:
+                CONFIG.update(await request.json(), live_only=True)
+            except (ValueError, ConfigError) as e:
+                return web.json_response({"error": str(e)}, status=400)
+        return web.json_response(CONFIG.to_dict())
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/metrics.json", handle_json)
+    app.router.add_get("/config", handle_config)
+    if config_token:
+        app.router.add_post("/config", handle_config)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", port)
+    await site.start()
+    log.info("Serving metrics on port %s", port)
+    return runner
+
+
+async def start_from_env():
+    """
+    METRICS_PORT serves /metrics, /metrics.json and /config (POST only with METRICS_CONFIG_TOKEN),
+    METRICS_DUMP_PATH writes a json dump every METRICS_DUMP_INTERVAL seconds
+    """
+    tasks = []
+    if os.environ.get("METRICS_PORT"):
+        await start_metrics_server(int(os.environ["METRICS_PORT"]), os.environ.get("METRICS_CONFIG_TOKEN"))
+    if os.environ.get("METRICS_DUMP_PATH"):
+        interval = float(os.environ.get("METRICS_DUMP_INTERVAL", 60))
+        tasks.append(asyncio.create_task(dump_json_periodically(os.environ["METRICS_DUMP_PATH"], interval)))
+    return tasks
@@ -1,14 +1,33 @@
 import json, asyncio, aiohttp
+from time import perf_counter
 
-from util import remove_xssi_guard
+from util import remove_xssi_guard, route
+import metrics
+
+# Set by --max-plus-ones. getpeople has no paging, a comment's +1s come back as one body of up to `num`
+# profiles, so this caps how many are requested for viral comments. Capped comments and replies are
+# marked with "plus_ones_capped" since their "plus_ones" only has the first MAX_PLUS_ONES profiles.
+MAX_PLUS_ONES = None
+
+def get_request_amount(amount):
+    if MAX_PLUS_ONES is not None and amount > MAX_PLUS_ONES:
+        metrics.PLUS_ONES_CAPPED.inc()
+        return MAX_PLUS_ONES
+    return amount
+
+def is_capped(item):
+    return MAX_PLUS_ONES is not None and item.get("plus_one_count", 0) > MAX_PLUS_ONES
 
 # Gets all of the profiles who +1d a given comment
 # plus_one_id - The plus_one_id of the comment
 # amount - The amount of profiles to fetch
 async def fetch_comment_plus_ones(plus_one_id, amount, session):
     headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:65.0) Gecko/20100101 Firefox/65.0"}
-    data = {"plusoneId": plus_one_id, "num": amount}
-    async with session.post("https://apis.google.com/wm/1/_/common/getpeople/", data=data, headers=headers) as response:
+    data = {"plusoneId": plus_one_id, "num": get_request_amount(amount)}
+    started = perf_counter()
+    async with session.post(route("https://apis.google.com/wm/1/_/common/getpeople/"), data=data, headers=headers) as response:
+        body = await response.read()
+        metrics.observe_request("getpeople", started, response.status, len(body))
         text = await response.text()
         return text
 
@@ -19,11 +38,16 @@ def get_raw_plus_one_list(raw_response_text):
     return obj[0][1]
 
 def get_plus_ones_from_raw_response(raw_response_text):
+    started = perf_counter()
     raw_plus_ones = get_raw_plus_one_list(raw_response_text)
+    metrics.observe_parse("getpeople", started)
 
     for plus_one in raw_plus_ones:
         yield get_info_from_plus_one(plus_one)
 
+# The keys get_info_from_plus_one sets, in order
+PLUS_ONE_FIELDS = ("user_name", "user_id", "user_profile", "user_avatar")
+
 def get_info_from_plus_one(plus_one):
     results = {}
 
@@ -38,12 +62,18 @@ async def get_plus_ones_from_id(plus_one_id, amount, session):
     raw_response_text = await fetch_comment_plus_ones(plus_one_id, amount, session)
     return get_plus_ones_from_raw_response(raw_response_text)
 
+# Yields the profiles who +1'd a comment one at a time
+async def iter_plus_ones(plus_one_id, amount, session):
+    raw_response_text = await fetch_comment_plus_ones(plus_one_id, amount, session)
+    for plus_one in get_plus_ones_from_raw_response(raw_response_text):
+        yield plus_one
+
 async def test_plus_ones():
     async with aiohttp.ClientSession() as session:
         plus_one_id = "4/jcsn4g3bahvbkw3padqrcvlmg5mn0h33gloaovvdj1mqmy3aj5xaowvja1pk/"
 
-        for plus_one in await get_plus_ones_from_id("4/jcsn4g3bahvbkw3padqrcvlmg5mn0h33gloaovvdj1mqmy3aj5xaowvja1pk/", 112, session):
-            print(plus_one)
+        plus_ones = await get_plus_ones_from_id(plus_one_id, 112, session)
+        print(json.dumps(plus_ones, indent=4))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import aiohttp
+
+import metrics
+from config import CONFIG
+
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/72.0.3626.121 Safari/537.36"}
+
+CONNECTIONS = metrics.METRICS.counter("blogspot_connections_total", "Pooled connections, by event (new connections pay a TCP/TLS handshake)", ("event",))
+DNS_LOOKUPS = metrics.METRICS.counter("blogspot_dns_lookups_total", "Host resolutions, by cache result", ("result",))
+IDENTITY_ROTATIONS = metrics.METRICS.counter("blogspot_identity_rotations_total", "Times the session cookies were dropped after a rate limit")
+
+
+async def on_connection_create_end(session, context, params):
+    CONNECTIONS.inc("new")
+
+async def on_connection_reuseconn(session, context, params):
+    CONNECTIONS.inc("reused")
+
+async def on_dns_cache_hit(session, context, params):
+    DNS_LOOKUPS.inc("hit")
+
+async def on_dns_cache_miss(session, context, params):
+    DNS_LOOKUPS.inc("miss")
+
+
+class SessionPool:
+    """
+    One long lived connector and session shared by every blog and batch, so warm
+    keep-alive connections to apis.google.com survive from one blog to the next.
+    aiohttp only speaks HTTP/1.1, keep-alive and the dns cache are what saves the handshakes.
+    limit and timeout default to config.CONFIG's connection_limit and request_timeout.
+    """
+
+    def __init__(self, limit=None, timeout=None, keepalive_timeout=60, dns_ttl=300, headers=DEFAULT_HEADERS):
+        self.limit = limit
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.headers = headers
+
+        self.connector = None
+        self.session = None
+        # sessions and connectors replaced after the config changed, closed once no blog uses them anymore
+        self.retired_sessions = []
+        self.retired_connectors = []
+        # {session: number of downloaders using it}, counted by get_session and release
+        self.users = {}
+        # identity rotations so far, downloaders note it when they pause (see rotate_identity)
+        self.rotations = 0
+
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_connection_create_end.append(on_connection_create_end)
+        self.trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        self.trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        self.trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+
+    def get_session(self):
+        limit = self.limit or CONFIG.connection_limit
+        timeout = self.timeout or CONFIG.request_timeout
+        if self.connector is not None and not self.connector.closed and self.connector.limit != limit:
+            self.retire(connector=True)
+        elif self.session is not None and not self.session.closed and self.session.timeout.total != timeout:
+            self.retire(connector=False)
+
+        # created lazily since the connector has to be made inside the running event loop
+        if self.session is None or self.session.closed:
+            if self.connector is None or self.connector.closed:
+                self.connector = aiohttp.TCPConnector(
+                    limit=limit,
+                    ttl_dns_cache=self.dns_ttl,
+                    keepalive_timeout=self.keepalive_timeout,
+                    enable_cleanup_closed=True
+                )
+            self.session = aiohttp.ClientSession(
+                connector=self.connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                trace_configs=[self.trace_config],
+                connector_owner=False
+            )
+        self.users[self.session] = self.users.get(self.session, 0) + 1
+        return self.session
+
+    async def release(self, session):
+        """Called by every user of get_session when it's done with the session, at the end of a blog"""
+        self.users[session] -= 1
+        if self.users[session] == 0:
+            del self.users[session]
+        await self.close_retired()
+
+    def retire(self, connector):
+        # a new session (and connector) is made for the next blog, the old ones are closed by close_retired
+        # once the blogs still using them are done
+        self.retired_sessions.append(self.session)
+        self.session = None
+        if connector:
+            self.retired_connectors.append(self.connector)
+            self.connector = None
+
+    async def close_retired(self):
+        for session in [session for session in self.retired_sessions if session not in self.users]:
+            self.retired_sessions.remove(session)
+            await session.close()
+        # a connector can outlive several sessions retired for a timeout change
+        for connector in [connector for connector in self.retired_connectors if not any(session.connector is connector for session in self.retired_sessions)]:
+            self.retired_connectors.remove(connector)
+            await connector.close()
+
+    def rotate_identity(self, paused_at=None):
+        # Drops the cookies Google tied to the rate limit without closing any connections.
+        # paused_at: self.rotations when the caller paused. Blogs downloaded in parallel share the cookies,
+        # if another blog already rotated them since then they're fresh and aren't dropped again.
+        if self.session is not None and (paused_at is None or paused_at == self.rotations):
+            self.session.cookie_jar.clear()
+            self.rotations += 1
+            IDENTITY_ROTATIONS.inc()
+
+    async def close(self):
+        self.users = {}
+        await self.close_retired()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.connector is not None:
+            await self.connector.close()
+            self.connector = None
+
+
+POOL = SessionPool()
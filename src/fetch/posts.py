@@ -1,4 +1,12 @@
 import asyncio, aiohttp, json
+from time import perf_counter
+
+import metrics
+from util import route
+from config import CONFIG
+from log import get_logger
+
+log = get_logger("posts")
 
 class MarkExclusion(Exception):
     pass
@@ -7,7 +15,9 @@ class NoEntries(Exception):
     pass
 
 
-async def get_blog_posts(blog, exclusion_limit, session):
+# comment_counts - An optional list that gets each post's comment count from the feed (thr$total),
+#   in the same order as the returned urls, None where the feed doesn't have one
+async def get_blog_posts(blog, exclusion_limit, session, comment_counts=None):
     json_loads = json.loads
     # Create a new request session so we can reuse for following requests
     # Results in much faster requests
@@ -17,24 +27,32 @@ async def get_blog_posts(blog, exclusion_limit, session):
     post_urls = []
     post_urls_extend = post_urls.extend
     complete = False
+    # read once per blog, a reload mid blog would break the paging
+    page_size = CONFIG.feed_page_size
     while not complete:
-        index = (posts_index * 150) + 1
+        index = (posts_index * page_size) + 1
 
         if exclusion_limit and index > exclusion_limit:
             raise MarkExclusion(f"Blog has greater than {exclusion_limit} posts")
 
         #Can only get 150 blog posts returned even if a higher number is specified
-        url = blog + '/feeds/posts/default?max-results=150&alt=json&start-index=' + str(index)
+        url = blog + '/feeds/posts/default?max-results=' + str(page_size) + '&alt=json&start-index=' + str(index)
         request_info = None
         for dl_try in range(3):
             try:
-                print(f"try {dl_try + 1} | Getting posts from feed: " + url)
-                request_info = await session_get(url)
+                log.info("try %s | Getting posts from feed: %s", dl_try + 1, url)
+                started = perf_counter()
+                request_info = await session_get(route(url))
+                # gzip and chunked feed pages have no Content-Length, the body is read (and kept for text()) to count it
+                body = await request_info.read()
+                metrics.observe_request("feed", started, request_info.status, len(body))
                 if request_info.status == 200:
                     break
                 else:
+                    metrics.RETRIES.inc("feed")
                     await asyncio.sleep(2)
             except:
+                metrics.RETRIES.inc("feed")
                 await asyncio.sleep(2)
 
         # Check if the blog exists and is accessible
@@ -51,15 +69,19 @@ async def get_blog_posts(blog, exclusion_limit, session):
 
             feed_json = None
             try:
+                started = perf_counter()
                 feed_json = json_loads(text)
+                metrics.observe_parse("feed", started)
             except json.decoder.JSONDecodeError:
-                print(f"Unable to load posts as JSON for: {blog}, marking as exclusion")
+                log.warning("Unable to load posts as JSON for: %s, marking as exclusion", blog)
                 raise MarkExclusion("Unable to load response as JSON")
 
             if feed_json:
                 if "feed" in feed_json and "entry" in feed_json["feed"]:
                     post_urls_extend([feed_json['feed']['entry'][p]['link'][-1]['href'] for p in range(0, len(feed_json['feed']['entry']))])
-                    if len(feed_json['feed']['entry']) != 150:
+                    if comment_counts is not None:
+                        comment_counts.extend(get_entry_comment_count(entry) for entry in feed_json['feed']['entry'])
+                    if len(feed_json['feed']['entry']) != page_size:
                         complete = True
                     else:
                         posts_index += 1
@@ -72,6 +94,15 @@ async def get_blog_posts(blog, exclusion_limit, session):
 
     return post_urls # Return the complete list of articles
 
+def get_entry_comment_count(entry):
+    total = entry.get("thr$total")
+    if total and "$t" in total:
+        try:
+            return int(total["$t"])
+        except ValueError:
+            pass
+    return None
+
 async def test():
     async with aiohttp.ClientSession() as session:
         # Sample default blog
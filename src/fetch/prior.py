@@ -0,0 +1,96 @@
+import json
+
+# Comments that were already archived by an earlier batch, used to re-archive a blog incrementally.
+# A prior archive is either a previous batch .json.gz (full comments, their replies and +1s are reused)
+# or a compact index with one json object per line: {"post_url", "comment_id", "reply_count", "plus_one_count"}.
+# Compact entries only have counts, so comments reused from them are marked instead of carrying data.
+
+
+class PriorArchive:
+    def __init__(self):
+        # post_url -> {comment_id: comment}
+        self.posts = {}
+
+    @classmethod
+    def load(cls, path):
+        prior = cls()
+        if path.endswith(".json.gz"):
+            prior.add_batch(path)
+        else:
+            prior.add_index(path)
+        return prior
+
+    def add_batch(self, path):
+        # read post by post so a large batch is never inflated and parsed all at once
+        from batch_reader import iter_posts
+        for blog, post in iter_posts(path):
+            if "comments" in post:
+                self.add_post(post["post_url"], post["comments"])
+                # comments an incremental run only knew from a compact index, their counts aren't known
+                for comment_id in post.get("archived_comment_ids", ()):
+                    self.posts[post["post_url"]].setdefault(comment_id, {"id": comment_id, "archived": True})
+
+    def add_index(self, path):
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.posts.setdefault(entry["post_url"], {})[entry["comment_id"]] = {
+                    "id": entry["comment_id"],
+                    "reply_count": entry.get("reply_count", 0),
+                    "plus_one_count": entry.get("plus_one_count", 0),
+                    "archived": True
+                }
+
+    def add_post(self, post_url, comments):
+        self.posts[post_url] = {comment["id"]: comment for comment in comments}
+
+    def get(self, post_url):
+        return self.posts.get(post_url)
+
+    def save_index(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            for post_url, comments in self.posts.items():
+                for comment_id, comment in comments.items():
+                    file.write(json.dumps({
+                        "post_url": post_url,
+                        "comment_id": comment_id,
+                        "reply_count": comment.get("reply_count", 0),
+                        "plus_one_count": comment.get("plus_one_count", 0)
+                    }) + "\n")
+
+
+def reuse_replies(comment, prior_comment):
+    """Copies the archived replies if the reply count hasn't changed, returns whether the fetch can be skipped"""
+    if not prior_comment or prior_comment.get("reply_count", 0) != comment["reply_count"]:
+        return False
+    if "replies" in prior_comment:
+        comment["replies"] = prior_comment["replies"]
+    elif prior_comment.get("archived"):
+        comment["replies_archived"] = True
+    else:
+        return False
+    return True
+
+
+def reuse_plus_ones(item, prior_item):
+    """Same as reuse_replies for the +1s of a comment or reply"""
+    if not prior_item or prior_item.get("plus_one_count", 0) != item.get("plus_one_count", 0):
+        return False
+    if prior_item.get("plus_ones_capped"):
+        # only the first --max-plus-ones were archived, fetch them again under the current cap
+        return False
+    if "plus_ones" in prior_item:
+        item["plus_ones"] = prior_item["plus_ones"]
+    elif prior_item.get("archived"):
+        item["plus_ones_archived"] = True
+    else:
+        return False
+    return True
+
+
+def prior_replies_by_id(prior_comment):
+    if not prior_comment or "replies" not in prior_comment:
+        return {}
+    return {reply["id"]: reply for reply in prior_comment["replies"]}
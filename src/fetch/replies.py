@@ -1,9 +1,22 @@
 import json, asyncio, aiohttp
-from util import remove_xssi_guard
-
-async def fetch_comment_replies(comment_id, post_url, session):
-    data = {"f.req": f'["{comment_id}",null,null,null,null,null,null,[20,null,null,1,null,null,null,1,null,"fntn",0,9,0,["{post_url}"],null,null,0],2]'}
-    async with session.post("https://apis.google.com/wm/1/_/stream/getactivity/", data=data) as response:
+from time import perf_counter
+
+from util import remove_xssi_guard, route
+import metrics
+from text_content import set_text
+from request_bodies import replies_body, FORM_HEADERS
+
+# The first value of getactivity's page hint. getactivity has no continuation for replies and returns the whole
+# thread regardless of the hint for the threads we've seen (91 replies for a hint of 20), but a response that
+# stops at exactly the hint with more replies left is fetched again with the hint raised to the reply count.
+REPLY_PAGE_HINT = 20
+
+async def fetch_comment_replies(comment_id, post_url, session, page_hint=REPLY_PAGE_HINT):
+    data = replies_body(post_url).render(comment_id=comment_id, page_hint=page_hint)
+    started = perf_counter()
+    async with session.post(route("https://apis.google.com/wm/1/_/stream/getactivity/"), data=data, headers=FORM_HEADERS) as response:
+        body = await response.read()
+        metrics.observe_request("getactivity", started, response.status, len(body))
         return await response.text()
 
 def get_os_u_object(raw_response_text):
@@ -19,12 +32,17 @@ def get_raw_reply_list(json_object):
         return []
 
 def get_replies_from_raw_response(raw_response_text):
+    started = perf_counter()
     os_u_object = get_os_u_object(raw_response_text)
     raw_replies = get_raw_reply_list(os_u_object)
+    metrics.observe_parse("getactivity", started)
 
     for reply in raw_replies:
         yield get_info_from_reply(reply)
 
+# The keys get_info_from_reply can set, in order
+REPLY_FIELDS = ("id", "date_posted", "user_name", "user_id", "user_avatar", "user_profile", "plus_one_id", "plus_one_count", "text", "text_plain", "text_spans", "language_code", "language_display")
+
 def get_info_from_reply(reply):
     results = {}
 
@@ -45,8 +63,7 @@ def get_info_from_reply(reply):
         results["plus_one_id"] = likes_object[0] or None
         results["plus_one_count"] = likes_object[16] or 0
 
-    text_object = reply[27]
-    results["text"] = text_object or None
+    set_text(results, reply[27])
 
     language_object = reply[26]
     results["language_code"] = language_object[0] or None
@@ -54,9 +71,27 @@ def get_info_from_reply(reply):
 
     return results
 
-async def get_replies_from_comment_id(comment_id, post_url, session):
+def is_cut_at_hint(replies, reply_count, page_hint=REPLY_PAGE_HINT):
+    # only a thread that stops at exactly the hint was cut there, one that's short of its count
+    # by any other amount had replies deleted and another request wouldn't find them
+    return reply_count is not None and len(replies) == page_hint < reply_count
+
+async def get_replies_from_comment_id(comment_id, post_url, session, reply_count=None):
     raw_response_text = await fetch_comment_replies(comment_id, post_url, session)
-    return get_replies_from_raw_response(raw_response_text)
+    replies = list(get_replies_from_raw_response(raw_response_text))
+
+    if is_cut_at_hint(replies, reply_count):
+        metrics.RETRIES.inc("reply page hint")
+        raw_response_text = await fetch_comment_replies(comment_id, post_url, session, reply_count)
+        all_replies = list(get_replies_from_raw_response(raw_response_text))
+        if len(all_replies) > len(replies):
+            replies = all_replies
+    return replies
+
+# Yields the replies of a comment one at a time
+async def iter_replies(comment_id, post_url, session, reply_count=None):
+    for reply in await get_replies_from_comment_id(comment_id, post_url, session, reply_count):
+        yield reply
 
 async def test_replies():
     # file = open("../test_data/replies_response.txt", "r", encoding="utf-8").read()
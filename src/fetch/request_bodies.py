@@ -0,0 +1,86 @@
+import re
+
+from functools import lru_cache
+from urllib.parse import quote_plus
+
+# The sw/bs and getactivity endpoints take a single urlencoded "f.req" field built from a large template
+# that repeats the post url several times around a long constant token.
+# A RequestBody urlencodes the constant parts of its template once; binding the post url makes a
+# template for that post, and rendering it only encodes and splices in the per-request values.
+# The bodies are byte for byte what aiohttp sends for data={"f.req": ...}, sent with FORM_HEADERS.
+# python request_bodies.py checks that against the f-strings the requests used to be built with.
+
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+PLACEHOLDER_PATTERN = re.compile(r"\{(\w+)\}")
+
+
+class RequestBody:
+    def __init__(self, parts, names):
+        # parts are encoded constants, names are the placeholders between them: len(parts) == len(names) + 1
+        self.parts = parts
+        self.names = names
+
+    @classmethod
+    def from_template(cls, field, template):
+        split = PLACEHOLDER_PATTERN.split(template)
+        parts = [quote_plus(part) for part in split[0::2]]
+        parts[0] = f"{quote_plus(field)}={parts[0]}"
+        return cls(parts, split[1::2])
+
+    def bind(self, **values):
+        """Returns a RequestBody with the given placeholders encoded into its constant parts"""
+        parts = [self.parts[0]]
+        names = []
+        for name, part in zip(self.names, self.parts[1:]):
+            if name in values:
+                parts[-1] += quote_plus(str(values[name])) + part
+            else:
+                names.append(name)
+                parts.append(part)
+        return RequestBody(parts, names)
+
+    def render(self, **values):
+        parts = self.parts
+        pieces = [parts[0]]
+        for i, name in enumerate(self.names):
+            pieces.append(quote_plus(str(values[name])))
+            pieces.append(parts[i + 1])
+        return "".join(pieces).encode("utf-8")
+
+
+MORE_COMMENTS_TEMPLATE = '[[null,[[null,null,null,null,2]],[1,[20,"{continuation_key}"],null,[[[2,[null,""]]]],true],[100]],[["{post_url}",null,null,null,0,null,"{post_url}",null,null,1,[20,null,null,1,null,null,null,1,null,"fntn",0,9,0,["{post_url}"],null,null,0],null,null,null,null,1,null,null,null,null,0,null,null,3,1,"ADSJ_i2qch7-NelDrYpMAgUEL3IyfvpRaOpIlNdE_bvIQ75NJOZBrBOcjySzgO6TLTwV505qclfGXYIJhMfE5caBt_gnFo0oJQMYepGtofNznk9sXjdUpWpbuvR9fVGZg5UE5s63b2jaYidM-u0YJobnkro9YS07tqwxEfgTeBOKzWrTTOVchhsesdkGf_5Bt2nIVwQX-CBt0dMjHSlQOVRDK8lDWMDDmByx31C9iLDhEhuG6dr0IdYCDriTB8orFKbx4AJztSfIqaJgpDhjauRnxyGTfIeDCF615Dhc5oQRNWv5DC3lk0Tdz76D42zH768dAYF1_pyJLZX8CdvH9V2MlBc6bvnCJdZWmHaWi1U17imK",20,null,null,[null,null,0,0,0],1,0,null,0],"{post_url}","{post_url}",[20,null,null,1,null,null,null,1,null,"fntn",0,9,0,["{post_url}"],null,null,0],0,""]]'
+REPLIES_TEMPLATE = '["{comment_id}",null,null,null,null,null,null,[{page_hint},null,null,1,null,null,null,1,null,"fntn",0,9,0,["{post_url}"],null,null,0],2]'
+
+MORE_COMMENTS_BODY = RequestBody.from_template("f.req", MORE_COMMENTS_TEMPLATE)
+REPLIES_BODY = RequestBody.from_template("f.req", REPLIES_TEMPLATE)
+
+
+# a post's pages and reply requests all come while it's being downloaded, so only recent posts are kept
+@lru_cache(maxsize=256)
+def more_comments_body(post_url):
+    return MORE_COMMENTS_BODY.bind(post_url=post_url)
+
+
+@lru_cache(maxsize=256)
+def replies_body(post_url):
+    return REPLIES_BODY.bind(post_url=post_url)
+
+
+def check_bodies():
+    from urllib.parse import urlencode
+
+    post_urls = ["https://blogger.googleblog.com/2019/01/an-update-on-google-and-blogger.html", "http://example.blogspot.com/2013/05/café & \"crème\".html?m=1"]
+    for post_url in post_urls:
+        for continuation_key in ["ADSJ_i2JqJ59cZYuQVvIKgqSvnIAvgA1Bdva5lYmJrCyUeXUXwxyx-_+/=", ""]:
+            legacy = f'[[null,[[null,null,null,null,2]],[1,[20,\"{continuation_key}\"],null,[[[2,[null,\"\"]]]],true],[100]],[[\"{post_url}\",null,null,null,0,null,\"{post_url}\",null,null,1,[20,null,null,1,null,null,null,1,null,\"fntn\",0,9,0,[\"{post_url}\"],null,null,0],null,null,null,null,1,null,null,null,null,0,null,null,3,1,\"ADSJ_i2qch7-NelDrYpMAgUEL3IyfvpRaOpIlNdE_bvIQ75NJOZBrBOcjySzgO6TLTwV505qclfGXYIJhMfE5caBt_gnFo0oJQMYepGtofNznk9sXjdUpWpbuvR9fVGZg5UE5s63b2jaYidM-u0YJobnkro9YS07tqwxEfgTeBOKzWrTTOVchhsesdkGf_5Bt2nIVwQX-CBt0dMjHSlQOVRDK8lDWMDDmByx31C9iLDhEhuG6dr0IdYCDriTB8orFKbx4AJztSfIqaJgpDhjauRnxyGTfIeDCF615Dhc5oQRNWv5DC3lk0Tdz76D42zH768dAYF1_pyJLZX8CdvH9V2MlBc6bvnCJdZWmHaWi1U17imK\",20,null,null,[null,null,0,0,0],1,0,null,0],\"{post_url}\",\"{post_url}\",[20,null,null,1,null,null,null,1,null,\"fntn\",0,9,0,[\"{post_url}\"],null,null,0],0,\"\"]]'
+            assert more_comments_body(post_url).render(continuation_key=continuation_key) == urlencode({"f.req": legacy}, doseq=True).encode("utf-8")
+        for comment_id in ["z120g3vxpu2mtn2ae04cdhjoixeixfyzjso0k", "z13+/ id"]:
+            for page_hint in [20, 91]:
+                legacy = f'["{comment_id}",null,null,null,null,null,null,[{page_hint},null,null,1,null,null,null,1,null,"fntn",0,9,0,["{post_url}"],null,null,0],2]'
+                assert replies_body(post_url).render(comment_id=comment_id, page_hint=page_hint) == urlencode({"f.req": legacy}, doseq=True).encode("utf-8")
+    print("Request bodies match the f-string bodies")
+
+
+if __name__ == '__main__':
+    check_bodies()
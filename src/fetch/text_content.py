@@ -0,0 +1,78 @@
+# Decodes the nested segment arrays Google stores comment and reply text in, e.g.
+# [[[0, "Read "], [2, "this", None, ["https://..."]], [1], [0, "bold", [1]]]]
+# into plain text plus spans of [start, end, kind, value] over it:
+#   0 text (optional formatting flags [bold, italic, strikethrough]), 1 line break,
+#   2 link -> "link" span with the url, 3 mention -> "mention" span with the user id,
+#   4 hashtag -> "hashtag" span with the tag
+# Formatting becomes "bold" / "italic" / "strike" spans with no value.
+
+# "raw" keeps Google's arrays in "text", "decoded" replaces them with "text_plain" and "text_spans",
+# "both" stores all three. Set by --text in worker.py and downloader.py.
+TEXT_FORMATS = ("raw", "decoded", "both")
+TEXT_FORMAT = "raw"
+
+FORMAT_KINDS = ("bold", "italic", "strike")
+
+
+class UnknownSegment(ValueError):
+    pass
+
+
+def decode_text(text):
+    """Returns (plain text, spans) for a raw text array"""
+    parts = []
+    spans = []
+    position = 0
+    append_part = parts.append
+    append_span = spans.append
+
+    for paragraph_number, paragraph in enumerate(text):
+        if paragraph_number:
+            append_part("\n")
+            position += 1
+        for segment in paragraph:
+            segment_type = segment[0]
+            if segment_type == 1:
+                append_part("\n")
+                position += 1
+                continue
+
+            value = segment[1] or ""
+            end = position + len(value)
+            if segment_type == 0:
+                if len(segment) > 2 and segment[2]:
+                    for kind, flag in zip(FORMAT_KINDS, segment[2]):
+                        if flag:
+                            append_span([position, end, kind, None])
+            elif segment_type == 2:
+                append_span([position, end, "link", segment[3][0] if segment[3] else value])
+            elif segment_type == 3:
+                append_span([position, end, "mention", segment[4][1] if segment[4] else None])
+            elif segment_type == 4:
+                append_span([position, end, "hashtag", segment[5][0] if len(segment) > 5 and segment[5] else value.lstrip("#")])
+            else:
+                raise UnknownSegment(f"Unknown text segment type: '{segment_type}'")
+            append_part(value)
+            position = end
+
+    return ("".join(parts), spans)
+
+
+def set_text(results, text):
+    """Stores a comment or reply's text in results according to TEXT_FORMAT"""
+    text = text or None
+    if TEXT_FORMAT != "decoded":
+        results["text"] = text
+    if TEXT_FORMAT == "raw":
+        return
+    if not text:
+        results["text_plain"] = None
+        return
+    try:
+        plain, spans = decode_text(text)
+    except (UnknownSegment, IndexError, TypeError):
+        # keep the raw form so nothing is lost on a segment we don't understand
+        results["text"] = text
+        return
+    results["text_plain"] = plain
+    results["text_spans"] = spans or None
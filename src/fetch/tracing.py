@@ -0,0 +1,121 @@
+import asyncio, contextvars, json, os
+
+from contextlib import contextmanager
+from time import perf_counter
+
+from log import get_logger
+
+log = get_logger("tracing")
+
+# The tracer for the current batch. Tasks copy the context they're created in,
+# so everything started while downloading a batch records into that batch's tracer.
+current_tracer = contextvars.ContextVar("current_tracer", default=None)
+
+
+class Tracer:
+    """Collects span timings and writes them as a Chrome trace (chrome://tracing, Perfetto)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+        self.started = perf_counter()
+        # each asyncio task gets its own row in the trace
+        self.task_ids = {}
+
+    def task_id(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task)
+        if key not in self.task_ids:
+            self.task_ids[key] = len(self.task_ids)
+        return self.task_ids[key]
+
+    def add(self, name, started, duration, args):
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": round((started - self.started) * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": 0,
+            "tid": self.task_id(),
+            "args": args
+        })
+
+    def summary(self):
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["name"], [0, 0])
+            total[0] += 1
+            total[1] += event["dur"]
+        return {name: {"count": count, "seconds": round(duration / 1e6, 3)} for name, (count, duration) in totals.items()}
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}, file)
+
+
+@contextmanager
+def record_span(tracer, name, args):
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        tracer.add(name, started, perf_counter() - started, args)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **args):
+    """Times the enclosed block when tracing is enabled for the current batch"""
+    tracer = current_tracer.get()
+    if tracer is None:
+        return NULL_SPAN
+    return record_span(tracer, name, args)
+
+
+class BatchProfiler:
+    """
+    Traces (and optionally cProfiles) everything run while it's active.
+    cProfile can only profile one thing at a time per thread, so when several batches
+    run at once only the first gets a cProfile dump, the rest still get traces.
+    """
+
+    profiling = False
+
+    def __init__(self, name, directory="../profiles/", use_cprofile=True):
+        self.name = name
+        self.directory = directory
+        self.tracer = Tracer(name)
+        self.profiler = None
+        self.use_cprofile = use_cprofile
+        self.token = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.token = current_tracer.set(self.tracer)
+        if self.use_cprofile and not BatchProfiler.profiling:
+            import cProfile
+            BatchProfiler.profiling = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        current_tracer.reset(self.token)
+        if self.profiler:
+            self.profiler.disable()
+            BatchProfiler.profiling = False
+            self.profiler.dump_stats(f"{self.directory}{self.name}.prof")
+        self.tracer.save(f"{self.directory}{self.name}.trace.json")
+        log.info("Saved profile for %s to %s | %s", self.name, self.directory, json.dumps(self.tracer.summary()))
+        return False
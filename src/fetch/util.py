@@ -1,7 +1,43 @@
+import re
+
+from urllib.parse import urlsplit
+
 # https://security.stackexchange.com/questions/110539/how-does-including-a-magic-prefix-to-a-json-response-work-to-prevent-xssi-attack
 # Google uses )]}'
 def remove_xssi_guard(raw_response_text):
     return raw_response_text.replace(")]}\'", "")
 
 def get_url_path(url):
-    return url[url.rfind("/") + 1:url.rfind(".html")]
\ No newline at end of file
+    return url[url.rfind("/") + 1:url.rfind(".html")]
+
+# Set by worker.py --target, every request goes to that server instead (see simulator.py)
+# with the original host as the first part of the path: https://apis.google.com/x -> {TARGET}/apis.google.com/x
+TARGET = None
+
+def route(url):
+    if TARGET is None:
+        return url
+    return f"{TARGET}/{url.partition('://')[2]}"
+
+
+# A blog's domain is the host of its post urls. Blogs on blogspot.com or one of blogspot's country domains
+# (nearly all of them) are taken as they are; only custom domains go through tldextract, which is imported
+# when the first one is seen and uses the public suffix list it was installed with instead of downloading
+# the current list and caching it on disk.
+BLOGSPOT_HOST_PATTERN = re.compile(r"[a-z0-9-]+\.blogspot(\.[a-z]{2,3}){1,2}", re.IGNORECASE)
+_domain_extractor = None
+
+def get_blog_domain(post_url):
+    host = urlsplit(post_url).netloc
+    if BLOGSPOT_HOST_PATTERN.fullmatch(host):
+        return host
+
+    global _domain_extractor
+    if _domain_extractor is None:
+        import tldextract
+        _domain_extractor = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=())
+    blog_tld = _domain_extractor(post_url)
+    blog_domain = f"{blog_tld.domain}.{blog_tld.suffix}"
+    if blog_tld.subdomain:
+        blog_domain = f"{blog_tld.subdomain}.{blog_domain}"
+    return blog_domain
@@ -0,0 +1,242 @@
+import asyncio, multiprocessing, os, signal, sys
+
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, './fetch/')
+
+import downloader
+import metrics, tracing, budget
+from log import get_logger, setup_logging, stop_logging
+from pool import POOL
+from config import CONFIG
+from prior import PriorArchive
+import text_content
+import plus_ones
+import util
+from archive_index import ArchiveIndex
+from batch_file import ShardSpool
+
+# Downloads one giant blog with several local processes (worker.py --shard-processes), for single domain
+# batches that a single event loop can't keep up with.
+# The blog's posts are split into shards and every process starts with an even range of them. A process takes
+# the next shard of its own range when its downloaders run out of posts, and once its range is empty it steals
+# the back half of the largest range left, so processes that got the quick shards help out the slow ones.
+# Each process writes everything it downloads to its own gzip member (batch_file.ShardSpool), and the worker
+# process copies the members into the blog as they are once every process is done.
+# Budgets are shared through shared memory, metrics and staged archive index rows are handed back at the end.
+
+SHARDS_PER_PROCESS = 8
+# smaller blogs are downloaded in the worker process, starting the processes isn't worth it for them
+MIN_SHARDED_POSTS = 500
+
+SHARDS = metrics.METRICS.counter("blogspot_shards_total", "Shards of sharded blogs downloaded, by whether the process stole them", ("source",))
+
+log = get_logger("shards")
+
+
+def make_shards(posts, comment_counts, count):
+    """Splits posts into count shards striped over the posts by comment count, so every shard gets its share of the big posts"""
+    ordered = sorted(posts, key=lambda post: -(comment_counts.get(post) or 0))
+    return [ordered[i::count] for i in range(count)]
+
+
+class ShardRanges:
+    """The [next, end) range of shards each process has left, in shared memory"""
+
+    def __init__(self, context, shard_count, processes):
+        self.processes = processes
+        self.lock = context.Lock()
+        bounds = []
+        for i in range(processes):
+            bounds += [shard_count * i // processes, shard_count * (i + 1) // processes]
+        self.bounds = context.Array("i", bounds, lock=False)
+
+    def take(self, slot):
+        """Returns the next shard for the process in slot, stealing when its range is empty, None once all shards are taken"""
+        bounds = self.bounds
+        stolen = False
+        with self.lock:
+            start, end = bounds[2 * slot], bounds[2 * slot + 1]
+            if start == end:
+                victim = max(range(self.processes), key=lambda i: bounds[2 * i + 1] - bounds[2 * i])
+                left = bounds[2 * victim + 1] - bounds[2 * victim]
+                if left == 0:
+                    return None
+                end = bounds[2 * victim + 1]
+                start = end - (left + 1) // 2
+                bounds[2 * victim + 1] = start
+                stolen = True
+            bounds[2 * slot] = start + 1
+            bounds[2 * slot + 1] = end
+        SHARDS.inc("stolen" if stolen else "own")
+        return start
+
+
+class ShardedDownloader:
+    """
+    Used like downloader.PostsDownloader for a blog that's started in batch_file: start() returns once every post
+    is in the blog, budget_exceeded is set if a budget ran out in any of the processes.
+    """
+
+    def __init__(self, blog_posts, batch_file, exclude_limit, processes, prior_archive=None, archive_index=None, skip_unchanged=False, comment_counts=None):
+        self.blog_posts = blog_posts
+        self.batch_file = batch_file
+        self.exclude_limit = exclude_limit
+        self.processes = processes
+        self.prior_archive = prior_archive
+        self.archive_index = archive_index
+        self.skip_unchanged = skip_unchanged
+        self.comment_counts = comment_counts or {}
+
+        self.posts_finished = 0
+        self.budget_exceeded = None
+
+    def make_job(self, shards):
+        """Everything a shard process needs, sent to it once when it starts"""
+        batch_file = self.batch_file
+        prior_posts = None
+        if self.prior_archive:
+            prior_posts = {url: self.prior_archive.posts[url] for url in self.blog_posts if url in self.prior_archive.posts}
+        return {
+            "directory": batch_file.directory,
+            "batch_id": batch_file.batch_id,
+            "file_name": batch_file.file_name,
+            "blog_name": batch_file.blog_name,
+            "blog_domain": batch_file.blog_domain,
+            "index": batch_file.index is not None,
+            "exclude_limit": self.exclude_limit,
+            "shards": shards,
+            "comment_counts": {url: count for url, count in self.comment_counts.items() if count is not None},
+            "prior_posts": prior_posts,
+            "archive_index_path": self.archive_index.path if self.archive_index else None,
+            "skip_unchanged": self.skip_unchanged,
+            # the worker's settings, a config reload while the blog downloads only applies to the next one
+            "config": CONFIG.to_dict(),
+            "text_format": text_content.TEXT_FORMAT,
+            "max_plus_ones": plus_ones.MAX_PLUS_ONES,
+            "target": util.TARGET
+        }
+
+    async def start(self):
+        t0 = perf_counter()
+        # spawned rather than forked, the worker's event loop and open connections mustn't be copied
+        context = multiprocessing.get_context("spawn")
+        shards = make_shards(self.blog_posts, self.comment_counts, min(len(self.blog_posts), self.processes * SHARDS_PER_PROCESS))
+        ranges = ShardRanges(context, len(shards), self.processes)
+
+        budgets = budget.current_budgets.get()
+        shared_budgets = []
+        for tracked in budgets:
+            limits = dict(tracked.limits)
+            if limits["seconds"] is not None:
+                limits["seconds"] -= tracked.used()["seconds"]
+            shared_budgets.append((tracked.scope, limits, context.Array("q", [tracked.requests, tracked.bytes])))
+
+        executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context, initializer=start_process, initargs=(self.make_job(shards), ranges, shared_budgets))
+        loop = asyncio.get_running_loop()
+        try:
+            with tracing.span("blog", file=self.batch_file.file_name, posts=len(self.blog_posts), processes=self.processes):
+                results = await asyncio.gather(*[loop.run_in_executor(executor, download_shards, slot) for slot in range(self.processes)])
+            for result in results:
+                metrics.METRICS.merge(result["metrics"])
+                if result["posts"]:
+                    self.batch_file.append_shard(result["path"], result["post_locations"], self.posts_finished == 0)
+                    self.posts_finished += result["posts"]
+                if result["budget_exceeded"] and not self.budget_exceeded:
+                    self.budget_exceeded = result["budget_exceeded"]
+                if self.archive_index:
+                    self.archive_index.staged.setdefault(self.batch_file.batch_id, []).extend(result["staged"])
+        finally:
+            # shutting down waits for the processes still running if one of them failed
+            await loop.run_in_executor(None, executor.shutdown)
+            for slot in range(self.processes):
+                path = shard_path(self.batch_file.directory, self.batch_file.file_name, slot)
+                if os.path.exists(path):
+                    os.remove(path)
+            for tracked, (scope, limits, counts) in zip(budgets, shared_budgets):
+                tracked.requests, tracked.bytes = counts[0], counts[1]
+        log.info("Saved %s posts in %s seconds with %s processes", self.posts_finished, format(perf_counter() - t0, '.2f'), self.processes)
+
+
+def shard_path(directory, file_name, slot):
+    return f"{directory}{file_name}.shard-{slot}"
+
+
+# set in every shard process by start_process
+JOB = None
+RANGES = None
+SHARED_BUDGETS = None
+
+
+def start_process(job, ranges, shared_budgets):
+    global JOB, RANGES, SHARED_BUDGETS
+    JOB = job
+    RANGES = ranges
+    SHARED_BUDGETS = shared_budgets
+    # ctrl+c is for the worker process, it stops taking blogs after this one like it does without shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in job["config"].items():
+        setattr(CONFIG, name, value)
+    text_content.TEXT_FORMAT = job["text_format"]
+    plus_ones.MAX_PLUS_ONES = job["max_plus_ones"]
+    util.TARGET = job["target"]
+
+
+def download_shards(slot):
+    """Runs in a shard process, downloads shards until there are none left and returns what the worker process merges"""
+    setup_logging()
+    try:
+        return asyncio.run(download_shards_in_loop(slot))
+    finally:
+        stop_logging()
+
+
+async def download_shards_in_loop(slot):
+    job = JOB
+    shards = job["shards"]
+    spool = ShardSpool(shard_path(job["directory"], job["file_name"], slot), job["batch_id"], job["file_name"], job["blog_name"], job["blog_domain"], job["index"])
+    prior_archive = None
+    if job["prior_posts"] is not None:
+        prior_archive = PriorArchive()
+        prior_archive.posts = job["prior_posts"]
+    archive_index = ArchiveIndex(job["archive_index_path"]) if job["archive_index_path"] else None
+    budget.current_budgets.set(tuple(budget.SharedBudget(scope, counts, **limits) for scope, limits, counts in SHARED_BUDGETS))
+
+    budget_exceeded = None
+    staged = []
+    try:
+        shard = RANGES.take(slot)
+        if shard is not None:
+            log.info("shard process %s | Starting with shard %s of %s", slot, shard + 1, len(shards))
+
+            def take_next_shard():
+                # called when the downloaders have taken every post, the next shard keeps them busy
+                if dler.budget_exceeded:
+                    return
+                shard = RANGES.take(slot)
+                if shard is not None:
+                    log.info("shard process %s | Taking shard %s of %s", slot, shard + 1, len(shards))
+                    dler.add_posts(shards[shard])
+                    dler.on_tail = take_next_shard
+
+            dler = downloader.PostsDownloader(shards[shard], spool, job["exclude_limit"], prior_archive=prior_archive, archive_index=archive_index, skip_unchanged=job["skip_unchanged"], comment_counts=job["comment_counts"], on_tail=take_next_shard)
+            await dler.start()
+            budget_exceeded = dler.budget_exceeded
+        if archive_index:
+            staged = archive_index.staged.pop(job["batch_id"], [])
+    finally:
+        spool.close()
+        await POOL.close()
+        if archive_index:
+            archive_index.close()
+
+    log.info("shard process %s | Done with %s posts", slot, spool.posts_written)
+    return {
+        "path": spool.raw_file.name,
+        "posts": spool.posts_written,
+        "post_locations": spool.index["blogs"][0]["posts"] if spool.index is not None else None,
+        "budget_exceeded": budget_exceeded,
+        "staged": staged,
+        "metrics": metrics.METRICS.collect()
+    }
@@ -0,0 +1,409 @@
+import asyncio, contextlib, json, os, re, sys, random, argparse, tempfile, uuid, zlib
+
+from aiohttp import web
+from collections import deque
+from time import perf_counter
+
+sys.path.insert(0, './fetch/')
+
+from util import remove_xssi_guard
+
+# A local stand-in for Blogger, the Google comment endpoints and the master/upload servers, for load testing
+# one worker: python simulator.py --port 8080 then python worker.py --target http://127.0.0.1:8080
+# With --target every request goes to {target}/{original host}/{original path}, which is how the routes
+# below are laid out.
+#
+# Blogs, posts, comments, replies and +1s are generated from a seed and the url, so every endpoint agrees
+# on the counts without keeping any state. The comments and replies are the ones recorded in ../test_data/
+# with new ids and counts, so response sizes and parse costs are realistic.
+
+TEST_DATA = "../test_data/"
+
+COMMENTS_PER_PAGE = 20
+FEED_PAGE_SIZE = 150
+
+CAPTCHA_PAGE = "<html><head><title>Sorry...</title></head><body>Our systems have detected unusual traffic from your computer network.</body></html>"
+
+PLACEHOLDER_PATTERN = re.compile(r'"@@(\w+)@@"')
+
+
+class JsonTemplate:
+    """A json document serialized once, with "@@name@@" strings replaced by json values when rendered"""
+
+    def __init__(self, obj):
+        split = PLACEHOLDER_PATTERN.split(json.dumps(obj))
+        self.parts = split[0::2]
+        self.names = split[1::2]
+
+    def render(self, values):
+        pieces = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            pieces.append(json.dumps(values[name]))
+            pieces.append(part)
+        return "".join(pieces)
+
+
+def load_comment_templates():
+    with open(f"{TEST_DATA}sample_comments.json", "r", encoding="utf-8") as file:
+        comments = json.load(file)[7]
+    templates = []
+    for comment in comments:
+        comment[5][1] = "@@id@@"
+        info_list = next(iter(comment[6].values()))
+        info_list[5] = "@@date@@"
+        info_list[93] = "@@reply_count@@"
+        if info_list[73]:
+            info_list[73][0] = "@@plus_one_id@@"
+            info_list[73][16] = "@@plus_one_count@@"
+        templates.append(JsonTemplate(comment))
+    return templates
+
+
+def load_reply_templates():
+    with open(f"{TEST_DATA}replies_response.txt", "r", encoding="utf-8") as file:
+        response = json.loads(remove_xssi_guard(file.read()))
+    templates = []
+    for reply in response[0][1][7]:
+        reply[3] = "@@date@@"
+        reply[4] = "@@id@@"
+        if reply[15]:
+            reply[15][0] = "@@plus_one_id@@"
+            reply[15][16] = "@@plus_one_count@@"
+        templates.append(JsonTemplate(reply))
+    # the comment the replies belong to, the response repeats it in front of its replies
+    response[0][1][7] = "@@replies@@"
+    return templates, JsonTemplate(response)
+
+
+def domain_name(i):
+    return f"simblog{i:07d}"
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.comment_templates = load_comment_templates()
+        self.reply_templates, self.reply_response_template = load_reply_templates()
+
+        self.batches_given = 0
+        # index in the domains list of the next batch's first blog
+        self.next_blog = 0
+        self.started = perf_counter()
+        # (endpoint, status) -> count
+        self.requests = {}
+        self.uploaded_bytes = 0
+        # times of recent Google requests, for the rate limit
+        self.recent_requests = deque()
+        self.captcha_until = 0
+
+        self.directory = tempfile.mkdtemp(prefix="blogspot-simulator-")
+        self.domains_path = os.path.join(self.directory, "domains.txt")
+        with open(self.domains_path, "w") as file:
+            for i in range(args.domains):
+                file.write(domain_name(i) + "\n")
+
+    def rng(self, *key):
+        return random.Random(":".join([str(self.args.seed)] + [str(part) for part in key]))
+
+    def lognormal_count(self, rng, median, maximum):
+        if median <= 0:
+            return 0
+        return min(maximum, int(rng.lognormvariate(0, self.args.spread) * median))
+
+    # generated content
+
+    def blog_status(self, blog_name):
+        roll = self.rng("status", blog_name).random()
+        if roll < self.args.deleted_rate:
+            return 404
+        elif roll < self.args.deleted_rate + self.args.private_rate:
+            return 401
+        return 200
+
+    def blog_post_count(self, blog_name):
+        return self.lognormal_count(self.rng("posts", blog_name), self.args.posts, self.args.max_posts)
+
+    def post_url(self, blog_name, i):
+        return f"https://{blog_name}.blogspot.com/2019/01/post-{i}.html"
+
+    def post_comment_count(self, post_url):
+        rng = self.rng("comments", post_url)
+        if rng.random() < self.args.empty_rate:
+            return 0
+        return max(1, self.lognormal_count(rng, self.args.comments, self.args.max_comments))
+
+    def comment_counts(self, comment_id):
+        rng = self.rng("comment", comment_id)
+        reply_count = self.lognormal_count(rng, self.args.replies, self.args.max_replies) if rng.random() < self.args.reply_rate else 0
+        plus_one_count = self.lognormal_count(rng, self.args.plus_ones, self.args.max_plus_ones) if rng.random() < self.args.plus_one_rate else 0
+        return reply_count, plus_one_count
+
+    def render_comment(self, post_url, i):
+        comment_id = f"sim{zlib.crc32(post_url.encode()):010d}_{i}"
+        reply_count, plus_one_count = self.comment_counts(comment_id)
+        template = self.comment_templates[i % len(self.comment_templates)]
+        return template.render({
+            "id": comment_id,
+            "date": 1548956847157 + i,
+            "reply_count": reply_count,
+            "plus_one_id": f"4/{comment_id}/{plus_one_count}",
+            "plus_one_count": plus_one_count
+        })
+
+    def comments_page(self, post_url, page):
+        total = self.post_comment_count(post_url)
+        start = page * COMMENTS_PER_PAGE
+        comments = [self.render_comment(post_url, i) for i in range(start, min(total, start + COMMENTS_PER_PAGE))]
+        continuation_key = f"page:{page + 1}" if start + COMMENTS_PER_PAGE < total else ""
+        # blogger_object[1]: [.., continuation key, .., comments at 7]
+        page_object = f'[[],{json.dumps(continuation_key)},null,null,[],null,null,[{",".join(comments)}],null,null,null,[]]'
+        return total, page_object
+
+    # fault injection
+
+    async def google_request(self, endpoint):
+        """Latency, errors and the rate limit for the Google endpoints, returns the response to fail with or None"""
+        args = self.args
+        if args.latency:
+            await asyncio.sleep(max(0, random.gauss(args.latency, args.latency_jitter)) / 1000)
+
+        now = perf_counter()
+        if args.rate_limit:
+            self.recent_requests.append(now)
+            while self.recent_requests and self.recent_requests[0] < now - 1:
+                self.recent_requests.popleft()
+            if len(self.recent_requests) > args.rate_limit and self.captcha_until < now:
+                self.captcha_until = now + args.captcha_seconds
+                print(f"Rate limit reached ({len(self.recent_requests)} requests/s), serving captcha pages for {args.captcha_seconds}s")
+            if self.captcha_until >= now:
+                # the widget answers 404 when rate limited, the other endpoints a captcha page
+                if endpoint == "widget":
+                    return web.Response(status=404, text=CAPTCHA_PAGE, content_type="text/html")
+                return web.Response(text=CAPTCHA_PAGE, content_type="text/html")
+
+        if args.error_rate and random.random() < args.error_rate:
+            return web.Response(status=503, text="Service Unavailable")
+
+    def count(self, endpoint, status):
+        self.requests[(endpoint, status)] = self.requests.get((endpoint, status), 0) + 1
+
+    @web.middleware
+    async def count_requests(self, request, handler):
+        response = await handler(request)
+        self.count(request.match_info.route.name or "unknown", response.status)
+        return response
+
+    # Blogger
+
+    async def handle_feed(self, request):
+        if self.args.feed_latency:
+            await asyncio.sleep(max(0, random.gauss(self.args.feed_latency, self.args.latency_jitter)) / 1000)
+        blog_name = request.match_info["host"].split(".")[0]
+        status = self.blog_status(blog_name)
+        if status != 200:
+            return web.Response(status=status, text="Not found" if status == 404 else "Private")
+
+        start_index = int(request.query.get("start-index", 1))
+        max_results = min(FEED_PAGE_SIZE, int(request.query.get("max-results", 25)))
+        post_count = self.blog_post_count(blog_name)
+        entries = []
+        for i in range(start_index - 1, min(post_count, start_index - 1 + max_results)):
+            post_url = self.post_url(blog_name, i)
+            entries.append({
+                "title": {"$t": f"Post {i}"},
+                "link": [{"rel": "alternate", "type": "text/html", "href": post_url}],
+                "thr$total": {"$t": str(self.post_comment_count(post_url))}
+            })
+        feed = {"feed": {"entry": entries}} if entries else {"feed": {}}
+        return web.json_response(feed)
+
+    # Google comment endpoints
+
+    async def handle_widget(self, request):
+        failure = await self.google_request("widget")
+        if failure:
+            return failure
+        post_url = request.query.get("query", "")
+        total, page_object = self.comments_page(post_url, 0)
+        html = f"<html><body><script>AF_initDataCallback({{key: 'ds:0', data:[\"os.blogger\",{page_object},[{total}]]}});</script></body></html>"
+        return web.Response(text=html, content_type="text/html")
+
+    async def handle_more_comments(self, request):
+        failure = await self.google_request("sw-bs")
+        if failure:
+            return failure
+        form = await request.post()
+        f_req = json.loads(form["f.req"])
+        continuation_key = f_req[0][2][1][1]
+        post_url = f_req[1][0][0]
+        page = int(continuation_key.split(":")[1]) if continuation_key.startswith("page:") else 1
+        total, page_object = self.comments_page(post_url, page)
+        return web.Response(text=f')]}}\'\n[["os.blogger",{page_object}]]', content_type="application/json")
+
+    async def handle_replies(self, request):
+        failure = await self.google_request("getactivity")
+        if failure:
+            return failure
+        form = await request.post()
+        f_req = json.loads(form["f.req"])
+        comment_id = f_req[0]
+        reply_count, _ = self.comment_counts(comment_id)
+        replies = []
+        for i in range(reply_count):
+            reply_id = f"{comment_id}#{1548959647425826 + i}"
+            plus_one_count = self.comment_counts(reply_id)[1]
+            replies.append(self.reply_templates[i % len(self.reply_templates)].render({
+                "id": reply_id,
+                "date": 1548959647425 + i,
+                "plus_one_id": f"5/{reply_id}/{plus_one_count}",
+                "plus_one_count": plus_one_count
+            }))
+        # the replies are already json, so they go straight between the two parts of the response
+        template = self.reply_response_template
+        response = template.parts[0] + f"[{','.join(replies)}]" + template.parts[1]
+        return web.Response(text=")]}'\n" + response, content_type="application/json")
+
+    async def handle_plus_ones(self, request):
+        failure = await self.google_request("getpeople")
+        if failure:
+            return failure
+        form = await request.post()
+        plus_one_count = int(form["plusoneId"].rstrip("/").rsplit("/", 1)[1])
+        amount = min(plus_one_count, int(form.get("num", plus_one_count)))
+        people = [[f"Person {i}", f"1{i:020d}", f"./1{i:020d}", "https://lh3.googleusercontent.com/photo.jpg"] for i in range(amount)]
+        return web.Response(text=")]}'\n" + json.dumps([["os.pl", people]]), content_type="application/json")
+
+    # master and upload server
+
+    async def handle_get_id(self, request):
+        return web.Response(text=str(uuid.uuid4()))
+
+    async def handle_get_batch(self, request):
+        if self.args.batches and self.batches_given >= self.args.batches or self.next_blog >= self.args.domains:
+            return web.Response(text="Fail")
+        self.batches_given += 1
+        # the offset is where the batch starts in domains.txt in bytes, every line has the same length
+        offset = self.next_blog * len(domain_name(0) + "\n")
+        if self.args.domain_batches:
+            # a single blog per batch, named in the batch instead of read from the domains list
+            content = domain_name(self.next_blog)
+            self.next_blog += 1
+        else:
+            content = ""
+            self.next_blog += self.args.batch_size
+        return web.json_response({
+            "batchID": self.batches_given,
+            "randomKey": random.randrange(10 ** 6),
+            "offset": offset,
+            "limit": self.args.exclusion_limit,
+            "assignmentType": "domain" if self.args.domain_batches else "list",
+            "content": content,
+            "batchSize": 1 if self.args.domain_batches else self.args.batch_size,
+            "worker_version": 3
+        })
+
+    async def handle_success(self, request):
+        return web.Response(text="Success")
+
+    async def handle_upload(self, request):
+        reader = await request.multipart()
+        async for part in reader:
+            save = self.args.save_uploads and part.filename
+            with open(os.path.join(self.args.save_uploads, part.filename), "wb") if save else contextlib.nullcontext() as file:
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    self.uploaded_bytes += len(chunk)
+                    if file:
+                        file.write(chunk)
+        return web.Response(text="Success")
+
+    async def handle_domains(self, request):
+        return web.FileResponse(self.domains_path)
+
+    # reporting
+
+    def report(self):
+        elapsed = perf_counter() - self.started
+        totals = {}
+        for (endpoint, status), count in self.requests.items():
+            totals.setdefault(endpoint, {})[status] = count
+        print(f"[simulator] {elapsed:.0f}s | batches: {self.batches_given} | uploaded: {self.uploaded_bytes} bytes | requests: {json.dumps(totals, sort_keys=True)}")
+
+    async def report_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.count_requests], client_max_size=1024 ** 3)
+        app.router.add_get("/{host}/feeds/posts/default", self.handle_feed, name="feed")
+        app.router.add_get("/apis.google.com/u/0/_/widget/render/comments", self.handle_widget, name="widget")
+        app.router.add_post("/apis.google.com/wm/1/_/sw/bs", self.handle_more_comments, name="sw-bs")
+        app.router.add_post("/apis.google.com/wm/1/_/stream/getactivity/", self.handle_replies, name="getactivity")
+        app.router.add_post("/apis.google.com/wm/1/_/common/getpeople/", self.handle_plus_ones, name="getpeople")
+        app.router.add_get("/{host}/worker/getID", self.handle_get_id, name="getID")
+        app.router.add_get("/{host}/worker/getBatch", self.handle_get_batch, name="getBatch")
+        app.router.add_get("/{host}/worker/updateStatus", self.handle_success, name="updateStatus")
+        app.router.add_get("/{host}/worker/{submission:submit\\w+}", self.handle_success, name="submit")
+        app.router.add_post("/{host}/submitBatchUnit", self.handle_upload, name="upload")
+        app.router.add_get("/{host}/worker/domains.txt", self.handle_domains, name="domains")
+        return app
+
+
+async def main(args):
+    simulation = Simulation(args)
+    runner = web.AppRunner(simulation.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, args.host, args.port)
+    await site.start()
+    print(f"Simulating Blogger, Google and the master on http://{args.host}:{args.port} | domains: {args.domains} | seed: {args.seed}")
+    try:
+        await simulation.report_periodically(args.report_interval)
+    finally:
+        simulation.report()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--save-uploads", help="directory to keep the uploaded batches in")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report-interval", type=float, default=10)
+    # batches
+    parser.add_argument("--domains", type=int, default=100000, help="blogs in the simulated domains list")
+    parser.add_argument("--batch-size", type=int, default=10, help="blogs per batch")
+    parser.add_argument("--batches", type=int, default=0, help="stop handing out batches after this many (0 for no limit)")
+    parser.add_argument("--domain-batches", action="store_true", help="hand out single domain batches of one blog each (worker.py --shard-processes)")
+    parser.add_argument("--exclusion-limit", type=int, default=0, help="the post limit sent with each batch, 0 for none")
+    # blog sizes, counts are lognormal around the median with --spread as sigma
+    parser.add_argument("--posts", type=float, default=30, help="median posts per blog")
+    parser.add_argument("--max-posts", type=int, default=5000)
+    parser.add_argument("--comments", type=float, default=5, help="median comments on posts that have some")
+    parser.add_argument("--max-comments", type=int, default=2000)
+    parser.add_argument("--empty-rate", type=float, default=0.6, help="share of posts without comments")
+    parser.add_argument("--replies", type=float, default=3, help="median replies on comments that have some")
+    parser.add_argument("--max-replies", type=int, default=500)
+    parser.add_argument("--reply-rate", type=float, default=0.2, help="share of comments with replies")
+    parser.add_argument("--plus-ones", type=float, default=3, help="median +1s on comments and replies that have some")
+    parser.add_argument("--max-plus-ones", type=int, default=2000)
+    parser.add_argument("--plus-one-rate", type=float, default=0.2, help="share of comments and replies with +1s")
+    parser.add_argument("--spread", type=float, default=1.0)
+    parser.add_argument("--deleted-rate", type=float, default=0.05)
+    parser.add_argument("--private-rate", type=float, default=0.02)
+    # faults
+    parser.add_argument("--latency", type=float, default=50, help="mean added latency of the Google endpoints in ms")
+    parser.add_argument("--feed-latency", type=float, default=0, help="mean added latency of each Blogger feed page in ms")
+    parser.add_argument("--latency-jitter", type=float, default=20, help="standard deviation of the added latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of Google requests answered with a 503")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Google requests per second above which captcha pages are served (0 for none)")
+    parser.add_argument("--captcha-seconds", type=float, default=30, help="how long captcha pages are served once the rate limit is hit")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,12 +1,26 @@
-import asyncio, aiohttp, json, tldextract, sys, os
+import asyncio, aiohttp, json, sys, os, signal, argparse, contextlib
 
 from aiohttp import FormData
+from time import perf_counter
 
 sys.path.insert(0, './fetch/')
 
 from fetch.posts import get_blog_posts, MarkExclusion, NoEntries
 import downloader
+import shards
+import domains_list
+import metrics, tracing, budget
+from log import get_logger, setup_logging, stop_logging
+from pool import POOL
+from config import CONFIG
+from prior import PriorArchive
+import text_content
+import plus_ones
+import util
+from util import route, get_blog_domain
+from archive_index import ArchiveIndex
 from batch_file import BatchFile
+from columnar import ColumnarSink, import_pyarrow
 
 MASTER_SERVER = "https://blogspot-comments-master.herokuapp.com"
 UPLOAD_SERVER = "http://blogstore.bot.nu"
@@ -33,9 +47,19 @@ SUBMIT_EXCLUSION_BLOG_ENDPOINT = f"{MASTER_SERVER}/worker/submitExclusion"
 SUBMIT_DELETED_BLOG_ENDPOINT = f"{MASTER_SERVER}/worker/submitDeleted"
 SUBMIT_PRIVATE_BLOG_ENDPOINT = f"{MASTER_SERVER}/worker/submitPrivate"
 SUBMIT_CUSTOM_DOMAIN_ENDPOINT = f"{MASTER_SERVER}/worker/submitDomain"
+# blogs cut short by --blog-budget / --batch-budget, the master may not support it yet so it's only tried once
+SUBMIT_TRUNCATED_BLOG_ENDPOINT = f"{MASTER_SERVER}/worker/submitTruncated"
 
 UPDATE_BATCH_ENDPOINT = f"{MASTER_SERVER}/worker/updateStatus"
 DOMAINS_LIST_ENDPOINT = f"{UPLOAD_SERVER}/worker/domains.txt.gz"
+# uncompressed copy of the domains list, must support range requests
+DOMAINS_TEXT_ENDPOINT = os.environ.get("DOMAINS_TEXT_ENDPOINT", f"{UPLOAD_SERVER}/worker/domains.txt")
+# LAZY_DOMAINS=1 reads only the part of the domains list each batch needs instead of downloading all of it
+LAZY_DOMAINS = os.environ.get("LAZY_DOMAINS") == "1"
+# Optional sparse local copy of the blocks read in lazy mode
+DOMAINS_BLOCK_CACHE = os.environ.get("DOMAINS_BLOCK_CACHE")
+# Set when there's no valid domains.txt, it's downloaded and extracted in the background while batches run
+DOWNLOAD_DOMAINS = False
 
 SUBMIT_BATCH_UNIT = f"{UPLOAD_SERVER}/submitBatchUnit"
 # called by master
@@ -44,15 +68,44 @@ SUBMIT_BATCH_UNIT = f"{UPLOAD_SERVER}/submitBatchUnit"
 WORKER_VERSION = 3
 # WORKER_BATCH_SIZE = 500
 
-# Stop trying to connect to master after 18 hours
-MASTER_SLEEP_TOTAL = (60 * 60) * 18
-# MASTER_SLEEP_TOTAL = 10
-# Multiply the sleep amount each retry
-# MASTER_SLEEP_INCREMENT = 5
-MASTER_SLEEP_INCREMENT = 30
-# Stop multiplying after 180 seconds
-# MASTER_SLEEP_MAXIMUM = 10
-MASTER_SLEEP_MAXIMUM = 180
+# The batch downloader count, the master retry sleeps (stop trying to connect to master after 18 hours,
+# add 30 seconds to the sleep each retry up to 180) and the sleep between batches are in fetch/config.py
+
+log = get_logger("worker")
+
+# Set by --profile, saves a cProfile dump and a Chrome trace of each batch to ../profiles/
+PROFILE = False
+# Set by --prior, comments already archived by earlier batches (see fetch/prior.py)
+PRIOR_ARCHIVE = None
+# Set by --index, the local record of archived posts (see archive_index.py)
+ARCHIVE_INDEX = None
+# Set by --skip-unchanged, posts whose comment total hasn't changed since they were indexed aren't downloaded again
+SKIP_UNCHANGED = False
+# Posts the blog feed reports 0 comments for are written without requesting the comments widget,
+# --no-feed-counts turns this off
+USE_FEED_COUNTS = True
+# Set by --columnar, also writes each batch as Parquet tables to ../output/columnar/ (kept locally, not uploaded)
+COLUMNAR_OUTPUT = False
+# Set by --blog-budget and --batch-budget, limits on the seconds, requests and response bytes a blog or a
+# whole batch may use (see fetch/budget.py). Blogs that run out are written with what they have and a "truncated"
+# key, blogs the batch doesn't get to as status t.
+BLOG_BUDGET = {}
+BATCH_BUDGET = {}
+# Set by --batch-index, each blog is written as its own gzip member and a .idx.json of where every post starts
+# is kept next to the batch (the batch itself is still uploaded as one ordinary .json.gz)
+BATCH_INDEX = False
+# Cleared by --no-prefetch, in list batches the next blog's feed is fetched while the current blog
+# finishes its last posts
+PREFETCH_NEXT_BLOG = True
+# Set by --parallel-blogs, how many blogs of a list batch are downloaded at once. Blogs that finish before
+# their turn wait in spools (batch_file.BlogSpool) and are copied into the batch in order.
+PARALLEL_BLOGS = 1
+# Set by --shard-processes, how many local processes download the blog of a single domain batch, see shards.py
+SHARD_PROCESSES = 1
+# Set by --target, the simulator (simulator.py) every request goes to instead, see fetch/util.py route.
+# A load report is appended to LOAD_REPORT_PATH every LOAD_REPORT_INTERVAL seconds while it's set.
+LOAD_REPORT_PATH = "../load_report.jsonl"
+LOAD_REPORT_INTERVAL = 10
 
 class GracefulKiller:
   kill_now = False
@@ -66,9 +119,9 @@ class GracefulKiller:
 async def get_worker_id(session):
 
     def fail_func(response_status):
-        print(f"[get_worker_id] The server response was unsuccessful ({response_status}), unable to get a worker ID")
+        log.error("[get_worker_id] The server response was unsuccessful (%s), unable to get a worker ID", response_status)
 
-    response = await retry_request_on_fail(session.get, fail_func, True, False, GET_ID_ENDPOINT)
+    response = await retry_request_on_fail(session.get, fail_func, True, False, route(GET_ID_ENDPOINT))
     if response and response.status == 200:
         text = await response.text()
         return text
@@ -76,10 +129,10 @@ async def get_worker_id(session):
 async def get_batch(worker_id, session):
 
     def fail_func(response_status):
-        print(f"[get_batch] The server response was unsuccessful ({response_status}), unable to get a batch")
+        log.error("[get_batch] The server response was unsuccessful (%s), unable to get a batch", response_status)
 
     params = {"id": worker_id}
-    response = await retry_request_on_fail(session.get, fail_func, True, True, GET_BATCH_ENDPOINT, params=params)
+    response = await retry_request_on_fail(session.get, fail_func, True, True, route(GET_BATCH_ENDPOINT), params=params)
     if response and response.status == 200:
         text = await response.text()
         obj = json.loads(text)
@@ -96,7 +149,7 @@ async def get_batch(worker_id, session):
 
 async def update_batch_status(worker_id, batch_id, random_key, status, session):
     def fail_func(response_status):
-        print(f"[update_batch_status] The server response was unsuccessful ({response_status}), unable to update batch status")
+        log.error("[update_batch_status] The server response was unsuccessful (%s), unable to update batch status", response_status)
 
     params = {
         "id": worker_id,
@@ -104,9 +157,9 @@ async def update_batch_status(worker_id, batch_id, random_key, status, session):
         "randomKey": random_key,
         "status": status
     }
-    response = await retry_request_on_fail(session.get, fail_func, True, False, UPDATE_BATCH_ENDPOINT, params=params)
+    response = await retry_request_on_fail(session.get, fail_func, True, False, route(UPDATE_BATCH_ENDPOINT), params=params)
     if response and response.status == 200:
-        print(f"Successfully updated batch status: worker_id: {worker_id} | batch_id: {batch_id}")
+        log.info("Successfully updated batch status: worker_id: %s | batch_id: %s", worker_id, batch_id)
         return True
 
 
@@ -115,7 +168,7 @@ async def submit_batch_exception(exception_type, endpoint, worker_id, batch_id,
     variables_string = f"worker_id: {worker_id} batch_id: {batch_id} random_key: {random_key} blog_name: {blog_name}"
 
     def fail_func(response_status):
-        print(f"[submit_batch_exception] The server response was unsuccessful ({response_status}), unable to submit as {exception_type}\n{variables_string}")
+        log.error("[submit_batch_exception] The server response was unsuccessful (%s), unable to submit as %s\n%s", response_status, exception_type, variables_string)
 
     params = {
         "id": worker_id,
@@ -129,19 +182,19 @@ async def submit_batch_exception(exception_type, endpoint, worker_id, batch_id,
     else:
         params[exception_type] = blog_name
 
-    response = await retry_request_on_fail(session.get, fail_func, True, False, endpoint, params=params)
+    response = await retry_request_on_fail(session.get, fail_func, True, False, route(endpoint), params=params)
 
     if response and response.status == 200:
         text = await response.text()
         success = text == "Success"
         if success:
-            print(f"Submitted batch for {exception_type}\n{variables_string}")
+            log.info("Submitted batch for %s\n%s", exception_type, variables_string)
             return True
         elif text == "Dupe":
-            print(f"Aborting submitting as {exception_type}, duplication detected\n{variables_string}")
+            log.error("Aborting submitting as %s, duplication detected\n%s", exception_type, variables_string)
             return True
         else:
-            print(f"Failed to submit {exception_type}\n{variables_string}")
+            log.error("Failed to submit %s\n%s", exception_type, variables_string)
             return False
 
 async def submit_exclusion(worker_id, batch_id, random_key, blog_name, session):
@@ -156,6 +209,27 @@ async def submit_deleted(worker_id, batch_id, random_key, blog_name, session):
     success = await submit_batch_exception("deleted", SUBMIT_DELETED_BLOG_ENDPOINT, worker_id, batch_id, random_key, blog_name, session)
     return success
 
+async def submit_truncated(worker_id, batch_id, random_key, blog_name, session):
+    # best effort: a single try without retry_request_on_fail, so a master that doesn't have the endpoint
+    # can't hold up or fail the batch, the truncation is recorded in the batch file either way
+    variables_string = f"worker_id: {worker_id} batch_id: {batch_id} random_key: {random_key} blog_name: {blog_name}"
+    params = {
+        "id": worker_id,
+        "batchID": batch_id,
+        "randomKey": random_key,
+        "truncated": blog_name
+    }
+    try:
+        response = await session.get(route(SUBMIT_TRUNCATED_BLOG_ENDPOINT), params=params)
+        text = await response.text()
+        if response.status == 200 and text in ("Success", "Dupe"):
+            log.info("Submitted batch for truncated\n%s", variables_string)
+            return True
+        log.warning("Unable to submit as truncated (%s), not retrying\n%s", response.status, variables_string)
+    except Exception as e:
+        log.warning("Unable to submit as truncated (%r), not retrying\n%s", e, variables_string)
+    return False
+
 async def submit_custom_domain(worker_id, batch_id, random_key, blog_name, domain, session):
     success = await submit_batch_exception("domain", SUBMIT_CUSTOM_DOMAIN_ENDPOINT, worker_id, batch_id, random_key, blog_name, session, domain=domain)
     return success
@@ -163,7 +237,7 @@ async def submit_custom_domain(worker_id, batch_id, random_key, blog_name, domai
 async def upload_batch(worker_id, batch_id, random_key, version, file_path, file_name, session):
 
     def fail_func(response_status):
-        print(f"[upload_batch] The server response was unsuccessful ({response_status}), unable to upload batch")
+        log.error("[upload_batch] The server response was unsuccessful (%s), unable to upload batch", response_status)
 
     async def create_request(url):
         data = FormData()
@@ -178,109 +252,214 @@ async def upload_batch(worker_id, batch_id, random_key, version, file_path, file
     url = SUBMIT_BATCH_UNIT
 
     # response = await retry_request_on_fail(create_request, fail_func, False, False, url)
-    response = await create_request(url)
+    response = await create_request(route(url))
     if response.status == 200:
-        print(f"Successfully uploaded batch: worker_id: {worker_id} batch_id: {batch_id} | file_path: {file_path}")
+        log.info("Successfully uploaded batch: worker_id: %s batch_id: %s | file_path: %s", worker_id, batch_id, file_path)
         return True
     else:
-        print(f"Unable to upload batch: worker_id: {worker_id} batch_id: {batch_id} | file_path: {file_path}")
+        log.error("Unable to upload batch: worker_id: %s batch_id: %s | file_path: %s", worker_id, batch_id, file_path)
         return False
 
 async def download_batch(worker_id, batch_id, batch_type, batch_content, random_key, batch_size, offset, domains, exclusion_limit, session):
 
-    domains.seek(offset)
-
     file_path = "../output/"
-    batch_file = BatchFile(file_path, batch_id)
+    columnar_sink = ColumnarSink(f"{file_path}columnar/", batch_id) if COLUMNAR_OUTPUT else None
+    batch_file = BatchFile(file_path, batch_id, columnar_sink, index=BATCH_INDEX)
+    batch_budget = budget.Budget("batch", **BATCH_BUDGET)
+
+    # {blog_name: (blog budget, feed discovery task)} for the next blog of a list batch, started while
+    # the blog before it finishes its last posts. Only the feed is fetched early, the blog is still
+    # classified and written in its turn so the batch file keeps the list's order.
+    prefetched = {}
+
+    async def discover_blog(blog_name):
+        comment_counts = []
+        blog_posts = await get_blog_posts(f"https://{blog_name}.blogspot.com", exclusion_limit, session, comment_counts)
+        for i, post in enumerate(blog_posts):
+            if post.startswith("https:///"):
+                blog_posts[i] = post.replace("https://", f"https://{blog_name}.blogspot.com")
+        return blog_posts, comment_counts
+
+    def prefetch_blog(blog_name):
+        log.info("Discovering next blog: %s", blog_name)
+        blog_budget = budget.Budget("blog", **BLOG_BUDGET)
+        # the feed requests are charged to the blog they're for, not to the one still downloading
+        token = budget.current_budgets.set((batch_budget, blog_budget))
+        try:
+            prefetched[blog_name] = (blog_budget, asyncio.create_task(discover_blog(blog_name)))
+        finally:
+            budget.current_budgets.reset(token)
+
+    async def cancel_prefetched():
+        # a blog that raised or was killed leaves the next blog's discovery running on the shared session
+        discoveries = [discovery for blog_budget, discovery in prefetched.values()]
+        prefetched.clear()
+        for discovery in discoveries:
+            discovery.cancel()
+        await asyncio.gather(*discoveries, return_exceptions=True)
+
+    # output: the batch file, or a BlogSpool of it the blog is written to until it's its turn
+    async def download_blog(blog_name, first_blog, next_blog=None, output=batch_file):
+        blog_budget, discovery = prefetched.pop(blog_name, (None, None))
+        batch_exceeded = batch_budget.exceeded()
+        if batch_exceeded:
+            if discovery:
+                discovery.cancel()
+            # the rest of the batch is still listed so the master knows which blogs weren't downloaded
+            log.warning("Marking as truncated (batch %s budget used up): batch_id: %s | blog_name: %s", batch_exceeded, batch_id, blog_name)
+            metrics.BUDGETS_EXCEEDED.inc(f"batch {batch_exceeded}")
+            await submit_truncated(worker_id, batch_id, random_key, blog_name, session)
+            blog_domain = f"{blog_name}.blogspot.com"
+            output.start_blog(WORKER_VERSION, blog_name, blog_domain, "t", first_blog)
+            output.end_blog()
+            return
+
+        if blog_budget:
+            # the blog's time starts with its turn, not with the discovery that overlapped the blog before it
+            blog_budget.started = perf_counter()
+        else:
+            blog_budget = budget.Budget("blog", **BLOG_BUDGET)
+        with budget.track(batch_budget), budget.track(blog_budget):
+            await download_blog_within_budget(blog_name, first_blog, discovery, next_blog, output)
 
-    async def download_blog(blog_name, first_blog):
+    async def download_blog_within_budget(blog_name, first_blog, discovery, next_blog, output):
 
         if killer.kill_now:
-            print(f"Graceful Killer enabled, setting batch status to Fail | batch_id: {batch_id}")
+            log.warning("Graceful Killer enabled, setting batch status to Fail | batch_id: %s", batch_id)
+            if discovery:
+                discovery.cancel()
+                await asyncio.gather(discovery, return_exceptions=True)
+            await cancel_prefetched()
             await update_batch_status(worker_id, batch_id, random_key, "f", session)
             exit(1)
         else:
             try:
-                print(f"Downloading blog: {blog_name}")
-                blog_posts = await get_blog_posts(f"https://{blog_name}.blogspot.com", exclusion_limit, session)
-                for i, post in enumerate(blog_posts):
-                    if post.startswith("https:///"):
-                        blog_posts[i] = post.replace("https://", f"https://{blog_name}.blogspot.com")
+                log.info("Downloading blog: %s", blog_name)
+                blog_posts, comment_counts = await (discovery or discover_blog(blog_name))
                 # The blog cannot be found / is deleted
                 if blog_posts == "nf":
-                    print(f"Marking as deleted: batch_id: {batch_id} | blog_name: {blog_name}")
+                    log.info("Marking as deleted: batch_id: %s | blog_name: %s", batch_id, blog_name)
                     await submit_deleted(worker_id, batch_id, random_key, blog_name, session)
                     blog_domain = f"{blog_name}.blogspot.com"
-                    batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "d", first_blog)
-                    batch_file.end_blog()
+                    output.start_blog(WORKER_VERSION, blog_name, blog_domain, "d", first_blog)
+                    output.end_blog()
                 # The blog is private
                 elif blog_posts == "pr":
-                    print(f"Marking as private: batch_id: {batch_id} | blog_name: {blog_name}")
+                    log.info("Marking as private: batch_id: %s | blog_name: %s", batch_id, blog_name)
                     await submit_private(worker_id, batch_id, random_key, blog_name, session)
                     blog_domain = f"{blog_name}.blogspot.com"
-                    batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "p", first_blog)
-                    batch_file.end_blog()
+                    output.start_blog(WORKER_VERSION, blog_name, blog_domain, "p", first_blog)
+                    output.end_blog()
                 # Other errors
                 elif blog_posts == "oe":
                     if batch_type == "list":
-                        print(f"Marking as exclusion: batch_id: {batch_id} | blog_name: {blog_name}")
+                        log.info("Marking as exclusion: batch_id: %s | blog_name: %s", batch_id, blog_name)
                         await submit_exclusion(worker_id, batch_id, random_key, blog_name, session)
                         blog_domain = f"{blog_name}.blogspot.com"
-                        batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "e", first_blog)
-                        batch_file.end_blog()
+                        output.start_blog(WORKER_VERSION, blog_name, blog_domain, "e", first_blog)
+                        output.end_blog()
                     elif batch_type == "domain":
-                        print(f"Marking as investigate: batch_id: {batch_id} | blog_name: {blog_name}")
+                        log.info("Marking as investigate: batch_id: %s | blog_name: %s", batch_id, blog_name)
                         blog_domain = f"{blog_name}.blogspot.com"
-                        batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "__i", first_blog)
-                        batch_file.end_blog()
+                        output.start_blog(WORKER_VERSION, blog_name, blog_domain, "__i", first_blog)
+                        output.end_blog()
                 else:
-                    blog_tld = tldextract.extract(blog_posts[0])
-                    blog_domain = f"{blog_tld.domain}.{blog_tld.suffix}"
-                    if blog_tld.subdomain:
-                        blog_domain = f"{blog_tld.subdomain}.{blog_domain}"
+                    blog_domain = get_blog_domain(blog_posts[0])
 
                     if blog_domain != f"{blog_name}.blogspot.com":
-                        print(f"Marking as custom domain: batch_id: {batch_id} | blog_name: {blog_name} | blog_domain: {blog_domain}")
+                        log.info("Marking as custom domain: batch_id: %s | blog_name: %s | blog_domain: %s", batch_id, blog_name, blog_domain)
                         await submit_custom_domain(worker_id, batch_id, random_key, blog_name, blog_domain, session)
 
-                    batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "a", first_blog)
-                    dler = PostsDownloader(blog_posts, batch_file, exclusion_limit)
+                    output.start_blog(WORKER_VERSION, blog_name, blog_domain, "a", first_blog)
+                    post_comment_counts = dict(zip(blog_posts, comment_counts)) if USE_FEED_COUNTS else None
+                    if batch_type == "domain" and SHARD_PROCESSES > 1 and len(blog_posts) >= shards.MIN_SHARDED_POSTS:
+                        log.info("Downloading %s posts with %s processes: batch_id: %s | blog_name: %s", len(blog_posts), SHARD_PROCESSES, batch_id, blog_name)
+                        dler = shards.ShardedDownloader(blog_posts, output, exclusion_limit, SHARD_PROCESSES, prior_archive=PRIOR_ARCHIVE, archive_index=ARCHIVE_INDEX, skip_unchanged=SKIP_UNCHANGED, comment_counts=post_comment_counts)
+                    else:
+                        dler = downloader.PostsDownloader(blog_posts, output, exclusion_limit, prior_archive=PRIOR_ARCHIVE, archive_index=ARCHIVE_INDEX, skip_unchanged=SKIP_UNCHANGED, comment_counts=post_comment_counts, on_tail=(lambda: prefetch_blog(next_blog)) if next_blog else None)
                     await dler.start()
-                    batch_file.end_blog()
+                    if dler.budget_exceeded:
+                        log.warning("Marking as truncated (%s budget used up): batch_id: %s | blog_name: %s", dler.budget_exceeded, batch_id, blog_name)
+                        await submit_truncated(worker_id, batch_id, random_key, blog_name, session)
+                        output.end_blog(truncated=dler.budget_exceeded)
+                    else:
+                        output.end_blog()
 
             except MarkExclusion:
                 if batch_type == "list":
-                    print(f"Marking as exclusion: batch_id: {batch_id} | blog_name: {blog_name}")
+                    log.info("Marking as exclusion: batch_id: %s | blog_name: %s", batch_id, blog_name)
                     await submit_exclusion(worker_id, batch_id, random_key, blog_name, session)
                     blog_domain = f"{blog_name}.blogspot.com"
-                    batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "e", first_blog)
-                    batch_file.end_blog()
+                    output.start_blog(WORKER_VERSION, blog_name, blog_domain, "e", first_blog)
+                    output.end_blog()
                 elif batch_type == "domain":
-                    print(f"Marking as investigate: batch_id: {batch_id} | blog_name: {blog_name}")
+                    log.info("Marking as investigate: batch_id: %s | blog_name: %s", batch_id, blog_name)
                     blog_domain = f"{blog_name}.blogspot.com"
-                    batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "__i", first_blog)
-                    batch_file.end_blog()
+                    output.start_blog(WORKER_VERSION, blog_name, blog_domain, "__i", first_blog)
+                    output.end_blog()
             except NoEntries:
-                print(f"Blog has no posts: batch_id: {batch_id} | blog_name: {blog_name}")
+                log.info("Blog has no posts: batch_id: %s | blog_name: %s", batch_id, blog_name)
                 blog_domain = f"{blog_name}.blogspot.com"
-                batch_file.start_blog(WORKER_VERSION, blog_name, blog_domain, "a", first_blog)
-                batch_file.end_blog()
+                output.start_blog(WORKER_VERSION, blog_name, blog_domain, "a", first_blog)
+                output.end_blog()
+
+    async def download_blogs_in_parallel(blog_names):
+        # up to PARALLEL_BLOGS blogs download at once, each into its own spool on disk, and they're
+        # appended to the batch in the list's order as soon as every blog before them is done.
+        # The blogs share the pool's session and so one identity: each blog pauses on its own rate limits,
+        # but the cookies a rotation drops are every blog's (pool.rotate_identity doesn't rotate again for a blog that paused before another blog's rotation).
+        running = asyncio.Semaphore(PARALLEL_BLOGS)
+
+        async def download_spooled(blog_name, first_blog):
+            async with running:
+                spool = batch_file.spool_blog()
+                try:
+                    await download_blog(blog_name, first_blog, output=spool)
+                except BaseException:
+                    # also when cancelled, the temp file of a blog that won't be appended is dropped right away
+                    spool.raw_file.close()
+                    raise
+                return spool
+
+        tasks = [asyncio.create_task(download_spooled(blog_name, i == 0)) for i, blog_name in enumerate(blog_names[:batch_size]) if blog_name != ""]
+        if len(tasks) < batch_size:
+            log.info("Reached end of domains list")
+        try:
+            for i, task in enumerate(tasks):
+                batch_file.append_spool(await task)
+                log.info("[BATCH PROGRESS] %s/%s", i + 1, batch_size)
+        except BaseException:
+            # the batch fails with the first blog that does, the others are stopped before it's retried
+            for task in tasks:
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if not isinstance(result, BaseException):
+                    result.raw_file.close()
+            raise
 
     if batch_type == "list":
         # batch_size = 5
-        print("Downloading multiple domains (list)")
-        for i in range(batch_size):
-            print(f"[BATCH PROGRESS] {i}/{batch_size}")
-            blog_name = domains.readline().replace("\n", "")
-            if blog_name != "":
-                first_blog = (i == 0)
-                await download_blog(blog_name, first_blog)
-            else:
-                print("Reached end of domains list")
+        log.info("Downloading multiple domains (list)")
+        blog_names = await domains.read_lines(offset, batch_size)
+        if PARALLEL_BLOGS > 1:
+            await download_blogs_in_parallel(blog_names)
+        else:
+            try:
+                for i in range(batch_size):
+                    log.info("[BATCH PROGRESS] %s/%s", i, batch_size)
+                    blog_name = blog_names[i]
+                    if blog_name != "":
+                        first_blog = (i == 0)
+                        next_blog = blog_names[i + 1] if PREFETCH_NEXT_BLOG and i + 1 < batch_size else None
+                        await download_blog(blog_name, first_blog, next_blog or None)
+                    else:
+                        log.info("Reached end of domains list")
+            finally:
+                await cancel_prefetched()
 
     elif batch_type == "domain":
         if batch_content != "":
-            print(f"Downloading single domain: {batch_content}")
+            log.info("Downloading single domain: %s", batch_content)
             await download_blog(batch_content, True)
         else:
             raise Exception(f"Invalid batch_content: {batch_content}")
@@ -293,18 +472,26 @@ async def download_batch(worker_id, batch_id, batch_type, batch_content, random_
     file_name = batch_file.file_name
 
     upload_response = await upload_batch(worker_id, batch_id, random_key, WORKER_VERSION, file_path, file_name, session)
+    if ARCHIVE_INDEX:
+        if upload_response:
+            log.info("Indexed %s posts | batch_id: %s", ARCHIVE_INDEX.commit_batch(batch_id), batch_id)
+        else:
+            ARCHIVE_INDEX.discard_batch(batch_id)
     await update_batch_status(worker_id, batch_id, random_key, "c" if upload_response else "f", session)
-    print(f"Deleting batch file | file_path: {file_path} | status: {upload_response}")
+    log.info("Deleting batch file | file_path: %s | status: %s", file_path, upload_response)
     os.remove(file_path)
+    # the index only locates posts in the local file, it goes with it
+    if batch_file.index_path:
+        os.remove(batch_file.index_path)
 
     return True
 
 async def retry_request_on_fail(func, fail_func, check_text, check_batch_fail=False, *args, **kwargs):
 
     total_slept = 0
-    sleep_amount = MASTER_SLEEP_INCREMENT
+    sleep_amount = CONFIG.master_sleep_increment
 
-    while total_slept < MASTER_SLEEP_TOTAL:
+    while total_slept < CONFIG.master_sleep_total:
         try:
             response = await func(*args, **kwargs)
             if check_batch_fail:
@@ -314,121 +501,81 @@ async def retry_request_on_fail(func, fail_func, check_text, check_batch_fail=Fa
                     if "batchID" in obj and obj["batchID"] != "Fail":
                         return response
                     else:
+                        metrics.RETRIES.inc("master")
                         fail_func(response.status)
-                        print(f"Retrying request | sleep_amount: {sleep_amount} total_slept: {total_slept}")
+                        log.info("Retrying request | sleep_amount: %s total_slept: %s", sleep_amount, total_slept)
                         await asyncio.sleep(sleep_amount)
                         total_slept += sleep_amount
-                        if sleep_amount < MASTER_SLEEP_MAXIMUM:
-                            sleep_amount += MASTER_SLEEP_INCREMENT
+                        if sleep_amount < CONFIG.master_sleep_maximum:
+                            sleep_amount += CONFIG.master_sleep_increment
 
                 else:
+                    metrics.RETRIES.inc("master")
                     fail_func(response.status)
-                    print(f"Retrying request | sleep_amount: {sleep_amount} total_slept: {total_slept}")
+                    log.info("Retrying request | sleep_amount: %s total_slept: %s", sleep_amount, total_slept)
                     await asyncio.sleep(sleep_amount)
                     total_slept += sleep_amount
-                    if sleep_amount < MASTER_SLEEP_MAXIMUM:
-                        sleep_amount += MASTER_SLEEP_INCREMENT
+                    if sleep_amount < CONFIG.master_sleep_maximum:
+                        sleep_amount += CONFIG.master_sleep_increment
             elif check_text:
                 text = await(response.text())
-                print(f"Server response: {text}")
+                log.debug("Server response: %s", text)
                 if (text != "Fail" or text == "Dupe") and response.status == 200:
                     # print("Success!")
                     return response
                 else:
+                    metrics.RETRIES.inc("master")
                     fail_func(response.status)
-                    print(f"Retrying request | sleep_amount: {sleep_amount} total_slept: {total_slept}")
+                    log.info("Retrying request | sleep_amount: %s total_slept: %s", sleep_amount, total_slept)
                     await asyncio.sleep(sleep_amount)
                     total_slept += sleep_amount
-                    if sleep_amount < MASTER_SLEEP_MAXIMUM:
-                        sleep_amount += MASTER_SLEEP_INCREMENT
+                    if sleep_amount < CONFIG.master_sleep_maximum:
+                        sleep_amount += CONFIG.master_sleep_increment
 
             elif response.status == 200:
-                print("Server responded with 200")
+                log.debug("Server responded with 200")
                 return response
             else:
+                metrics.RETRIES.inc("master")
                 fail_func(response.status)
-                print(f"Retrying request | sleep_amount: {sleep_amount} total_slept: {total_slept}")
+                log.info("Retrying request | sleep_amount: %s total_slept: %s", sleep_amount, total_slept)
                 await asyncio.sleep(sleep_amount)
                 total_slept += sleep_amount
-                if sleep_amount < MASTER_SLEEP_MAXIMUM:
-                    sleep_amount += MASTER_SLEEP_INCREMENT
+                if sleep_amount < CONFIG.master_sleep_maximum:
+                    sleep_amount += CONFIG.master_sleep_increment
         except Exception:
+            metrics.RETRIES.inc("master")
             fail_func("unknown")
-            print(f"Retrying request | sleep_amount: {sleep_amount} total_slept: {total_slept}")
+            log.info("Retrying request | sleep_amount: %s total_slept: %s", sleep_amount, total_slept)
             await asyncio.sleep(sleep_amount)
             total_slept += sleep_amount
-            if sleep_amount < MASTER_SLEEP_MAXIMUM:
-                sleep_amount += MASTER_SLEEP_INCREMENT
+            if sleep_amount < CONFIG.master_sleep_maximum:
+                sleep_amount += CONFIG.master_sleep_increment
 
 
-    print(f"Request retry reached max ({MASTER_SLEEP_TOTAL} seconds)")
+    log.error("Request retry reached max (%s seconds)", CONFIG.master_sleep_total)
+    stop_logging()
     sys.exit(1)
     # return False
 
 async def download_domains():
 
-    class IncompleteDomains(Exception):
-        pass
-
     async with aiohttp.ClientSession() as session:
-
-        def fail_func(response_status):
-            print(f"Failed to get domains.txt.gz, retrying")
-
         try:
-
-            domains_response = await retry_request_on_fail(session.get, fail_func, False, False, DOMAINS_LIST_ENDPOINT)
-
-            domains_length = int(domains_response.headers["Content-Length"])
-
-            print(f"Received content length from server: {domains_length}")
-
-            with open("../domains.txt.gz", "wb") as domains:
-                total_bytes_downloaded = 0
-                while True:
-                    # download in chunks of 10MB
-                    chunk = await domains_response.content.read((1000 * 1000) * 10)
-                    chunk_length = len(chunk)
-                    total_bytes_downloaded += chunk_length
-                    if total_bytes_downloaded == domains_length and chunk_length == 0:
-                        break
-                    elif chunk_length == 0:
-                        print("Sleeping", total_bytes_downloaded, domains_length, total_bytes_downloaded == domains_length)
-                        time.sleep(2)
-                    else:
-                        domains.write(chunk)
-
-            final_file_size = os.path.getsize("../domains.txt.gz")
-            print(f"domains.txt.gz | Download finished (expected size: {domains_length}, got: {final_file_size})")
-            if final_file_size == domains_length:
-                print(f"Successfully downloaded domains.txt (expected size: {domains_length}, got: {final_file_size})")
-                print("Extracting to ../domains.txt")
-                with gzip.open("../domains.txt.gz", "rb") as f_in:
-                    with open("../domains.txt", "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-
-                if os.path.exists("../domains.txt.gz"):
-                    print("Deleting gzip..")
-                    os.remove("../domains.txt.gz")
-            else:
-                print(f"Domains list is incomplete. Try manually downloading in a browser\n{DOMAINS_LIST_ENDPOINT}")
-                if os.path.exists("../domains.txt.gz"):
-                    print("Deleting gzip..")
-                    os.remove("../domains.txt.gz")
-                raise IncompleteDomains("The domains list is incomplete")
-        except asyncio.TimeoutError:
-            print("Request timed out..")
-            print(f"Delete domains.txt and start the worker again, or try manually downloading and extracting the domains list from {DOMAINS_LIST_ENDPOINT}")
-            print(f"Should that also fail to download, try the same with https://archive.org/details/domains.txt")
-            exit(0)
+            await domains_list.download_domains(DOMAINS_LIST_ENDPOINT, session)
+        except Exception as e:
+            log.error("Failed to download domains list (%s)", e)
+            log.error("Start the worker again, or try manually downloading and extracting the domains list from %s", DOMAINS_LIST_ENDPOINT)
+            log.error("Should that also fail to download, try with https://archive.org/details/domains.txt")
+            raise domains_list.IncompleteDomains(str(e)) from e
 
 
 async def batch_downloader(worker_id, domains, session, batch_id):
     while True:
-        print("Requesting new batch...")
+        log.info("Requesting new batch...")
         batch = await get_batch(worker_id, session)
         # batch = {"batch_id": 11580, "batch_type": "domain", "random_key": 2938, "content": "kalaichotkovai", "batch_size": 250, "file_offset": 0, "exclusion_limit": 0}
-        print(f"Received batch: {batch}")
+        log.info("Received batch: %s", batch)
         if batch:
             batch_id = batch["batch_id"]
             batch_type = batch["batch_type"]
@@ -442,72 +589,156 @@ async def batch_downloader(worker_id, domains, session, batch_id):
 
             for i in range(3):
                 try:
-                    batch_result = await download_batch(worker_id, batch_id, batch_type, batch_content, random_key, batch_size, offset, domains, exclusion_limit, session)
+                    with tracing.BatchProfiler(f"batch-{batch_id}-{i}") if PROFILE else contextlib.nullcontext():
+                        batch_result = await download_batch(worker_id, batch_id, batch_type, batch_content, random_key, batch_size, offset, domains, exclusion_limit, session)
                     break
                 except Exception as e:
-                    print(f"Error: {e}\nRetrying downloading of batch in 10 seconds: batch_id: {batch_id}")
-                    await asyncio.sleep(10)
+                    if ARCHIVE_INDEX:
+                        ARCHIVE_INDEX.discard_batch(batch_id)
+                    log.warning("Error: %s\nRetrying downloading of batch in %s seconds: batch_id: %s", e, CONFIG.batch_sleep, batch_id)
+                    await asyncio.sleep(CONFIG.batch_sleep)
 
             if not batch_result:
-                print(f"Unable to download batch | batch_id: {batch_id}, requesting new batch in 10 seconds")
+                log.error("Unable to download batch | batch_id: %s, requesting new batch in %s seconds", batch_id, CONFIG.batch_sleep)
 
         else:
-            print("Unable to get batch, requesting new batch in 10 seconds")
+            log.error("Unable to get batch, requesting new batch in %s seconds", CONFIG.batch_sleep)
 
-        await asyncio.sleep(10)
+        await asyncio.sleep(CONFIG.batch_sleep)
 
 
 async def main():
 
     # logging.basicConfig(format="%(message)s", level=logging.INFO)
 
-    with open("../domains.txt", "r") as domains:
-        async with aiohttp.ClientSession() as session:
-            print("Requesting worker ID")
+    if hasattr(signal, "SIGHUP"):
+        # kill -HUP <pid> re-reads the config file (--config or WORKER_CONFIG)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, CONFIG.reload)
+
+    async with aiohttp.ClientSession() as session:
+        if LAZY_DOMAINS:
+            domains = domains_list.RemoteDomains(route(DOMAINS_TEXT_ENDPOINT), session, DOMAINS_BLOCK_CACHE)
+        elif DOWNLOAD_DOMAINS:
+            # batches start as soon as the part of the list they need has been extracted
+            domains_download = asyncio.create_task(download_domains())
+            domains = domains_list.LocalDomains(download=domains_download)
+        else:
+            domains = domains_list.LocalDomains()
+        try:
+            metrics_tasks = await metrics.start_from_env()
+            if util.TARGET:
+                metrics_tasks.append(asyncio.create_task(metrics.write_load_report_periodically(LOAD_REPORT_PATH, LOAD_REPORT_INTERVAL)))
+            log.info("Requesting worker ID")
             worker_id = await get_worker_id(session)
             # worker_id = "27747438-9825-51e1-9578-8807297944e6"
             if worker_id:
                 batch_downloader_tasks = []
-                print(f"Received worker ID: {worker_id}")
-                for i in range(BATCH_DOWNLOADER_COUNT):
+                log.info("Received worker ID: %s", worker_id)
+                for i in range(CONFIG.batch_downloader_count):
                     task = asyncio.create_task(batch_downloader(worker_id, domains, session, i))
                     batch_downloader_tasks.append(task)
 
-                await asyncio.gather(*batch_downloader_tasks)
-                print("All batch downloaders done")
+                if DOWNLOAD_DOMAINS:
+                    batch_downloader_tasks.append(domains_download)
+                try:
+                    await asyncio.gather(*batch_downloader_tasks)
+                except domains_list.IncompleteDomains:
+                    log.error("Stopping, the worker can't get batches without the domains list")
+                    return
+                log.info("All batch downloaders done")
+        finally:
+            domains.close()
+            await POOL.close()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", action="store_true", help="save a cProfile dump and a Chrome trace of each batch to ../profiles/")
+    parser.add_argument("--prior", action="append", default=[], help="a previous batch .json.gz or comment index, only new comments are fetched for the posts in it (can be repeated)")
+    parser.add_argument("--index", help="sqlite file recording every archived post")
+    parser.add_argument("--skip-unchanged", action="store_true", help="don't download posts again whose comment total matches the index")
+    parser.add_argument("--columnar", action="store_true", help="also write comments, replies and +1s as Parquet files to ../output/columnar/ (needs pyarrow)")
+    parser.add_argument("--blog-budget", type=budget.parse_budget, default={}, help="stop a blog once it reaches any of seconds=, requests=, bytes= (e.g. seconds=3600,bytes=2g) and save what it has with status t")
+    parser.add_argument("--batch-budget", type=budget.parse_budget, default={}, help="the same limits for a whole batch, blogs left when it runs out are saved with status t")
+    parser.add_argument("--batch-index", action="store_true", help="write each blog as a separate gzip member and save an index of where every post starts")
+    parser.add_argument("--max-plus-ones", type=int, help="request at most this many +1 profiles per comment or reply, larger lists are marked plus_ones_capped")
+    parser.add_argument("--text", choices=text_content.TEXT_FORMATS, default="raw", help="store comment text as Google's raw arrays, decoded plain text with link spans, or both")
+    parser.add_argument("--target", help="send every request to this simulator (python simulator.py) instead, e.g. http://127.0.0.1:8080, and write a load report")
+    parser.add_argument("--report", default=LOAD_REPORT_PATH, help="where --target appends its load report (json lines)")
+    parser.add_argument("--report-interval", type=float, default=LOAD_REPORT_INTERVAL)
+    parser.add_argument("--no-prefetch", action="store_true", help="don't start fetching the next blog's feed before the current blog is finished")
+    parser.add_argument("--parallel-blogs", type=int, default=PARALLEL_BLOGS, help="download this many blogs of a list batch at once, spooling finished ones to disk until their turn")
+    parser.add_argument("--shard-processes", type=int, default=SHARD_PROCESSES, help="download the blog of a single domain batch with this many processes, idle ones take over the shards of busy ones")
+    parser.add_argument("--config", default=CONFIG.path, help="json file of settings from fetch/config.py, re-read on SIGHUP")
+    parser.add_argument("--no-feed-counts", action="store_true", help="request the comments widget even for posts the feed says have no comments")
+    args = parser.parse_args()
+    PROFILE = args.profile
+    # before the config is loaded, which logs the settings it changes
+    setup_logging()
+    CONFIG.path = args.config
+    CONFIG.load()
+    if args.skip_unchanged and not args.index:
+        parser.error("--skip-unchanged needs --index")
+    SKIP_UNCHANGED = args.skip_unchanged
+    USE_FEED_COUNTS = not args.no_feed_counts
+    COLUMNAR_OUTPUT = args.columnar
+    if COLUMNAR_OUTPUT:
+        # a missing pyarrow would otherwise fail every batch after it's been taken from the master
+        try:
+            import_pyarrow()
+        except ImportError as e:
+            parser.error(str(e))
+    BATCH_INDEX = args.batch_index
+    PREFETCH_NEXT_BLOG = not args.no_prefetch
+    PARALLEL_BLOGS = args.parallel_blogs
+    SHARD_PROCESSES = args.shard_processes
+    BLOG_BUDGET = args.blog_budget
+    BATCH_BUDGET = args.batch_budget
+    text_content.TEXT_FORMAT = args.text
+    plus_ones.MAX_PLUS_ONES = args.max_plus_ones
+    if args.target:
+        util.TARGET = args.target.rstrip("/")
+        LOAD_REPORT_PATH = args.report
+        LOAD_REPORT_INTERVAL = args.report_interval
+        # the simulated domains list is read remotely so the real ../domains.txt is left alone
+        LAZY_DOMAINS = True
+        log.info("Sending every request to %s", util.TARGET)
+    if args.index:
+        ARCHIVE_INDEX = ArchiveIndex(args.index)
+
+    if args.prior:
+        PRIOR_ARCHIVE = PriorArchive()
+        for prior_path in args.prior:
+            PRIOR_ARCHIVE.posts.update(PriorArchive.load(prior_path).posts)
+        log.info("Loaded prior archive | posts: %s", len(PRIOR_ARCHIVE.posts))
+
     killer = GracefulKiller()
 
     # create the output folder for the gzipped batches
     if not os.path.isdir("../output"):
         os.makedirs("../output")
 
-    # download the domains list
-    if not os.path.exists("../domains.txt"):
-        print("Downloading domains list..")
-        asyncio.run(download_domains())
-        if os.path.exists("../domains.txt.gz"):
-            print("Deleting gzip..")
-            os.remove("../domains.txt.gz")
-    else:
-        file_size = os.path.getsize("../domains.txt")
-        expected_size = 122697503
-        if file_size == expected_size:
-            print("Found valid domains.txt")
+    # download the domains list, resuming a partial download if there is one
+    if LAZY_DOMAINS:
+        log.info("Reading domains list on demand from %s", route(DOMAINS_TEXT_ENDPOINT))
+    elif not domains_list.is_valid_domains_file():
+        if os.path.exists(domains_list.DOMAINS_PATH) and not os.path.exists(domains_list.DOMAINS_HASH_PATH):
+            # there's nothing recorded to tell a broken file from a list that's newer or extracted by hand
+            log.warning("domains.txt isn't the expected %s bytes and has no recorded hash, using it as it is (delete it to download the list again)", domains_list.DOMAINS_SIZE)
+        elif os.path.exists(domains_list.DOMAINS_PATH):
+            log.warning("domains.txt doesn't match its recorded hash, downloading it again while the first batches run..")
+            # batches mustn't read the old file before the download replaces it, a partial download is resumed from its .part
+            os.remove(domains_list.DOMAINS_PATH)
         else:
-            print(f"Domains list should be {expected_size} bytes, but it's {file_size} bytes")
-            print("Trying to re download domains.txt..")
-            try:
-                asyncio.run(download_domains())
-                if os.path.exists("../domains.txt.gz"):
-                    print("Deleting gzip..")
-                    os.remove("../domains.txt.gz")
-            except:
-                print("Failed to redownload domains list..")
-                print(f"Delete domains.txt and start the worker again, or try manually downloading and extracting the domains list from {DOMAINS_LIST_ENDPOINT}")
-                print(f"Should that also fail to download, try with https://archive.org/details/domains.txt")
-                exit(0)
-
-
-    asyncio.run(main())
+            log.info("Downloading domains list while the first batches run..")
+        if not os.path.exists(domains_list.DOMAINS_PATH):
+            if os.path.exists(domains_list.DOMAINS_HASH_PATH):
+                os.remove(domains_list.DOMAINS_HASH_PATH)
+            DOWNLOAD_DOMAINS = True
+    else:
+        log.info("Found valid domains.txt")
+
+
+    try:
+        asyncio.run(main())
+    finally:
+        stop_logging()